@@ -25,12 +25,14 @@ import os.path
 from projectgenerator.gui.options import OptionsDialog
 from projectgenerator.gui.multiple_models import MultipleModelsDialog
 from projectgenerator.libili2db.iliexporter import JavaNotFoundError
-from projectgenerator.libili2db.ilicache import IliCache
+from projectgenerator.libili2db.ili2dbconfig import JavaVersionError, MIN_JAVA_VERSION
+from projectgenerator.libili2db.ili2dbjob import Ili2dbJob
+from projectgenerator.libili2db.ilicache import IliCache, IliModelCompleterModel
 from projectgenerator.utils.qt_utils import make_save_file_selector, Validators, \
-    make_file_selector, FileValidator, NonEmptyStringValidator, make_folder_selector, OverrideCursor
+    make_file_selector, FileValidator, NonEmptyStringValidator, make_folder_selector, OverrideCursor, SearchCompleter
 from qgis.PyQt.QtGui import QColor, QDesktopServices, QFont, QValidator
-from qgis.PyQt.QtWidgets import QDialog, QDialogButtonBox, QApplication, QCompleter, QMessageBox
-from qgis.PyQt.QtCore import QCoreApplication, QSettings, Qt, QLocale
+from qgis.PyQt.QtWidgets import QDialog, QDialogButtonBox, QApplication, QMessageBox
+from qgis.PyQt.QtCore import QSettings, Qt, QLocale
 from qgis.core import QgsProject
 from qgis.gui import QgsGui
 from ..utils import get_ui_class
@@ -42,7 +44,7 @@ DIALOG_UI = get_ui_class('export.ui')
 class ExportDialog(QDialog, DIALOG_UI):
     ValidExtensions = ['xtf', 'itf', 'gml', 'xml']
 
-    def __init__(self, base_config, parent=None):
+    def __init__(self, base_config, parent=None, ilicache=None):
         QDialog.__init__(self, parent)
         self.setupUi(self)
         QgsGui.instance().enableAutoGeometryRestore(self);
@@ -76,6 +78,7 @@ class ExportDialog(QDialog, DIALOG_UI):
             self.fill_models_line_edit)
 
         self.base_configuration = base_config
+        self.job = None
         self.restore_configuration()
 
         self.validators = Validators()
@@ -116,10 +119,11 @@ class ExportDialog(QDialog, DIALOG_UI):
             self.gpkg_file_line_edit.text())
 
         settings = QSettings()
-        ilifile = settings.value('QgsProjectGenerator/ili2db/ilifile')
-        self.ilicache = IliCache(base_config, ilifile or None)
-        self.ilicache.models_changed.connect(self.update_models_completer)
-        self.ilicache.refresh()
+        # The models of the last used ili file are only offered in this dialog
+        self.ilifile = settings.value('QgsProjectGenerator/ili2db/ilifile') or None
+        self.ilicache = ilicache or IliCache(base_config)
+        self.update_models_completer()
+        self.ilicache.refresh(background=True)
 
     def accepted(self):
         configuration = self.updated_configuration()
@@ -178,6 +182,12 @@ class ExportDialog(QDialog, DIALOG_UI):
             self.txtStdout.setTextColor(QColor('#000000'))
             self.txtStdout.clear()
 
+            if self.base_configuration.mirror_models_enabled:
+                self.ilicache.mirror_models(configuration.ilimodels)
+            if self.base_configuration.minimal_model_directories_enabled:
+                configuration.required_model_directories = self.ilicache.required_model_directories(
+                    configuration.ilimodels, self.ilifile)
+
             exporter = iliexporter.Exporter()
 
             tool_name = 'ili2pg' if self.type_combo_box.currentData() == 'pg' else 'ili2gpkg'
@@ -191,13 +201,24 @@ class ExportDialog(QDialog, DIALOG_UI):
             exporter.process_started.connect(self.on_process_started)
             exporter.process_finished.connect(self.on_process_finished)
 
-            self.progress_bar.setValue(25)
+            self.job = Ili2dbJob(exporter, self)
+            self.job.progress_changed.connect(self.progress_bar.setValue)
+            self.job.finished.connect(self.on_job_finished)
 
             try:
-                if exporter.run() != iliexporter.Exporter.SUCCESS:
+                if not self.job.start():
                     self.enable()
                     self.progress_bar.hide()
                     return
+            except JavaVersionError as e:
+                self.txtStdout.setTextColor(QColor('#000000'))
+                self.txtStdout.clear()
+                self.txtStdout.setText(self.tr(
+                    'Java {version} found at {path} is too old, Java {required} or newer is required. Please <a href="https://java.com/en/download/">install a newer Java</a> and or <a href="#configure">configure a custom java path</a>.').format(
+                    version=e.version, path=e.java_path, required=MIN_JAVA_VERSION))
+                self.enable()
+                self.progress_bar.hide()
+                return
             except JavaNotFoundError:
                 self.txtStdout.setTextColor(QColor('#000000'))
                 self.txtStdout.clear()
@@ -207,28 +228,29 @@ class ExportDialog(QDialog, DIALOG_UI):
                 self.progress_bar.hide()
                 return
 
-            self.buttonBox.clear()
-            self.buttonBox.setEnabled(True)
-            self.buttonBox.addButton(QDialogButtonBox.Close)
-            self.progress_bar.setValue(100)
+    def on_job_finished(self, result):
+        if result != iliexporter.Exporter.SUCCESS:
+            self.progress_bar.hide()
+        self.job = None
+
+    def reject(self):
+        if self.job:
+            self.job.cancel()
+        QDialog.reject(self)
 
     def print_info(self, text):
         self.txtStdout.setTextColor(QColor('#000000'))
         self.txtStdout.append(text)
-        QCoreApplication.processEvents()
 
     def on_stderr(self, text):
         self.txtStdout.setTextColor(QColor('#2a2a2a'))
         self.txtStdout.append(text)
-        self.advance_progress_bar_by_text(text)
-        QCoreApplication.processEvents()
 
     def on_process_started(self, command):
         self.disable()
         self.txtStdout.setTextColor(QColor('#000000'))
         self.txtStdout.clear()
         self.txtStdout.setText(command)
-        QCoreApplication.processEvents()
 
     def on_process_finished(self, exit_code, result):
         color = '#004905' if exit_code == 0 else '#aa2222'
@@ -266,6 +288,7 @@ class ExportDialog(QDialog, DIALOG_UI):
         return configuration
 
     def save_configuration(self, configuration):
+        self.ilicache.mark_models_used(configuration.ilimodels)
         settings = QSettings()
         settings.setValue(
             'QgsProjectGenerator/ili2pg/xtffile_export', configuration.xtffile)
@@ -346,8 +369,10 @@ class ExportDialog(QDialog, DIALOG_UI):
             QDesktopServices.openUrl(link)
 
     def update_models_completer(self):
-        completer = QCompleter(self.ilicache.model_names)
-        completer.setCaseSensitivity(Qt.CaseInsensitive)
+        completer = SearchCompleter(self)
+        completer_model = IliModelCompleterModel(self.ilicache, completer)
+        completer_model.set_ili_file(self.ilifile)
+        completer.setModel(completer_model)
         self.ili_models_line_edit.setCompleter(completer)
         self.multiple_models_dialog.models_line_edit.setCompleter(completer)
 
@@ -376,9 +401,3 @@ class ExportDialog(QDialog, DIALOG_UI):
         Slot. Sets a flag to false to eventually ask a user whether to overwrite a file.
         """
         self.xtf_browser_was_opened = False
-
-    def advance_progress_bar_by_text(self, text):
-        if text.strip() == 'Info: compile models…':
-            self.progress_bar.setValue(50)
-        elif text.strip() == 'Info: create table structure…':
-            self.progress_bar.setValue(75)
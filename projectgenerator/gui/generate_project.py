@@ -29,15 +29,17 @@ from projectgenerator.gui.ili2db_options import Ili2dbOptionsDialog
 from projectgenerator.gui.multiple_models import MultipleModelsDialog
 from projectgenerator.libili2db.globals import CRS_PATTERNS
 from projectgenerator.libili2db.ili2dbconfig import SchemaImportConfiguration
-from projectgenerator.libili2db.ilicache import IliCache
+from projectgenerator.libili2db.ilicache import IliCache, IliModelCompleterModel
 from projectgenerator.libili2db.iliimporter import JavaNotFoundError
+from projectgenerator.libili2db.ili2dbconfig import JavaVersionError, MIN_JAVA_VERSION
 from projectgenerator.utils.qt_utils import (
     make_file_selector,
     make_save_file_selector,
     Validators,
     FileValidator,
     NonEmptyStringValidator,
-    OverrideCursor
+    OverrideCursor,
+    SearchCompleter
 )
 from qgis.PyQt.QtGui import (
     QColor,
@@ -47,7 +49,7 @@ from qgis.PyQt.QtGui import (
 from qgis.PyQt.QtWidgets import (
     QDialog,
     QDialogButtonBox,
-    QCompleter,
+    QMessageBox,
     QSizePolicy,
     QGridLayout
 )
@@ -55,7 +57,8 @@ from qgis.PyQt.QtCore import (
     QCoreApplication,
     QSettings,
     Qt,
-    QLocale
+    QLocale,
+    QTimer
 )
 from qgis.core import (
     QgsProject,
@@ -67,7 +70,7 @@ from qgis.gui import (
     QgsGui
 )
 from ..utils import get_ui_class
-from ..libili2db import iliimporter
+from ..libili2db import iliimporter, ili2dbevents
 from ..libqgsprojectgen.generator.generator import Generator
 from ..libqgsprojectgen.dataobjects import Project
 
@@ -76,7 +79,10 @@ DIALOG_UI = get_ui_class('generate_project.ui')
 
 class GenerateProjectDialog(QDialog, DIALOG_UI):
 
-    def __init__(self, iface, base_config, parent=None):
+    # Milliseconds after the last change of the ili file path before its models are read
+    ili_file_delay = 300
+
+    def __init__(self, iface, base_config, parent=None, ilicache=None):
         QDialog.__init__(self, parent)
         self.setupUi(self)
         self.iface = iface
@@ -153,18 +159,28 @@ class GenerateProjectDialog(QDialog, DIALOG_UI):
             self.ili_models_line_edit.text())
         self.ili_models_line_edit.textChanged.connect(self.on_model_changed)
 
-        self.ilicache = IliCache(base_config)
-        self.ilicache.models_changed.connect(self.update_models_completer)
+        self.ilicache = ilicache or IliCache(base_config)
         self.ilicache.new_message.connect(self.show_message)
-        self.ilicache.refresh()
+        # The models of this ili file are only offered in this dialog
+        self.ilifile = None
+        self.update_models_completer()
+        self.ilicache.refresh(background=True)
 
         self.ili_file_line_edit.textChanged.connect(
             self.validators.validate_line_edits)
-        self.ili_file_line_edit.textChanged.connect(self.ili_file_changed)
+        # The models of the ili file are read once the user stopped typing
+        self._ili_file_timer = QTimer(self)
+        self._ili_file_timer.setSingleShot(True)
+        self._ili_file_timer.setInterval(self.ili_file_delay)
+        self._ili_file_timer.timeout.connect(self.ili_file_changed)
+        self.ili_file_line_edit.textChanged.connect(lambda: self._ili_file_timer.start())
         self.ili_file_line_edit.textChanged.emit(
             self.ili_file_line_edit.text())
 
     def accepted(self):
+        if self._ili_file_timer.isActive():
+            self._ili_file_timer.stop()
+            self.ili_file_changed()
         configuration = self.updated_configuration()
 
         if self.type_combo_box.currentData() in ['ili2pg', 'ili2gpkg']:
@@ -205,6 +221,16 @@ class GenerateProjectDialog(QDialog, DIALOG_UI):
                 self.gpkg_file_line_edit.setFocus()
                 return
 
+        if self.type_combo_box.currentData() in ['ili2pg', 'ili2gpkg'] and not self.ilicache.refreshing:
+            missing_models = self.ilicache.model_dependencies(configuration.ilimodels, self.ilifile)[1]
+            if missing_models and QMessageBox.warning(
+                    self, self.tr('Missing models'),
+                    self.tr('The following models are imported but could not be found in the model directories, '
+                            'ili2db will probably fail.\n\n{}\n\nDo you want to continue?').format(
+                        ', '.join(sorted(missing_models))),
+                    QMessageBox.Yes | QMessageBox.No) != QMessageBox.Yes:
+                return
+
         configuration.dbschema = configuration.dbschema or configuration.database
         self.save_configuration(configuration)
 
@@ -217,20 +243,40 @@ class GenerateProjectDialog(QDialog, DIALOG_UI):
             self.txtStdout.clear()
 
             if self.type_combo_box.currentData() in ['ili2pg', 'ili2gpkg']:
+                if self.base_configuration.mirror_models_enabled:
+                    self.ilicache.mirror_models(configuration.ilimodels)
+                if self.base_configuration.minimal_model_directories_enabled:
+                    configuration.required_model_directories = self.ilicache.required_model_directories(
+                        configuration.ilimodels, self.ilifile)
+                configuration.model_versions = self.ilicache.model_versions(configuration.ilimodels, self.ilifile)
+
                 importer = iliimporter.Importer()
 
                 importer.tool_name = self.type_combo_box.currentData()
                 importer.configuration = configuration
                 importer.stdout.connect(self.print_info)
                 importer.stderr.connect(self.on_stderr)
+                importer.progress_event.connect(self.advance_progress_bar_by_event)
                 importer.process_started.connect(self.on_process_started)
                 importer.process_finished.connect(self.on_process_finished)
 
                 try:
-                    if importer.run() != iliimporter.Importer.SUCCESS:
+                    if importer.schema_unchanged():
+                        self.print_info(
+                            self.tr('The schema already holds these models with the same options, skipping the schema import.'))
+                    elif importer.run() != iliimporter.Importer.SUCCESS:
                         self.enable()
                         self.progress_bar.hide()
                         return
+                except JavaVersionError as e:
+                    self.txtStdout.setTextColor(QColor('#000000'))
+                    self.txtStdout.clear()
+                    self.txtStdout.setText(self.tr(
+                        'Java {version} found at {path} is too old, Java {required} or newer is required. Please <a href="https://java.com/en/download/">install a newer Java</a> and or <a href="#configure">configure a custom java path</a>.').format(
+                        version=e.version, path=e.java_path, required=MIN_JAVA_VERSION))
+                    self.enable()
+                    self.progress_bar.hide()
+                    return
                 except JavaNotFoundError:
                     self.txtStdout.setTextColor(QColor('#000000'))
                     self.txtStdout.clear()
@@ -311,7 +357,6 @@ class GenerateProjectDialog(QDialog, DIALOG_UI):
     def on_stderr(self, text):
         self.txtStdout.setTextColor(QColor('#2a2a2a'))
         self.txtStdout.append(text)
-        self.advance_progress_bar_by_text(text)
         QCoreApplication.processEvents()
 
     def on_process_started(self, command):
@@ -356,6 +401,7 @@ class GenerateProjectDialog(QDialog, DIALOG_UI):
         configuration.inheritance = self.ili2db_options.inheritance_type()
         configuration.tomlfile = self.ili2db_options.toml_file()
         configuration.create_basket_col = self.ili2db_options.create_basket_col()
+        configuration.force_schema_import = self.ili2db_options.force_schema_import()
 
         configuration.base_configuration = self.base_configuration
         if self.ili_file_line_edit.text().strip():
@@ -367,6 +413,7 @@ class GenerateProjectDialog(QDialog, DIALOG_UI):
         return configuration
 
     def save_configuration(self, configuration):
+        self.ilicache.mark_models_used(configuration.ilimodels)
         settings = QSettings()
         settings.setValue('QgsProjectGenerator/ili2db/ilifile',
                           configuration.ilifile)
@@ -517,13 +564,9 @@ class GenerateProjectDialog(QDialog, DIALOG_UI):
                 self.ili_models_line_edit.text())
 
             # Update completer to add models from given ili file
-            self.iliFileCache = IliCache(
-                self.base_configuration, self.ili_file_line_edit.text().strip())
-            self.iliFileCache.models_changed.connect(
-                self.update_models_completer)
-            self.iliFileCache.new_message.connect(self.show_message)
-            self.iliFileCache.refresh()
-            models = self.iliFileCache.process_ili_file(self.ili_file_line_edit.text().strip())
+            self.ilifile = self.ili_file_line_edit.text().strip()
+            self.completer_model.set_ili_file(self.ilifile)
+            models = self.ilicache.process_ili_file(self.ili_file_line_edit.text().strip())
             self.ili_models_line_edit.setText(models[-1]['name'])
         else:
             nonEmptyValidator = NonEmptyStringValidator()
@@ -532,11 +575,18 @@ class GenerateProjectDialog(QDialog, DIALOG_UI):
                 self.ili_models_line_edit.text())
 
             # Update completer to show repository models in models dir
-            self.ilicache.models_changed.emit()
+            self.ilifile = None
+            self.completer_model.set_ili_file(None)
+
+    def done(self, result):
+        self.ilicache.new_message.disconnect(self.show_message)
+        QDialog.done(self, result)
 
     def update_models_completer(self):
-        completer = QCompleter(self.sender().model_names)
-        completer.setCaseSensitivity(Qt.CaseInsensitive)
+        completer = SearchCompleter(self)
+        self.completer_model = IliModelCompleterModel(self.ilicache, completer)
+        self.completer_model.set_ili_file(self.ilifile)
+        completer.setModel(self.completer_model)
         self.ili_models_line_edit.setCompleter(completer)
         self.multiple_models_dialog.models_line_edit.setCompleter(completer)
 
@@ -567,8 +617,10 @@ class GenerateProjectDialog(QDialog, DIALOG_UI):
             webbrowser.open(
                 "https://opengisch.github.io/projectgenerator/docs/user-guide.html#generate-project")
 
-    def advance_progress_bar_by_text(self, text):
-        if text.strip() == 'Info: compile models…':
+    def advance_progress_bar_by_event(self, event):
+        if event.kind != ili2dbevents.PHASE_STARTED:
+            return
+        if event.phase == 'compile models':
             self.progress_bar.setValue(20)
-        elif text.strip() == 'Info: create table structure…':
+        elif event.phase == 'create table structure':
             self.progress_bar.setValue(30)
@@ -69,6 +69,9 @@ class Ili2dbOptionsDialog(QDialog, DIALOG_UI):
     def create_basket_col(self):
         return self.create_basket_col_checkbox.isChecked()
 
+    def force_schema_import(self):
+        return self.force_schema_import_checkbox.isChecked()
+
     def inheritance_type(self):
         if self.smart1_radio_button.isChecked():
             return 'smart1'
@@ -92,6 +95,7 @@ class Ili2dbOptionsDialog(QDialog, DIALOG_UI):
         settings.setValue(
             self.toml_file_key, self.toml_file())
         settings.setValue('QgsProjectGenerator/ili2db/create_basket_col', self.create_basket_col())
+        settings.setValue('QgsProjectGenerator/ili2db/force_schema_import', self.force_schema_import())
 
     def restore_configuration(self):
         settings = QSettings()
@@ -104,5 +108,7 @@ class Ili2dbOptionsDialog(QDialog, DIALOG_UI):
         create_basket_col = settings.value('QgsProjectGenerator/ili2db/create_basket_col', defaultValue=False, type=bool)
 
         self.create_basket_col_checkbox.setChecked(create_basket_col)
+        self.force_schema_import_checkbox.setChecked(
+            settings.value('QgsProjectGenerator/ili2db/force_schema_import', defaultValue=False, type=bool))
         self.toml_file_line_edit.setText(
             settings.value(self.toml_file_key))
@@ -18,13 +18,16 @@
  ***************************************************************************/
 """
 
+import os
 import webbrowser
 
 from projectgenerator.gui.ili2db_options import Ili2dbOptionsDialog
 from projectgenerator.gui.options import OptionsDialog
 from projectgenerator.gui.multiple_models import MultipleModelsDialog
 from projectgenerator.libili2db.iliimporter import JavaNotFoundError
-from projectgenerator.libili2db.ilicache import IliCache
+from projectgenerator.libili2db.ili2dbconfig import JavaVersionError, MIN_JAVA_VERSION
+from projectgenerator.libili2db.ili2dbjob import Ili2dbJob
+from projectgenerator.libili2db.ilicache import IliCache, IliModelCompleterModel
 from projectgenerator.utils.qt_utils import (
     make_file_selector,
     make_save_file_selector,
@@ -32,7 +35,8 @@ from projectgenerator.utils.qt_utils import (
     Validators,
     FileValidator,
     NonEmptyStringValidator,
-    OverrideCursor
+    OverrideCursor,
+    SearchCompleter
 )
 from qgis.PyQt.QtGui import (
     QColor,
@@ -41,11 +45,9 @@ from qgis.PyQt.QtGui import (
 )
 from qgis.PyQt.QtWidgets import (
     QDialog,
-    QDialogButtonBox,
-    QCompleter
+    QDialogButtonBox
 )
 from qgis.PyQt.QtCore import (
-    QCoreApplication,
     QSettings,
     Qt,
     QLocale
@@ -62,7 +64,7 @@ DIALOG_UI = get_ui_class('import_data.ui')
 
 class ImportDataDialog(QDialog, DIALOG_UI):
 
-    def __init__(self, base_config, parent=None):
+    def __init__(self, base_config, parent=None, ilicache=None):
         QDialog.__init__(self, parent)
         self.setupUi(self)
         QgsGui.instance().enableAutoGeometryRestore(self);
@@ -76,7 +78,8 @@ class ImportDataDialog(QDialog, DIALOG_UI):
         self.buttonBox.helpRequested.connect(self.help_requested)
         self.xtf_file_browse_button.clicked.connect(
             make_file_selector(self.xtf_file_line_edit, title=self.tr('Open Transfer or Catalog File'),
-                               file_filter=self.tr('Transfer File (*.xtf *.itf);;Catalogue File(*.xml *.xls *.xlsx)')))
+                               file_filter=self.tr('Transfer File (*.xtf *.itf);;Catalogue File(*.xml *.xls *.xlsx)'),
+                               multiple=True))
         self.gpkg_file_browse_button.clicked.connect(
             make_save_file_selector(self.gpkg_file_line_edit, title=self.tr('Save in GeoPackage database file'),
                                     file_filter=self.tr('GeoPackage Database (*.gpkg)'), extension='.gpkg'))
@@ -95,12 +98,13 @@ class ImportDataDialog(QDialog, DIALOG_UI):
             self.fill_models_line_edit)
 
         self.base_configuration = base_config
+        self.job = None
         self.restore_configuration()
 
         self.validators = Validators()
         nonEmptyValidator = NonEmptyStringValidator()
         fileValidator = FileValidator(
-            pattern=['*.xtf', '*.itf', '*.pdf', '*.xml', '*.xls', '*.xlsx'])
+            pattern=['*.xtf', '*.itf', '*.pdf', '*.xml', '*.xls', '*.xlsx'], allow_multiple=True)
         gpkgFileValidator = FileValidator(
             pattern='*.gpkg', allow_non_existing=True)
 
@@ -135,10 +139,11 @@ class ImportDataDialog(QDialog, DIALOG_UI):
             self.gpkg_file_line_edit.text())
 
         settings = QSettings()
-        ilifile = settings.value('QgsProjectGenerator/ili2db/ilifile')
-        self.ilicache = IliCache(base_config, ilifile or None)
-        self.ilicache.models_changed.connect(self.update_models_completer)
-        self.ilicache.refresh()
+        # The models of the last used ili file are only offered in this dialog
+        self.ilifile = settings.value('QgsProjectGenerator/ili2db/ilifile') or None
+        self.ilicache = ilicache or IliCache(base_config)
+        self.update_models_completer()
+        self.ilicache.refresh(background=True)
 
     def accepted(self):
         configuration = self.updated_configuration()
@@ -185,26 +190,54 @@ class ImportDataDialog(QDialog, DIALOG_UI):
             self.txtStdout.setTextColor(QColor('#000000'))
             self.txtStdout.clear()
 
-            dataImporter = iliimporter.Importer(dataImport=True)
+            if self.base_configuration.mirror_models_enabled:
+                self.ilicache.mirror_models(configuration.ilimodels)
+            if self.base_configuration.minimal_model_directories_enabled:
+                configuration.required_model_directories = self.ilicache.required_model_directories(
+                    configuration.ilimodels, self.ilifile)
+            configuration.model_versions = self.ilicache.model_versions(configuration.ilimodels, self.ilifile)
 
             tool_name = 'ili2pg' if self.type_combo_box.currentData() == 'pg' else 'ili2gpkg'
-            dataImporter.tool_name = tool_name
-            dataImporter.configuration = configuration
 
             self.save_configuration(configuration)
 
-            dataImporter.stdout.connect(self.print_info)
-            dataImporter.stderr.connect(self.on_stderr)
-            dataImporter.process_started.connect(self.on_process_started)
-            dataImporter.process_finished.connect(self.on_process_finished)
-
-            self.progress_bar.setValue(25)
+            xtffiles = [xtffile.strip() for xtffile in configuration.xtffile.split(';') if xtffile.strip()]
 
             try:
-                if dataImporter.run() != iliimporter.Importer.SUCCESS:
-                    self.enable()
-                    self.progress_bar.hide()
+                if len(xtffiles) > 1:
+                    self.progress_bar.setValue(25)
+                    if not self.run_batch_import(configuration, tool_name, xtffiles):
+                        self.enable()
+                        self.progress_bar.hide()
+                        return
+                else:
+                    dataImporter = iliimporter.Importer(dataImport=True)
+                    dataImporter.tool_name = tool_name
+                    dataImporter.configuration = configuration
+
+                    dataImporter.stdout.connect(self.print_info)
+                    dataImporter.stderr.connect(self.on_stderr)
+                    dataImporter.process_started.connect(self.on_process_started)
+                    dataImporter.process_finished.connect(self.on_process_finished)
+
+                    self.job = Ili2dbJob(dataImporter, self)
+                    self.job.progress_changed.connect(self.progress_bar.setValue)
+                    self.job.finished.connect(self.on_job_finished)
+
+                    if not self.job.start():
+                        self.enable()
+                        self.progress_bar.hide()
+                    # Otherwise the import goes on in the background
                     return
+            except JavaVersionError as e:
+                self.txtStdout.setTextColor(QColor('#000000'))
+                self.txtStdout.clear()
+                self.txtStdout.setText(self.tr(
+                    'Java {version} found at {path} is too old, Java {required} or newer is required. Please <a href="https://java.com/en/download/">install a newer Java</a> and or <a href="#configure">configure a custom java path</a>.').format(
+                    version=e.version, path=e.java_path, required=MIN_JAVA_VERSION))
+                self.enable()
+                self.progress_bar.hide()
+                return
             except JavaNotFoundError:
                 self.txtStdout.setTextColor(QColor('#000000'))
                 self.txtStdout.clear()
@@ -219,23 +252,65 @@ class ImportDataDialog(QDialog, DIALOG_UI):
             self.buttonBox.addButton(QDialogButtonBox.Close)
             self.progress_bar.setValue(100)
 
+    def run_batch_import(self, configuration, tool_name, xtffiles):
+        """
+        Imports several transfer files at once and reports the result of each
+        of them. Returns ``True`` if all of them were imported.
+        """
+        batchImporter = iliimporter.BatchImporter()
+        batchImporter.tool_name = tool_name
+        batchImporter.configuration = configuration
+        for xtffile in xtffiles:
+            # Each delivery gets its own dataset if the schema has baskets
+            dataset = os.path.splitext(os.path.basename(xtffile))[0] if configuration.create_basket_col else ''
+            batchImporter.add_file(xtffile, dataset)
+
+        batchImporter.stdout.connect(self.print_info)
+        batchImporter.stderr.connect(self.on_stderr)
+        batchImporter.file_finished.connect(
+            lambda xtffile, result, seconds: self.progress_bar.setValue(
+                self.progress_bar.value() + 75 // len(xtffiles)))
+
+        results = batchImporter.run()
+        if results is None:
+            return False
+
+        failed = 0
+        for batch_result in results:
+            success = batch_result.result == iliimporter.Importer.SUCCESS
+            failed += 0 if success else 1
+            self.print_info(self.tr('{file}: {state} ({seconds:.1f} s)').format(
+                file=batch_result.xtffile, state=self.tr('imported') if success else self.tr('failed'),
+                seconds=batch_result.seconds), '#004905' if success else '#aa2222')
+        self.print_info(self.tr('Imported {imported} of {total} files').format(
+            imported=len(results) - failed, total=len(results)))
+        return failed == 0
+
+    def on_job_finished(self, result):
+        if result != iliimporter.Importer.SUCCESS:
+            self.progress_bar.hide()
+        else:
+            self.progress_bar.setValue(100)
+        self.job = None
+
+    def reject(self):
+        if self.job:
+            self.job.cancel()
+        QDialog.reject(self)
+
     def print_info(self, text, text_color='#000000'):
         self.txtStdout.setTextColor(QColor(text_color))
         self.txtStdout.append(text)
-        QCoreApplication.processEvents()
 
     def on_stderr(self, text):
         self.txtStdout.setTextColor(QColor('#2a2a2a'))
         self.txtStdout.append(text)
-        self.advance_progress_bar_by_text(text)
-        QCoreApplication.processEvents()
 
     def on_process_started(self, command):
         self.disable()
         self.txtStdout.setTextColor(QColor('#000000'))
         self.txtStdout.clear()
         self.txtStdout.setText(command)
-        QCoreApplication.processEvents()
 
     def on_process_finished(self, exit_code, result):
         color = '#004905' if exit_code == 0 else '#aa2222'
@@ -268,6 +343,7 @@ class ImportDataDialog(QDialog, DIALOG_UI):
 
         configuration.xtffile = self.xtf_file_line_edit.text().strip()
         configuration.delete_data = self.chk_delete_data.isChecked()
+        configuration.defer_indexes = self.chk_defer_indexes.isChecked()
         configuration.ilimodels = self.ili_models_line_edit.text().strip()
         configuration.inheritance = self.ili2db_options.inheritance_type()
         configuration.create_basket_col = self.ili2db_options.create_basket_col()
@@ -276,6 +352,7 @@ class ImportDataDialog(QDialog, DIALOG_UI):
         return configuration
 
     def save_configuration(self, configuration):
+        self.ilicache.mark_models_used(configuration.ilimodels)
         settings = QSettings()
         settings.setValue(
             'QgsProjectGenerator/ili2pg/xtffile_import', configuration.xtffile)
@@ -298,6 +375,8 @@ class ImportDataDialog(QDialog, DIALOG_UI):
                               configuration.dbschema)
             settings.setValue('QgsProjectGenerator/ili2pg/password',
                               configuration.dbpwd)
+            settings.setValue('QgsProjectGenerator/ili2pg/deferIndexes',
+                              configuration.defer_indexes)
         elif self.type_combo_box.currentData() in ['ili2gpkg', 'gpkg']:
             settings.setValue('QgsProjectGenerator/ili2gpkg/dbfile',
                               configuration.dbfile)
@@ -322,6 +401,8 @@ class ImportDataDialog(QDialog, DIALOG_UI):
             'QgsProjectGenerator/ili2pg/schema'))
         self.pg_password_line_edit.setText(settings.value(
             'QgsProjectGenerator/ili2pg/password'))
+        self.chk_defer_indexes.setChecked(settings.value(
+            'QgsProjectGenerator/ili2pg/deferIndexes', False, bool))
         self.gpkg_file_line_edit.setText(settings.value(
             'QgsProjectGenerator/ili2gpkg/dbfile'))
 
@@ -361,8 +442,10 @@ class ImportDataDialog(QDialog, DIALOG_UI):
             QDesktopServices.openUrl(link)
 
     def update_models_completer(self):
-        completer = QCompleter(self.ilicache.model_names)
-        completer.setCaseSensitivity(Qt.CaseInsensitive)
+        completer = SearchCompleter(self)
+        completer_model = IliModelCompleterModel(self.ilicache, completer)
+        completer_model.set_ili_file(self.ilifile)
+        completer.setModel(completer_model)
         self.ili_models_line_edit.setCompleter(completer)
         self.multiple_models_dialog.models_line_edit.setCompleter(completer)
 
@@ -386,9 +469,3 @@ class ImportDataDialog(QDialog, DIALOG_UI):
         else:
             webbrowser.open(
                 "https://opengisch.github.io/projectgenerator/docs/user-guide.html#import-an-interlis-transfer-file-xtf")
-
-    def advance_progress_bar_by_text(self, text):
-        if text.strip() == 'Info: compile models…':
-            self.progress_bar.setValue(50)
-        elif text.strip() == 'Info: create table structure…':
-            self.progress_bar.setValue(75)
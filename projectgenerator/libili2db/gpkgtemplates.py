@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                              -------------------
+        begin                : 18/10/26
+        git sha              : :%H$
+        copyright            : (C) 2026 by OPENGIS.ch
+        email                : info@opengis.ch
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import uuid
+
+from projectgenerator.libili2db.ili2dbutils import clone_file
+
+
+class GpkgTemplateStore(object):
+    """
+    Empty GeoPackages right after an ili2gpkg schema import, stored by the
+    fingerprint of the schema import. New GeoPackages for the same models and
+    options are copies of a template. The templates used the longest time ago
+    are removed once the store grows beyond ``max_size`` bytes.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def template_path(self, fingerprint):
+        return os.path.join(self.path, '{}.gpkg'.format(fingerprint))
+
+    def copy_to(self, fingerprint, target):
+        """
+        Creates ``target`` from the template with ``fingerprint`` and returns
+        whether there was one.
+        """
+        template = self.template_path(fingerprint)
+        if not os.path.isfile(template):
+            return False
+
+        part = '{}.{}.part'.format(target, uuid.uuid4().hex)
+        try:
+            clone_file(template, part)
+            os.replace(part, target)
+        except OSError:
+            if os.path.exists(part):
+                os.remove(part)
+            return False
+
+        # Marks the template as recently used
+        try:
+            os.utime(template)
+        except OSError:
+            pass
+        return True
+
+    def add(self, fingerprint, source):
+        """
+        Stores a copy of the GeoPackage ``source`` as template for
+        ``fingerprint``.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        template = self.template_path(fingerprint)
+        part = '{}.{}.part'.format(template, uuid.uuid4().hex)
+        try:
+            clone_file(source, part)
+            os.replace(part, template)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+        self.prune()
+
+    def prune(self):
+        """
+        Removes the least recently used templates until the store fits into
+        ``max_size``.
+        """
+        templates = list()
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith('.gpkg'):
+                stat = entry.stat()
+                templates.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(template[1] for template in templates)
+        for mtime, template_size, path in sorted(templates):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                size -= template_size
+            except OSError:
+                pass
@@ -18,11 +18,16 @@
  ***************************************************************************/
 """
 
-from projectgenerator.libili2db.ili2dbutils import get_all_modeldir_in_path
+from projectgenerator.libili2db.ili2dbutils import get_all_modeldir_in_path, get_jvm_profile_args, file_digest
+from projectgenerator.libqgsprojectgen.generator.config import TEMPLATE_SCHEMA_PREFIX
 from qgis.PyQt.QtNetwork import QNetworkProxy
 from qgis.core import QgsNetworkAccessManager
 import os
+import shlex
+import hashlib
 
+# The 'sha256' of a tool's zip file is verified before it is installed, tools
+# without one are installed with a warning and only checked for transfer errors
 ili2db_tools = {
     'ili2pg': {
         'version': '3.11.2'
@@ -37,6 +42,9 @@ ili2db_tools['ili2gpkg'][
     'url'] = 'http://www.eisenhutinformatik.ch/interlis/ili2gpkg/ili2gpkg-{}.zip'.format(
     ili2db_tools['ili2gpkg']['version'])
 
+# The oldest Java major version ili2db is run with
+MIN_JAVA_VERSION = 8
+
 
 class BaseConfiguration(object):
 
@@ -45,6 +53,36 @@ class BaseConfiguration(object):
         self.custom_model_directories = ''
         self.java_path = ''
         self.logfile_path = ''
+        # Seconds during which downloaded repository indexes are used without
+        # asking the server for a newer version
+        self.repository_cache_ttl = 300
+        # Model files of repositories are mirrored by IliCache to this
+        # directory, which is passed to ili2db before all other model directories
+        self.mirror_models_enabled = True
+        self.model_mirror_path = os.path.join(os.path.expanduser('~'), '.ilicache', 'mirror')
+        # Only pass the model directories which contain the models of a
+        # command and their dependencies to ili2db
+        self.minimal_model_directories_enabled = False
+        # Run ili2db in a resident Java process (Java 11 or newer) instead of
+        # starting a new one for every invocation
+        self.jvm_worker_enabled = False
+        # Create a class data sharing archive of ili2db on the first run and
+        # use it later on to reduce the JVM startup time (Java 13 or newer)
+        self.class_data_sharing_enabled = True
+        # JVM options for ili2db, e.g. "-Xmx4g -XX:+UseParallelGC". If empty and
+        # jvm_auto_options_enabled is set, heap size and garbage collector are
+        # derived from the size of the transfer file and the physical memory
+        self.jvm_options = ''
+        self.jvm_auto_options_enabled = True
+        # Keep empty GeoPackages after ili2gpkg schema imports and copy them
+        # for new GeoPackages with the same models and options. The least
+        # recently used ones are removed beyond the cache size in MB
+        self.gpkg_templates_enabled = True
+        self.gpkg_template_path = os.path.join(os.path.expanduser('~'), '.ilicache', 'gpkg_templates')
+        self.gpkg_template_cache_size = 256
+        # Number of PostgreSQL template schemas kept per database, the least
+        # recently used ones are dropped when a new one is set up
+        self.pg_template_schema_count = 10
 
         self.debugging_enabled = False
 
@@ -56,6 +94,16 @@ class BaseConfiguration(object):
         settings.setValue('JavaPath', self.java_path)
         settings.setValue('LogfilePath', self.logfile_path)
         settings.setValue('DebuggingEnabled', self.debugging_enabled)
+        settings.setValue('RepositoryCacheTTL', self.repository_cache_ttl)
+        settings.setValue('MirrorModelsEnabled', self.mirror_models_enabled)
+        settings.setValue('MinimalModelDirectoriesEnabled', self.minimal_model_directories_enabled)
+        settings.setValue('JvmWorkerEnabled', self.jvm_worker_enabled)
+        settings.setValue('ClassDataSharingEnabled', self.class_data_sharing_enabled)
+        settings.setValue('JvmOptions', self.jvm_options)
+        settings.setValue('JvmAutoOptionsEnabled', self.jvm_auto_options_enabled)
+        settings.setValue('GpkgTemplatesEnabled', self.gpkg_templates_enabled)
+        settings.setValue('GpkgTemplateCacheSize', self.gpkg_template_cache_size)
+        settings.setValue('PgTemplateSchemaCount', self.pg_template_schema_count)
 
     def restore(self, settings):
         self.custom_model_directories_enabled = settings.value(
@@ -66,24 +114,79 @@ class BaseConfiguration(object):
         self.debugging_enabled = settings.value(
             'DebuggingEnabled', False, bool)
         self.logfile_path = settings.value('LogfilePath', '', str)
-
-    def to_ili2db_args(self, with_modeldir=True):
+        self.repository_cache_ttl = settings.value(
+            'RepositoryCacheTTL', 300, int)
+        self.mirror_models_enabled = settings.value(
+            'MirrorModelsEnabled', True, bool)
+        self.minimal_model_directories_enabled = settings.value(
+            'MinimalModelDirectoriesEnabled', False, bool)
+        self.jvm_worker_enabled = settings.value(
+            'JvmWorkerEnabled', False, bool)
+        self.class_data_sharing_enabled = settings.value(
+            'ClassDataSharingEnabled', True, bool)
+        self.jvm_options = settings.value('JvmOptions', '', str)
+        self.jvm_auto_options_enabled = settings.value(
+            'JvmAutoOptionsEnabled', True, bool)
+        self.gpkg_templates_enabled = settings.value(
+            'GpkgTemplatesEnabled', True, bool)
+        self.gpkg_template_cache_size = settings.value(
+            'GpkgTemplateCacheSize', 256, int)
+        self.pg_template_schema_count = settings.value(
+            'PgTemplateSchemaCount', 10, int)
+
+    def to_ili2db_args(self, with_modeldir=True, model_directories=None):
         """
-        Create an ili2db command line argument string from this configuration
+        Create an ili2db command line argument string from this configuration.
+        If ``model_directories`` are provided, they are passed as ``--modeldir``
+        instead of the configured model directories.
         """
         args = list()
 
-        if with_modeldir:
+        if with_modeldir and model_directories:
+            args += ['--modeldir', ';'.join(model_directories)]
+        elif with_modeldir:
+            mirror_enabled = self.mirror_models_enabled and os.path.isdir(self.model_mirror_path)
+            str_model_directories = list()
             if self.custom_model_directories_enabled and self.custom_model_directories:
-                str_model_directories = [get_all_modeldir_in_path(path) for path in
-                                         self.custom_model_directories.split(';')]
-                str_model_directories = ';'.join(str_model_directories)
-                args += ['--modeldir', str_model_directories]
+                for path in self.custom_model_directories.split(';'):
+                    if '://' in path or path.startswith('%'):
+                        str_model_directories.append(path)
+                    else:
+                        str_model_directories += [directory for directory in
+                                                  get_all_modeldir_in_path(path).split(';') if directory]
+            elif mirror_enabled:
+                # The default model directories of ili2db around the mirror
+                str_model_directories += self.model_directories
+            if mirror_enabled:
+                # Local model directories take precedence over the mirrored
+                # repository models, which are searched before the repositories
+                repository_index = next((index for index, directory in enumerate(str_model_directories)
+                                         if '://' in directory), len(str_model_directories))
+                str_model_directories.insert(repository_index, self.model_mirror_path)
+            if str_model_directories:
+                args += ['--modeldir', ';'.join(str_model_directories)]
         if self.debugging_enabled and self.logfile_path:
             args += ['--trace']
             args += ['--log', self.logfile_path]
         return args
 
+    def to_jvm_args(self, input_size=0, process_count=1):
+        """
+        Create the JVM arguments for an ili2db process which reads
+        ``input_size`` bytes of transfer data while ``process_count``
+        ili2db processes run at the same time
+        """
+        if self.jvm_options.strip():
+            # Quoted options may contain spaces, backslashes are kept for
+            # Windows paths
+            lexer = shlex.shlex(self.jvm_options, posix=True)
+            lexer.whitespace_split = True
+            lexer.escape = ''
+            return list(lexer)
+        if self.jvm_auto_options_enabled:
+            return get_jvm_profile_args(input_size, process_count)
+        return list()
+
     @property
     def model_directories(self):
         dirs = list()
@@ -114,6 +217,9 @@ class Ili2DbCommandConfiguration(object):
         self.ilifile = ''
         self.ilimodels = ''
         self.tomlfile = ''
+        # Model directories which contain all models required by this command,
+        # overriding the model directories of the base configuration
+        self.required_model_directories = None
 
     @property
     def uri(self):
@@ -130,12 +236,16 @@ class Ili2DbCommandConfiguration(object):
             uri = [self.dbfile]
         return ' '.join(uri)
 
+    def to_jvm_args(self):
+        return self.base_configuration.to_jvm_args()
+
     def to_ili2db_args(self, hide_password=False):
 
         # Valid ili file, don't pass --modeldir (it can cause ili2db errors)
         with_modeldir = not self.ilifile
 
-        args = self.base_configuration.to_ili2db_args(with_modeldir=with_modeldir)
+        args = self.base_configuration.to_ili2db_args(with_modeldir=with_modeldir,
+                                                      model_directories=self.required_model_directories)
 
         if self.tool_name == 'ili2pg':
             # PostgreSQL specific options
@@ -176,6 +286,12 @@ class ExportConfiguration(Ili2DbCommandConfiguration):
     def __init__(self):
         super().__init__()
         self.xtffile = ''
+        # Only export this dataset or these baskets (transfer ids separated by ;)
+        self.dataset = ''
+        self.baskets = ''
+        # SQL files run by ili2db before and after exporting
+        self.pre_script = ''
+        self.post_script = ''
 
     def to_ili2db_args(self, hide_password=False, with_action=True):
         args = list()
@@ -183,6 +299,17 @@ class ExportConfiguration(Ili2DbCommandConfiguration):
         if with_action:
             args += ["--export"]
 
+        if self.baskets:
+            args += ["--baskets", self.baskets]
+        elif self.dataset:
+            args += ["--dataset", self.dataset]
+
+        if self.pre_script:
+            args += ["--preScript", self.pre_script]
+
+        if self.post_script:
+            args += ["--postScript", self.post_script]
+
         args += Ili2DbCommandConfiguration.to_ili2db_args(self, hide_password=hide_password)
 
         args += [self.xtffile]
@@ -197,17 +324,35 @@ class SchemaImportConfiguration(Ili2DbCommandConfiguration):
         self.inheritance = 'smart1'
         self.create_basket_col = False
         self.epsg = 21781  # Default EPSG code in ili2pg
-
-    def to_ili2db_args(self, hide_password=False, with_action=True):
+        # On PostgreSQL, run ili2db once into a template schema for these
+        # models and options and clone new schemas from it
+        self.use_template_schema = False
+        # "name version md5" of the models and all models they import as
+        # resolved by the IliCache, None if unknown
+        self.model_versions = None
+        # Run ili2db even if the schema or a template matches the fingerprint
+        self.force_schema_import = False
+
+    def to_ili2db_args(self, hide_password=False, with_action=True, with_indexes=True):
         """
         Create an ili2db argument array, with the password masked with ****** and optionally with the ``action``
-        argument (--schemaimport) removed
+        argument (--schemaimport) and the creation of geometry indexes and foreign keys removed
         """
         args = list()
 
         if with_action:
             args += ["--schemaimport"]
 
+        args += self.to_schema_args(with_indexes)
+        args += Ili2DbCommandConfiguration.to_ili2db_args(self, hide_password)
+
+        return args
+
+    def to_schema_args(self, with_indexes=True):
+        """
+        The ili2db arguments which define how the models are mapped to tables
+        """
+        args = list()
         args += ["--coalesceCatalogueRef"]
         args += ["--createEnumTabs"]
         args += ["--createNumChecks"]
@@ -218,9 +363,10 @@ class SchemaImportConfiguration(Ili2DbCommandConfiguration):
         args += ["--strokeArcs"]
         args += ["--beautifyEnumDispName"]
         args += ["--createUnique"]
-        args += ["--createGeomIdx"]
-        args += ["--createFk"]
-        args += ["--createFkIdx"]
+        if with_indexes:
+            args += ["--createGeomIdx"]
+            args += ["--createFk"]
+            args += ["--createFkIdx"]
         args += ["--createMetaInfo"]
         args += ["--importTid"]
 
@@ -240,19 +386,57 @@ class SchemaImportConfiguration(Ili2DbCommandConfiguration):
         if self.tool_name == 'ili2pg':
             args += ["--setupPgExt"]
 
-        args += Ili2DbCommandConfiguration.to_ili2db_args(self, hide_password)
-
         return args
 
+    def schema_fingerprint(self):
+        """
+        A hash over everything which ends up in the schema: the ili2db version,
+        the mapping arguments, the models with their resolved versions and the
+        content of the ili and toml files. Connection parameters and model
+        directories are not part of it.
+        """
+        fingerprint = hashlib.sha256()
+        parts = [self.tool_name, ili2db_tools.get(self.tool_name, {}).get('version', '')]
+        parts += self.to_schema_args()
+        parts += [self.ilimodels, file_digest(self.ilifile), file_digest(self.tomlfile)]
+        parts += self.model_versions or list()
+        fingerprint.update('\n'.join(parts).encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def can_reuse_schema(self):
+        """
+        Whether a schema or template with the same fingerprint may be used
+        instead of running the schema import. Without the resolved model
+        versions, a new version of a model would keep the fingerprint.
+        """
+        return self.model_versions is not None and not self.force_schema_import
+
+    @property
+    def template_schema(self):
+        return TEMPLATE_SCHEMA_PREFIX + self.schema_fingerprint()[:16]
+
 
 class ImportDataConfiguration(SchemaImportConfiguration):
 
     def __init__(self):
         super().__init__()
         self.xtffile = ''
+        self.dataset = ''
         self.delete_data = False
-
-    def to_ili2db_args(self, hide_password=False, with_action=True):
+        # On PostgreSQL, drop the indexes and foreign keys of the data tables
+        # during the import and rebuild them afterwards
+        self.defer_indexes = False
+        # Number of imports running at the same time and sharing the memory
+        self.process_count = 1
+
+    def to_jvm_args(self):
+        try:
+            input_size = os.path.getsize(self.xtffile)
+        except OSError:
+            input_size = 0
+        return self.base_configuration.to_jvm_args(input_size, self.process_count)
+
+    def to_ili2db_args(self, hide_password=False, with_action=True, with_indexes=True):
         args = list()
 
         if with_action:
@@ -261,10 +445,22 @@ class ImportDataConfiguration(SchemaImportConfiguration):
         if self.delete_data:
             args += ["--deleteData"]
 
-        args += SchemaImportConfiguration.to_ili2db_args(self, hide_password=hide_password, with_action=False)
+        if self.dataset:
+            args += ["--dataset", self.dataset]
+
+        args += SchemaImportConfiguration.to_ili2db_args(self, hide_password=hide_password, with_action=False,
+                                                         with_indexes=with_indexes)
 
         return args
 
 
 class JavaNotFoundError(FileNotFoundError):
     pass
+
+
+class JavaVersionError(JavaNotFoundError):
+
+    def __init__(self, java_path, version):
+        super().__init__(java_path, version)
+        self.java_path = java_path
+        self.version = version
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                              -------------------
+        begin                : 18/10/26
+        git sha              : :%H$
+        copyright            : (C) 2026 by OPENGIS.ch
+        email                : info@opengis.ch
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import codecs
+import collections
+import re
+import time
+
+PHASE_STARTED = 'phase_started'
+PHASE_FINISHED = 'phase_finished'
+OBJECT_COUNT = 'object_count'
+WARNING = 'warning'
+ERROR = 'error'
+DONE = 'done'
+MESSAGE = 'message'
+
+# ``phase`` is set for phase events, ``count`` and ``name`` (the class) for object
+# counts, ``action`` (import, export or None) for done events and ``duration``
+# in seconds for finished phases
+Ili2dbEvent = collections.namedtuple('Ili2dbEvent', ['kind', 'text', 'timestamp', 'phase', 'count', 'name',
+                                                     'action', 'duration'])
+
+# ili2db writes "..." or "…" depending on its version
+ELLIPSIS = r'(?:\.\.\.|…)'
+DONE_PATTERN = re.compile(r'^Info: ' + ELLIPSIS + r'(?:(\w+) )?done\s*$')
+PHASE_PATTERN = re.compile(r'^Info: (\w.*?)\s*' + ELLIPSIS + r'\s*$')
+OBJECT_COUNT_PATTERN = re.compile(r'^Info:\s+(\d+) objects in (?:CLASS|ASSOCIATION|STRUCTURE) (\S+)')
+
+# How far an import or export roughly is when a phase starts
+PHASE_PROGRESS = [
+    ('compile models', 20),
+    ('create table structure', 40),
+    ('process data file', 50),
+    ('first validation pass', 60),
+    ('second validation pass', 80),
+]
+
+
+def phase_progress(phase):
+    """
+    Returns the progress in percent when ``phase`` starts or ``None`` if it is
+    not known.
+    """
+    for prefix, progress in PHASE_PROGRESS:
+        if phase.startswith(prefix):
+            return progress
+    return None
+
+
+def _event(kind, text, timestamp, phase=None, count=None, name=None, action=None, duration=None):
+    return Ili2dbEvent(kind, text, timestamp, phase, count, name, action, duration)
+
+
+class Ili2dbOutputParser(object):
+    """
+    Decodes ili2db output chunk by chunk and turns every complete line into
+    an Ili2dbEvent. Multibyte characters and lines split across chunks are
+    kept until the rest arrives.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self._buffer = ''
+        self.phase = None
+        self._phase_started = None
+        # Seconds spent in every phase in the order they ran
+        self.phase_durations = collections.OrderedDict()
+        self.done_action = None
+        self.done = False
+
+    def feed(self, data):
+        """
+        Feeds ``data`` (bytes or already decoded text) and returns the complete
+        lines received so far as text together with their events.
+        """
+        if isinstance(data, bytes):
+            data = self._decoder.decode(data)
+        self._buffer += data
+
+        text, separator, self._buffer = self._buffer.rpartition('\n')
+        if not separator:
+            return '', []
+        text += separator
+        return text, self._parse(text.splitlines(), time.time())
+
+    def finish(self):
+        """
+        Returns what is left after the output ended like ``feed`` and closes the
+        running phase.
+        """
+        text = self._buffer + self._decoder.decode(b'', final=True)
+        self._buffer = ''
+        timestamp = time.time()
+        events = self._parse(text.splitlines(), timestamp) if text else []
+        events += self._finish_phase(timestamp)
+        return text, events
+
+    def _parse(self, lines, timestamp):
+        events = list()
+        for line in lines:
+            line = line.rstrip('\r')
+            match = DONE_PATTERN.match(line)
+            if match:
+                events += self._finish_phase(timestamp)
+                self.done = True
+                self.done_action = match.group(1)
+                events.append(_event(DONE, line, timestamp, action=match.group(1)))
+                continue
+
+            match = OBJECT_COUNT_PATTERN.match(line)
+            if match:
+                events.append(_event(OBJECT_COUNT, line, timestamp, phase=self.phase, count=int(match.group(1)),
+                                     name=match.group(2)))
+                continue
+
+            match = PHASE_PATTERN.match(line)
+            if match:
+                events += self._finish_phase(timestamp)
+                self.phase = match.group(1)
+                self._phase_started = timestamp
+                events.append(_event(PHASE_STARTED, line, timestamp, phase=self.phase))
+                continue
+
+            if line.startswith('Error'):
+                events.append(_event(ERROR, line, timestamp, phase=self.phase))
+            elif line.startswith('Warning'):
+                events.append(_event(WARNING, line, timestamp, phase=self.phase))
+            elif line:
+                events.append(_event(MESSAGE, line, timestamp, phase=self.phase))
+        return events
+
+    def _finish_phase(self, timestamp):
+        if self.phase is None:
+            return []
+        duration = timestamp - self._phase_started
+        self.phase_durations[self.phase] = self.phase_durations.get(self.phase, 0) + duration
+        event = _event(PHASE_FINISHED, '', timestamp, phase=self.phase, duration=duration)
+        self.phase = None
+        return [event]
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                              -------------------
+        begin                : 18/10/26
+        git sha              : :%H$
+        copyright            : (C) 2026 by OPENGIS.ch
+        email                : info@opengis.ch
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.PyQt.QtCore import QObject, pyqtSignal, QEventLoop, QTimer
+
+from projectgenerator.libili2db import ili2dbevents
+from projectgenerator.libili2db.ili2dbconfig import ili2db_tools
+from projectgenerator.libili2db.ili2dbutils import get_ili2db_bin
+from projectgenerator.libili2db.javaruntime import get_java_runtime
+
+
+class Ili2dbJob(QObject):
+    """
+    Runs an Importer or Exporter without blocking.
+
+    ``start()`` returns as soon as the first step of the runner is started.
+    The job reports its progress and emits ``finished`` with the result of
+    the runner once all its steps ended or it was canceled. Steps like
+    template schemas or deferred indexes are chained by signals and their
+    database work runs in background tasks, so any number of jobs can run at
+    the same time.
+    """
+
+    progress_changed = pyqtSignal(int)
+    finished = pyqtSignal(int)
+
+    def __init__(self, runner, parent=None):
+        QObject.__init__(self, parent)
+        self.runner = runner
+        self.progress = 0
+        self.result = None
+        self.exit_code = None
+        self.canceled = False
+        self._started = False
+        self._starting = False
+        runner.progress_event.connect(self._progress_event)
+        runner.process_finished.connect(self._process_finished)
+        runner.run_finished.connect(self._finish)
+
+    @property
+    def running(self):
+        return self._started and self.result is None
+
+    def start(self):
+        """
+        Starts ili2db and returns ``False`` if ili2db is not available.
+
+        Raises a JavaNotFoundError if Java is missing or too old.
+        """
+        ili2db_bin = get_ili2db_bin(self.runner.tool_name, self.runner.stdout, self.runner.stderr, ili2db_tools)
+        if not ili2db_bin:
+            return False
+
+        java_path = get_java_runtime(self.runner.configuration.base_configuration.java_path).path
+        self._started = True
+        self._set_progress(10)
+        self._starting = True
+        try:
+            self.runner.start_run(ili2db_bin, java_path)
+        finally:
+            self._starting = False
+        return True
+
+    def cancel(self):
+        """
+        Ends ili2db, the job finishes with an error result.
+        """
+        if self.running:
+            self.canceled = True
+            self.runner.cancel()
+
+    def wait(self):
+        """
+        Blocks until the job is finished and returns its result. Meant for
+        scripts without a running event loop.
+        """
+        if self.running:
+            loop = QEventLoop()
+            self.finished.connect(loop.quit)
+            loop.exec()
+        return self.result
+
+    def _progress_event(self, event):
+        if event.kind == ili2dbevents.PHASE_STARTED:
+            progress = ili2dbevents.phase_progress(event.phase)
+            if progress:
+                self._set_progress(progress)
+
+    def _process_finished(self, exit_code, result):
+        # A run may start more than one process, it finishes with run_finished
+        self.exit_code = exit_code
+
+    def _finish(self, result):
+        self.result = self.runner.ERROR if self.canceled else result
+        if self.result == self.runner.SUCCESS:
+            self._set_progress(100)
+        if self._starting:
+            # Finished right away, e.g. from a template, callers hear of it once start() returned
+            QTimer.singleShot(0, lambda: self.finished.emit(self.result))
+        else:
+            self.finished.emit(self.result)
+
+    def _set_progress(self, progress):
+        if progress > self.progress:
+            self.progress = progress
+            self.progress_changed.emit(progress)
@@ -17,73 +17,514 @@
  *                                                                         *
  ***************************************************************************/
 """
+import ctypes
+import functools
+import hashlib
+import mmap
 import os
+import re
+import shutil
+import sys
 import tempfile
+import time
+import uuid
 import zipfile
-import glob
 
-from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import QgsApplication, QgsTask
+from qgis.PyQt.QtCore import QCoreApplication, QLockFile, QEventLoop, QProcess, QTimer
 
-from projectgenerator.utils.qt_utils import download_file, NetworkError
+from projectgenerator.utils.qt_utils import download_file_resumable, NetworkError
+
+
+# Versioned ili2db installations, shared by all QGIS profiles of the user
+ILI2DB_TOOLS_DIR = os.path.join(os.path.expanduser('~'), '.ilicache', 'tools')
+# Milliseconds to wait for another process installing the same ili2db version
+ILI2DB_INSTALL_LOCK_TIMEOUT = 5 * 60 * 1000
 
 
 def get_ili2db_bin(tool_name, stdout, stderr, ili2db_tools):
     if not tool_name:
         return
-    dir_path = os.path.dirname(os.path.realpath(__file__))
     ili2db_dir = '{}-{}'.format(tool_name, ili2db_tools[tool_name]['version'])
+    jar_name = '{}.jar'.format(tool_name)
+
+    # Installed into the plugin directory by earlier versions
+    plugin_ili2db_file = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'bin', ili2db_dir, jar_name)
+    if os.path.isfile(plugin_ili2db_file):
+        return plugin_ili2db_file
+
+    ili2db_file = os.path.join(ILI2DB_TOOLS_DIR, ili2db_dir, jar_name)
+    if os.path.isfile(ili2db_file):
+        return ili2db_file
+
+    os.makedirs(ILI2DB_TOOLS_DIR, exist_ok=True)
+    # Other QGIS instances or workers may install the same version at the same time
+    lock = QLockFile(os.path.join(ILI2DB_TOOLS_DIR, '{}.lock'.format(ili2db_dir)))
+    lock.setStaleLockTime(15 * 60 * 1000)
+    if not lock.tryLock(100):
+        stdout.emit(QCoreApplication.translate('ili2dbutils', 'Waiting for {} to be installed by another process…'.format(
+            ili2db_dir)))
+        if not lock.tryLock(ILI2DB_INSTALL_LOCK_TIMEOUT):
+            stderr.emit(QCoreApplication.translate('ili2dbutils',
+                                                   'Gave up waiting for {} to be installed by another process.'.format(
+                                                       ili2db_dir)))
+            return None
+
+    try:
+        if not os.path.isfile(ili2db_file) and not _install_ili2db(tool_name, ili2db_dir, stdout, stderr, ili2db_tools):
+            return None
+    finally:
+        lock.unlock()
 
-    ili2db_file = os.path.join(
-        dir_path, 'bin', ili2db_dir, '{}.jar'.format(tool_name))
     if not os.path.isfile(ili2db_file):
-        try:
-            os.mkdir(os.path.join(dir_path, 'bin'))
-        except FileExistsError:
-            pass
+        stderr.emit(
+            QCoreApplication.translate('ili2dbutils',
+                                       'File "{file}" not found. Please download and extract <a href="{ili2db_url}">{ili2db_url}</a>.'.format(
+                                           file=ili2db_file,
+                                           ili2db_url=ili2db_tools[tool_name]['url'])))
+        return None
+
+    return ili2db_file
 
-        tmpfile = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
 
-        stdout.emit(QCoreApplication.translate('ili2dbutils', 'Downloading {} version {}…'.format(
-            tool_name, ili2db_tools[tool_name]['version'])))
+def _install_ili2db(tool_name, ili2db_dir, stdout, stderr, ili2db_tools):
+    """
+    Downloads and extracts ``ili2db_dir`` to the tools directory, the caller
+    needs to hold the lock of the tool.
+    """
+    zip_file = os.path.join(ILI2DB_TOOLS_DIR, '{}.zip'.format(ili2db_dir))
+    url = ili2db_tools[tool_name]['url']
 
-        try:
-            download_file(ili2db_tools[tool_name][
-                          'url'], tmpfile.name, on_progress=lambda received, total: stdout.emit('.'))
-        except NetworkError as e:
+    stdout.emit(QCoreApplication.translate('ili2dbutils', 'Downloading {} version {}…'.format(
+        tool_name, ili2db_tools[tool_name]['version'])))
+
+    try:
+        if not os.path.isfile(zip_file):
+            download_file_resumable(url, zip_file, on_progress=lambda received, total: stdout.emit('.'))
+    except NetworkError as e:
+        stderr.emit(
+            QCoreApplication.translate('ili2dbutils',
+                                       'Could not download {tool_name}\n\n  Error: {error}\n\nFile "{file}" not found. Please download and extract <a href="{ili2db_url}">{ili2db_url}</a>'.format(
+                                           tool_name=tool_name,
+                                           ili2db_url=url,
+                                           error=e.msg,
+                                           file=os.path.join(ILI2DB_TOOLS_DIR, ili2db_dir))
+                                       )
+        )
+        return False
+
+    expected_sha256 = ili2db_tools[tool_name].get('sha256')
+    if expected_sha256:
+        if file_digest(zip_file) != expected_sha256.lower():
+            os.remove(zip_file)
             stderr.emit(
                 QCoreApplication.translate('ili2dbutils',
-                                           'Could not download {tool_name}\n\n  Error: {error}\n\nFile "{file}" not found. Please download and extract <a href="{ili2db_url}">{ili2db_url}</a>'.format(
-                                               ili2db_url=ili2db_tools[
-                                                   tool_name]['version'],
-                                               error=e.msg,
-                                               file=ili2db_file)
-                                           )
-            )
+                                           'The checksum of the downloaded file {url} does not match, it has not been installed.'.format(
+                                               url=url)))
+            return False
+    else:
+        stderr.emit(
+            QCoreApplication.translate('ili2dbutils',
+                                       'Warning: There is no checksum for {url}, the download is only checked for transfer errors.'.format(
+                                           url=url)))
+
+    # Transfer errors, e.g. of a resumed download, show up as CRC mismatches
+    try:
+        with zipfile.ZipFile(zip_file, "r") as z:
+            damaged = z.testzip() is not None
+    except (zipfile.BadZipFile, OSError):
+        damaged = True
+    if damaged:
+        os.remove(zip_file)
+        stderr.emit(
+            QCoreApplication.translate('ili2dbutils',
+                                       'The downloaded file {url} is damaged, it has not been installed.'.format(
+                                           url=url)))
+        return False
+
+    # Extract next to the final location and move it in place at once, so an
+    # interrupted extraction never leaves an incomplete installation behind
+    extract_dir = tempfile.mkdtemp(prefix='.{}-'.format(ili2db_dir), dir=ILI2DB_TOOLS_DIR)
+    try:
+        with zipfile.ZipFile(zip_file, "r") as z:
+            z.extractall(extract_dir)
+        # Replace incomplete installations
+        shutil.rmtree(os.path.join(ILI2DB_TOOLS_DIR, ili2db_dir), ignore_errors=True)
+        os.replace(os.path.join(extract_dir, ili2db_dir), os.path.join(ILI2DB_TOOLS_DIR, ili2db_dir))
+    except (zipfile.BadZipFile, OSError):
+        # We will realize soon enough that the files were not extracted
+        pass
+    finally:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+        os.remove(zip_file)
+
+    return True
+
+
+# Transfer files smaller than this are processed fine with the JVM defaults
+JVM_PROFILE_MIN_INPUT_SIZE = 64 * 1024 * 1024
+
+
+def get_jvm_profile_args(input_size, process_count=1):
+    """
+    Returns JVM arguments with a heap size and garbage collector suitable for
+    ili2db processing ``input_size`` bytes of transfer data, or an empty list
+    if the JVM defaults are fine.
+
+    The memory is shared by ``process_count`` ili2db processes running at the
+    same time.
+    """
+    total_memory, available_memory = get_physical_memory()
+    if input_size < JVM_PROFILE_MIN_INPUT_SIZE or not total_memory:
+        return list()
+
+    megabyte = 1024 * 1024
+    process_count = max(process_count, 1)
+    # A heap of a few times the transfer size keeps the garbage collector from
+    # running constantly, but never less than the default of a quarter of the
+    # physical memory and not more than what is available
+    heap_size = min(input_size * 4 + 512 * megabyte, (available_memory or total_memory * 3 // 4) // process_count)
+    heap_size = max(heap_size, total_memory // 4 // process_count)
+    # ili2db runs as a batch process, throughput matters more than pause times
+    gc_threads = max(1, min((os.cpu_count() or 1) // process_count, 8))
+    return ['-Xmx{}m'.format(heap_size // megabyte),
+            '-XX:+UseParallelGC',
+            '-XX:ParallelGCThreads={}'.format(gc_threads)]
+
+
+def get_physical_memory():
+    """
+    Returns the total and the available physical memory in bytes, ``None``
+    for values which cannot be determined on this platform.
+    """
+    if os.name == 'nt':
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys, status.ullAvailPhys
+        return None, None
+
+    def sysconf(name):
+        try:
+            return os.sysconf(name)
+        except (ValueError, OSError, AttributeError):
             return None
 
+    page_size = sysconf('SC_PAGE_SIZE')
+    total_pages = sysconf('SC_PHYS_PAGES')
+    available_pages = sysconf('SC_AVPHYS_PAGES')
+    if not page_size or not total_pages:
+        return None, None
+    return page_size * total_pages, page_size * available_pages if available_pages else None
+
+
+def get_cds_args(java, ili2db_bin):
+    """
+    Returns the JVM arguments to use the class data sharing archive of
+    ``ili2db_bin`` for the JavaRuntime ``java`` and the path the JVM dumps a
+    new archive to, which is ``None`` if the archive already exists.
+
+    The archive is created when the JVM exits (Java 13 or newer) and needs to
+    be moved in place with ``store_cds_archive`` afterwards. Older JVMs ignore
+    the options.
+    """
+    archive_path = _cds_archive_path(java, ili2db_bin)
+    if os.path.isfile(archive_path):
+        return ['-XX:+IgnoreUnrecognizedVMOptions', '-XX:SharedArchiveFile={}'.format(archive_path)], None
+
+    # Concurrent runs must not dump into the same file
+    dump_path = '{}.{}.tmp'.format(archive_path, uuid.uuid4().hex)
+    return ['-XX:+IgnoreUnrecognizedVMOptions', '-XX:ArchiveClassesAtExit={}'.format(dump_path)], dump_path
+
+
+def store_cds_archive(dump_path, java, ili2db_bin):
+    if dump_path and os.path.isfile(dump_path):
         try:
-            with zipfile.ZipFile(tmpfile.name, "r") as z:
-                z.extractall(os.path.join(dir_path, 'bin'))
-        except zipfile.BadZipFile:
-            # We will realize soon enough that the files were not extracted
+            os.replace(dump_path, _cds_archive_path(java, ili2db_bin))
+        except OSError:
             pass
 
-        if not os.path.isfile(ili2db_file):
-            stderr.emit(
-                QCoreApplication.translate('ili2dbutils',
-                                           'File "{file}" not found. Please download and extract <a href="{ili2db_url}">{ili2db_url}</a>.'.format(
-                                               file=ili2db_file,
-                                               ili2db_url=ili2db_tools[tool_name]['version'])))
-            return None
 
-    return ili2db_file
+def _cds_archive_path(java, ili2db_bin):
+    # Archives only work with the JVM and the classes they were created with,
+    # files replaced in place by an update get a new archive
+    key = [java.path, java.version]
+    for path in (os.path.realpath(java.path), ili2db_bin):
+        try:
+            stat = os.stat(path)
+            key.append('{}:{}'.format(stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            key.append('')
+    java_hash = hashlib.md5('\n'.join(key).encode('utf-8')).hexdigest()[:8]
+    return '{}-{}.jsa'.format(os.path.splitext(ili2db_bin)[0], java_hash)
+
+
+def get_safe_command(java_path, args):
+    """
+    Returns the command line of ``java_path`` with ``args`` as shown to the
+    user, only the value of ``--dbpwd`` is masked.
+    """
+    safe_args = list(args)
+    for index, arg in enumerate(safe_args[:-1]):
+        if arg == '--dbpwd':
+            safe_args[index + 1] = '******'
+    return ' '.join([java_path] + safe_args)
+
+
+def file_digest(path):
+    """
+    The sha256 of the content of the file at ``path``, empty if there is no
+    such file.
+    """
+    if not path or not os.path.isfile(path):
+        return ''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ioctl request to share the blocks of a file on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def clone_file(source, target):
+    """
+    Copies ``source`` to ``target``. Where the file system supports it, the
+    copy shares the blocks with the source (reflink) and is created without
+    copying any data.
+    """
+    if sys.platform.startswith('linux'):
+        import fcntl
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    elif sys.platform == 'darwin':
+        if os.path.exists(target):
+            os.remove(target)
+        libc = ctypes.CDLL(None, use_errno=True)
+        if hasattr(libc, 'clonefile') and libc.clonefile(os.fsencode(source), os.fsencode(target), 0) == 0:
+            return
+
+    shutil.copyfile(source, target)
+
 
 def get_all_modeldir_in_path(path, lambdafunction=None):
-    all_subdirs = [path[0] for path in os.walk(path)] # include path
-    modeldir = ''
-    for subdir in all_subdirs:
-        if os.path.isdir(subdir) and '/.' not in subdir and len(glob.glob(subdir + '/*.ili')) > 0:
-            if lambdafunction is not None:
-                lambdafunction(subdir)
-            modeldir += subdir + ';'
-    return modeldir[:-1]  # remove last ';'
+    modeldirs = list()
+    for subdir, ilifiles in get_model_directories(path):
+        if lambdafunction is not None:
+            lambdafunction(subdir)
+        modeldirs.append(subdir)
+    return ';'.join(modeldirs)
+
+
+# Model directories of already walked paths, mapped to the modification
+# times of all directories in the walked tree
+_model_directories_cache = dict()
+
+
+def get_model_directories(path):
+    """
+    Returns a list of ``(directory, ili_files)`` tuples for ``path`` and all
+    its subdirectories which contain .ili files. Hidden directories are not
+    entered.
+
+    The tree is walked once with ``os.scandir`` and the result is reused as
+    long as none of its directories has been modified, which only needs a
+    ``stat`` per directory.
+    """
+    cached = _model_directories_cache.get(path)
+    if cached is not None and _directories_unchanged(cached[0]):
+        return cached[1]
+
+    mtimes = dict()
+    model_directories = list()
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        try:
+            # Read the mtime first, a modification during the walk is detected next time
+            mtimes[directory] = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        ilifiles = list()
+        subdirs = list()
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith('.ili') and entry.is_file():
+                    ilifiles.append(entry.path)
+            except OSError:
+                pass
+        if ilifiles:
+            model_directories.append((directory, ilifiles))
+        # Walk top-down in name order like os.walk
+        pending.extend(reversed(subdirs))
+
+    _model_directories_cache[path] = (mtimes, model_directories)
+    return model_directories
+
+
+def _directories_unchanged(mtimes):
+    try:
+        return all(os.stat(directory).st_mtime_ns == mtime for directory, mtime in mtimes.items())
+    except OSError:
+        return False
+
+
+def run_task(description, function, on_finished, *args):
+    """
+    Runs ``function(*args)`` in a background task and returns the task, which
+    needs to be kept until it is finished. ``on_finished(exception, result)``
+    is called in the main thread once it ended.
+    """
+    def finished(exception, result=None):
+        on_finished(exception, result)
+
+    task = QgsTask.fromFunction(description, lambda task, *args: function(*args), *args,
+                                on_finished=finished)
+    QgsApplication.taskManager().addTask(task)
+    return task
+
+
+def run_ili2db_pool(runners, ili2db_bin, java_path, process_count, first_alone=False, on_started=None,
+                    on_finished=None):
+    """
+    Runs importers or exporters with at most ``process_count`` ili2db processes
+    at the same time and returns ``(exit_code, result, seconds)`` for each of
+    them in the same order.
+
+    With ``first_alone`` the first runner is finished before the others are
+    started. ``on_started(index)`` and ``on_finished(index, exit_code, result,
+    seconds)`` are called for every runner. A runner which cannot be started
+    counts as failed with exit code -1.
+    """
+    pending = list(enumerate(runners))
+    running = set()
+    results = dict()
+    loop = QEventLoop()
+
+    def limit():
+        return 1 if first_alone and not results else max(process_count, 1)
+
+    def start_next():
+        while pending and len(running) < limit():
+            index, runner = pending.pop(0)
+            runner.process_finished.connect(
+                functools.partial(finished, index=index, started=time.monotonic()))
+            if on_started:
+                on_started(index)
+            try:
+                runner.start(ili2db_bin, java_path)
+            except FileNotFoundError:
+                # Java disappeared, report it like any other failure
+                finished(-1, runner.ERROR, index, time.monotonic())
+                continue
+            running.add(index)
+
+        if not running:
+            loop.quit()
+
+    def finished(exit_code, result, index, started):
+        seconds = time.monotonic() - started
+        results[index] = (exit_code, result, seconds)
+        running.discard(index)
+        if on_finished:
+            on_finished(index, exit_code, result, seconds)
+        start_next()
+
+    start_next()
+    if running:
+        loop.exec()
+
+    return [results[index] for index in range(len(runners))]
+
+
+def kill_process_tree(proc, timeout=5000):
+    """
+    Ends ``proc`` together with the processes it started. It gets ``timeout``
+    milliseconds to shut down before it is killed.
+    """
+    if proc.state() == QProcess.NotRunning:
+        return
+    if os.name == 'nt':
+        # terminate() only asks windows to close, console processes like java ignore that
+        QProcess.execute('taskkill', ['/T', '/F', '/PID', str(proc.processId())])
+    else:
+        # SIGTERM runs the JVM shutdown hooks, which release database connections
+        proc.terminate()
+        QTimer.singleShot(timeout, lambda: proc.state() != QProcess.NotRunning and proc.kill())
+
+
+XTF_DATASECTION_PATTERN = re.compile(rb'<(?:\w+:)?DATASECTION\b[^>]*?(/?)>')
+XTF_DATASECTION_END_PATTERN = re.compile(rb'</(?:\w+:)?DATASECTION\s*>')
+
+
+def merge_xtf_files(xtffiles, target, chunk_size=16 * 1024 * 1024):
+    """
+    Writes the baskets of all INTERLIS 2 ``xtffiles`` into one ``target``
+    transfer file, which uses the header of the first of them.
+
+    Files are copied in chunks and never loaded completely.
+    """
+    with open(target + '.part', 'wb') as output:
+        tail = None
+        for xtffile in xtffiles:
+            with open(xtffile, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    raise ValueError('{} is empty'.format(xtffile))
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    start = XTF_DATASECTION_PATTERN.search(data)
+                    if not start:
+                        raise ValueError('{} has no DATASECTION'.format(xtffile))
+                    if start.group(1):
+                        # Empty <DATASECTION/>
+                        end = after = start.end()
+                        end_tag = b'</DATASECTION>'
+                    else:
+                        # The end tag is close to the end of the file, look for it from there
+                        end_match = XTF_DATASECTION_END_PATTERN.match(
+                            data, data.rfind(b'<', start.end(), max(data.rfind(b'DATASECTION'), 0)))
+                        if not end_match or end_match.start() < start.end():
+                            raise ValueError('{} has an unterminated DATASECTION'.format(xtffile))
+                        end, after = end_match.span()
+                        end_tag = end_match.group(0)
+
+                    if tail is None:
+                        # The first file provides everything around the baskets
+                        _copy_range(data, 0, start.start(), output, chunk_size)
+                        output.write(start.group(0).replace(b'/>', b'>'))
+                        tail = end_tag + data[after:]
+                    _copy_range(data, start.end(), end, output, chunk_size)
+                finally:
+                    data.close()
+        output.write(tail)
+    os.replace(target + '.part', target)
+
+
+def _copy_range(data, start, end, output, chunk_size):
+    for position in range(start, end, chunk_size):
+        output.write(data[position:min(position + chunk_size, end)])
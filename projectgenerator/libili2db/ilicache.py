@@ -17,18 +17,384 @@
  *                                                                         *
  ***************************************************************************/
 """
+import bisect
+import collections
+import functools
 import glob
+import hashlib
+import itertools
+import json
 import logging
 import os
+import sqlite3
+import time
 import urllib.parse
 import xml.etree.ElementTree as ET
 
 import re
 
-from projectgenerator.libili2db.ili2dbutils import get_all_modeldir_in_path
+from projectgenerator.libili2db.ili2dbutils import get_model_directories
 from projectgenerator.utils.qt_utils import download_file, NetworkError
-from PyQt5.QtCore import QObject, pyqtSignal
-from qgis.core import QgsMessageLog, Qgis
+from PyQt5.QtCore import QAbstractListModel, QEventLoop, QModelIndex, QObject, Qt, QTimer, pyqtSignal, pyqtSlot
+from PyQt5.QtNetwork import QNetworkRequest
+from qgis.core import QgsApplication, QgsMessageLog, QgsTask, Qgis
+
+# Model header up to the ``=`` which starts the model body, strings within
+# the header (e.g. the ``AT`` url) are skipped
+ILI_HEADER_PATTERN = re.compile(rb'\bMODEL\s+([A-Za-z]\w*)((?:"[^"]*"|[^"=])*)=')
+# Comments are skipped in one forward pass, the MODEL keywords outside of them
+# are matched with ILI_HEADER_PATTERN
+ILI_COMMENT_OR_MODEL_PATTERN = re.compile(rb'/\*.*?(?:\*/|\Z)|!![^\n]*|\bMODEL\b', re.DOTALL)
+ILI_VERSION_PATTERN = re.compile(rb'\bVERSION\s*"([^"]*)"')
+# IMPORTS statement at the start of a model body, preceded by whitespace or comments
+ILI_IMPORTS_PATTERN = re.compile(rb'(?:\s|!![^\n]*|/\*.*?\*/)*IMPORTS\s+([^;]*);', re.DOTALL)
+# Models which are part of the INTERLIS compiler and never need to be looked up
+ILI_BUILTIN_MODELS = {'INTERLIS'}
+
+
+def model_version_key(version):
+    """
+    Returns a sort key for a model version which compares the numbers in it
+    as numbers, e.g. ``10.0`` is newer than ``9.0``.
+    """
+    return tuple((0, int(part)) if part.isdigit() else (1, part)
+                 for part in re.findall(r'\d+|[^\W\d_]+', version.lower()))
+
+
+class IliFileIndex(object):
+    """
+    Persistent index of the models found in local ili files.
+
+    Every file is stored with its size and modification time, so that only new
+    or modified files need to be parsed again. The HTTP validators of downloaded
+    repository files are kept as well.
+    """
+
+    # Increase whenever the structure of the indexed models changes
+    VERSION = 5
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            if self._conn.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+                self._conn.execute('DROP TABLE IF EXISTS ilifiles')
+                self._conn.execute('PRAGMA user_version = {}'.format(self.VERSION))
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS ilifiles (
+                    path TEXT PRIMARY KEY,
+                    directory TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime INTEGER NOT NULL,
+                    models TEXT NOT NULL
+                )""")
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS ilifiles_directory ON ilifiles (directory)')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS downloads (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    checked REAL NOT NULL
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS mirror (
+                    model TEXT PRIMARY KEY,
+                    md5 TEXT NOT NULL
+                )""")
+        return self._conn
+
+    def folder_entries(self, directory):
+        """
+        Returns a dict with the indexed files of ``directory`` mapped to
+        ``(size, mtime, models)`` tuples.
+        """
+        try:
+            cursor = self.conn.execute(
+                'SELECT path, size, mtime, models FROM ilifiles WHERE directory = ?', (directory,))
+            return {path: (size, mtime, json.loads(models)) for path, size, mtime, models in cursor}
+        except (sqlite3.Error, ValueError) as e:
+            QgsMessageLog.logMessage('Could not read ili file index `{path}` ({exception})'.format(
+                path=self.path, exception=str(e)), 'Projectgenerator')
+            return dict()
+
+    def update_folder(self, directory, entries):
+        """
+        Replaces the indexed files of ``directory`` with ``entries``, a dict
+        mapping file paths to ``(size, mtime, models)`` tuples.
+        """
+        try:
+            with self.conn:
+                self.conn.execute(
+                    'DELETE FROM ilifiles WHERE directory = ?', (directory,))
+                self.conn.executemany('INSERT OR REPLACE INTO ilifiles VALUES (?, ?, ?, ?, ?)',
+                                      [(path, directory, size, mtime, json.dumps(models))
+                                       for path, (size, mtime, models) in entries.items()])
+        except sqlite3.Error as e:
+            QgsMessageLog.logMessage('Could not update ili file index `{path}` ({exception})'.format(
+                path=self.path, exception=str(e)), 'Projectgenerator')
+
+    def file_models(self, path):
+        """
+        Returns the indexed models of the file ``path`` or ``None`` if the file
+        is not indexed or has changed since.
+        """
+        try:
+            stat = os.stat(path)
+            entry = self.conn.execute(
+                'SELECT size, mtime, models FROM ilifiles WHERE path = ?', (path,)).fetchone()
+            if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                return json.loads(entry[2])
+        except (OSError, sqlite3.Error, ValueError):
+            pass
+        return None
+
+    def update_file(self, path, models):
+        try:
+            stat = os.stat(path)
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO ilifiles VALUES (?, ?, ?, ?, ?)',
+                                  (path, os.path.dirname(path), stat.st_size, stat.st_mtime_ns, json.dumps(models)))
+        except (OSError, sqlite3.Error) as e:
+            QgsMessageLog.logMessage('Could not update ili file index `{path}` ({exception})'.format(
+                path=self.path, exception=str(e)), 'Projectgenerator')
+
+    def download_state(self, url):
+        """
+        Returns a dict with the ``etag``, ``last_modified`` and ``checked``
+        (timestamp of the last successful request) of a downloaded ``url``
+        or ``None`` if the url has never been downloaded.
+        """
+        try:
+            entry = self.conn.execute(
+                'SELECT etag, last_modified, checked FROM downloads WHERE url = ?', (url,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if entry:
+            return {'etag': entry[0], 'last_modified': entry[1], 'checked': entry[2]}
+        return None
+
+    def update_download_state(self, url, etag, last_modified):
+        try:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?)',
+                                  (url, etag, last_modified, time.time()))
+        except sqlite3.Error as e:
+            QgsMessageLog.logMessage('Could not update ili file index `{path}` ({exception})'.format(
+                path=self.path, exception=str(e)), 'Projectgenerator')
+
+    def mirrored_files(self):
+        """
+        Returns the md5 sums of all files in the model mirror.
+        """
+        try:
+            return {md5 for md5, in self.conn.execute('SELECT DISTINCT md5 FROM mirror')}
+        except sqlite3.Error:
+            return set()
+
+    def update_mirror(self, models):
+        """
+        Records that the models in the ``models`` dict are mirrored to the file
+        with the md5 they are mapped to.
+        """
+        try:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO mirror VALUES (?, ?)', models.items())
+        except sqlite3.Error as e:
+            QgsMessageLog.logMessage('Could not update ili file index `{path}` ({exception})'.format(
+                path=self.path, exception=str(e)), 'Projectgenerator')
+
+
+    def prune_mirror(self, models):
+        """
+        Removes the mirrored models which are not in the ``models`` dict or
+        which have a different md5 there.
+        """
+        try:
+            with self.conn:
+                rows = self.conn.execute('SELECT model, md5 FROM mirror').fetchall()
+                self.conn.executemany('DELETE FROM mirror WHERE model = ?',
+                                      [(model,) for model, md5 in rows if models.get(model) != md5])
+        except sqlite3.Error as e:
+            QgsMessageLog.logMessage('Could not update ili file index `{path}` ({exception})'.format(
+                path=self.path, exception=str(e)), 'Projectgenerator')
+
+
+class IliModelNameIndex(object):
+    """
+    Search index over the unique model names of an IliCache.
+
+    Every model name is kept once with its newest version. Names are kept
+    sorted for prefix lookups and joined to a single string for substring and
+    fuzzy (subsequence) lookups, so a search does not loop over all names in
+    python.
+
+    The fuzzy lookup is only run if there are not enough other matches. It
+    scans the names in chunks and stops after ``fuzzy_search_time`` seconds,
+    so it may miss matches in very large indexes while the user is typing.
+    """
+
+    fuzzy_search_time = 0.0005
+    # Characters of the joined names scanned between two checks of the time
+    fuzzy_chunk_size = 4096
+
+    def __init__(self):
+        self._models = dict()
+        self._keys = list()
+        self._offsets = list()
+        self._haystack = ''
+        self._recent = list()
+
+    def update(self, repositories):
+        models = dict()
+        for repo in repositories.values():
+            for model in repo:
+                key = model['name'].lower()
+                if key not in models or model_version_key(model['version']) > model_version_key(models[key][1]):
+                    models[key] = (model['name'], model['version'])
+
+        self._models = models
+        self._keys = sorted(models)
+        self._offsets = list()
+        offset = 0
+        for key in self._keys:
+            self._offsets.append(offset)
+            offset += len(key) + 1
+        self._haystack = '\n'.join(self._keys)
+
+    def mark_used(self, names):
+        """
+        Ranks ``names`` first in all later searches.
+        """
+        for name in reversed(names):
+            key = name.strip().lower()
+            if not key:
+                continue
+            if key in self._recent:
+                self._recent.remove(key)
+            self._recent.insert(0, key)
+        del self._recent[20:]
+
+    def search(self, text, limit=50):
+        """
+        Returns up to ``limit`` ``(name, version)`` tuples of the models matching ``text``.
+
+        Recently used models are ranked first, followed by names starting with
+        ``text``, names containing ``text`` and names containing the characters
+        of ``text`` in the same order.
+        """
+        text = text.strip().lower()
+        # Every character after the first one matches its next occurrence. The
+        # lookaheads with backreferences cannot be backtracked into, so a failed
+        # match is not retried with later occurrences of the same characters.
+        fuzzy_pattern = re.compile(text[:1] and re.escape(text[0]) + ''.join(
+            '(?=([^\n{char}]*{char}))\\{group}'.format(char=re.escape(char), group=group)
+            for group, char in enumerate(text[1:], 1)))
+
+        keys = [key for key in self._recent
+                if key in self._models and fuzzy_pattern.search(key)]
+
+        def add(key):
+            if key not in keys:
+                keys.append(key)
+            return len(keys) >= limit
+
+        start = bisect.bisect_left(self._keys, text)
+        for key in self._keys[start:start + limit]:
+            if not key.startswith(text) or add(key):
+                break
+
+        position = self._haystack.find(text) if text else -1
+        while position != -1 and len(keys) < limit:
+            line = bisect.bisect_right(self._offsets, position) - 1
+            add(self._keys[line])
+            position = self._haystack.find(text, position + 1)
+
+        if text and len(keys) < limit:
+            deadline = time.perf_counter() + self.fuzzy_search_time
+            position = 0
+            while position < len(self._haystack):
+                end = self._haystack.find('\n', position + self.fuzzy_chunk_size)
+                if end == -1:
+                    end = len(self._haystack)
+                match = fuzzy_pattern.search(self._haystack, position, end)
+                if match:
+                    line = bisect.bisect_right(self._offsets, match.start()) - 1
+                    if add(self._keys[line]):
+                        break
+                    # Continue after the matching name
+                    position = self._offsets[line] + len(self._keys[line]) + 1
+                else:
+                    position = end + 1
+                if time.perf_counter() > deadline:
+                    break
+
+        return [self._models[key] for key in keys[:limit]]
+
+
+class IliModelCompleterModel(QAbstractListModel):
+    """
+    List model with the best matches of an IliCache for the current search
+    text, to be used with a ``SearchCompleter``.
+
+    The models of the ili file set with ``set_ili_file`` are only offered by
+    this model and ranked first.
+    """
+
+    max_matches = 50
+
+    def __init__(self, ilicache, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self.ilicache = ilicache
+        self._search_text = ''
+        self._file_models = list()
+        self._models = list()
+        self.ilicache.models_changed.connect(self.update_matches)
+        self.update_matches()
+
+    def set_search_text(self, text):
+        if text != self._search_text:
+            self._search_text = text
+            self.update_matches()
+
+    def set_ili_file(self, ilifile):
+        if ilifile:
+            self._file_models = [(model['name'], model['version'])
+                                 for model in self.ilicache.ili_file_models(ilifile)]
+        else:
+            self._file_models = list()
+        self.update_matches()
+
+    @pyqtSlot()
+    def update_matches(self):
+        text = self._search_text.strip().lower()
+        models = [model for model in self._file_models if text in model[0].lower()]
+        names = {name for name, version in models}
+        models += [model for model in self.ilicache.model_index.search(self._search_text, self.max_matches)
+                   if model[0] not in names]
+        self.beginResetModel()
+        self._models = models[:self.max_matches]
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._models)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        name, version = self._models[index.row()]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return name
+        elif role == Qt.ToolTipRole:
+            return version
+        return None
 
 
 class IliCache(QObject):
@@ -39,75 +405,329 @@ class IliCache(QObject):
     models_changed = pyqtSignal()
     new_message = pyqtSignal(int, str)
 
-    def __init__(self, configuration, single_ili_file=None):
+    # Maximum number of repositories which are downloaded at the same time
+    max_parallel_downloads = 4
+    # Maximum nesting level of subsidiary sites which are crawled
+    max_site_depth = 5
+    # Milliseconds during which changes are collected before models_changed is emitted
+    notification_delay = 100
+    # Seconds during which a local model directory is not scanned again,
+    # repositories use the repository_cache_ttl of the configuration
+    local_directory_ttl = 60
+
+    def __init__(self, configuration):
         QObject.__init__(self)
         self.cache_path = os.path.expanduser('~/.ilicache')
         self.repositories = dict()
         self.base_configuration = configuration
-        self.single_ili_file = single_ili_file
+        self._file_index = None
+        self._repository_queue = collections.deque()
+        self._visited_repositories = set()
+        self._active_repositories = 0
+        self._repositories_changed = False
+        # Background scans which have not finished yet by their id
+        self._refresh_tasks = dict()
+        self._refresh_task_ids = itertools.count()
+        self._generation = 0
+        self._sources = None
+        self._refreshed_sources = dict()
+        self._repository_urls = dict()
+        self.model_index = IliModelNameIndex()
+        self._notification_timer = QTimer(self)
+        self._notification_timer.setSingleShot(True)
+        self._notification_timer.setInterval(self.notification_delay)
+        self._notification_timer.timeout.connect(self._notify_models_changed)
+
+    @property
+    def file_index(self):
+        """
+        The persistent index of local and downloaded files, stored in ``cache_path``.
+        """
+        index_path = os.path.join(self.cache_path, 'ilifiles.sqlite')
+        if self._file_index is None or self._file_index.path != index_path:
+            self._file_index = IliFileIndex(index_path)
+        return self._file_index
 
-    def refresh(self):
+    def refresh(self, background=False):
+        """
+        Reads the models of all model directories and repositories.
+
+        Sources which have been read less than their TTL ago are skipped, see
+        ``source_ttl``. If the model directories of the configuration changed
+        since the last refresh, all models read so far are discarded.
+
+        Repositories are always downloaded asynchronously. With ``background``
+        local directories are scanned in a task as well and this method returns
+        immediately.
+        """
+        sources = list()
         if not self.base_configuration is None:
-            for directory in self.base_configuration.model_directories:
+            sources = self.base_configuration.model_directories
+        if sources != self._sources:
+            self.invalidate()
+            self._sources = sources
+
+        directories = list()
+        now = time.time()
+        for directory in sources:
+            if directory[0] == '%':
+                continue
+            if now - self._refreshed_sources.get(directory, 0) < self.source_ttl(directory):
+                continue
+            self._refreshed_sources[directory] = now
+            if os.path.isdir(directory):
+                directories.append(directory)
+            else:
+                self.download_repository(directory)
+
+        if background:
+            task_id = next(self._refresh_task_ids)
+            task = QgsTask.fromFunction(self.tr('Refresh INTERLIS models'),
+                                        self._scan_local_models,
+                                        directories, self.file_index.path,
+                                        on_finished=functools.partial(self._local_models_scanned,
+                                                                      self._generation, task_id))
+            self._refresh_tasks[task_id] = task
+            QgsApplication.taskManager().addTask(task)
+        else:
+            for directory in directories:
                 self.process_model_directory(directory)
-        if not self.single_ili_file is None:
-            self.process_single_ili_file()
+
+    @property
+    def refreshing(self):
+        """
+        Whether local directories are being scanned or repositories downloaded.
+        """
+        return bool(self._refresh_tasks) or self._active_repositories > 0 or bool(self._repository_queue)
+
+    def invalidate(self):
+        """
+        Discards all models read so far, the next refresh reads all sources again.
+        Scans and downloads which are still running are dropped when they finish.
+        """
+        self._generation += 1
+        self._refreshed_sources.clear()
+        self._repository_queue.clear()
+        self._visited_repositories.clear()
+        if self.repositories:
+            self.repositories.clear()
+            self._schedule_models_changed()
+
+    def source_ttl(self, source):
+        """
+        Seconds during which the models read from ``source`` are considered current.
+        """
+        if os.path.isdir(source):
+            return self.local_directory_ttl
+        return self.repository_cache_ttl
+
+    def _scan_local_models(self, task, directories, index_path):
+        """
+        Collects the models of local directories.
+        Runs in a background task and therefore uses its own file index connection.
+        """
+        file_index = IliFileIndex(index_path)
+        repositories = dict()
+        for directory in directories:
+            if task.isCanceled():
+                return None
+            for path, ilifiles in get_model_directories(directory):
+                repositories[path] = self._local_ili_folder_models(path, file_index, ilifiles)
+        return repositories
+
+    def _local_models_scanned(self, generation, task_id, exception, repositories=None):
+        self._refresh_tasks.pop(task_id, None)
+        if generation != self._generation:
+            # The cache has been invalidated while scanning
+            return
+        if exception is not None:
+            QgsMessageLog.logMessage(self.tr('Could not read local INTERLIS models ({exception})').format(
+                exception=str(exception)), self.tr('Projectgenerator'))
+        elif repositories:
+            self.repositories.update(repositories)
+            self._schedule_models_changed()
+
+    def _schedule_models_changed(self):
+        """
+        Collects changes of the repositories and emits a single models_changed
+        after ``notification_delay`` milliseconds.
+        """
+        self._notification_timer.start()
+
+    def _notify_models_changed(self):
+        self.model_index.update(self.repositories)
+        self.models_changed.emit()
+
+    def mark_models_used(self, models):
+        """
+        Ranks the ``;`` separated ``models`` first in model searches.
+        """
+        self.model_index.mark_used(models.split(';'))
 
     def process_model_directory(self, path):
         if path[0] == '%':
             pass
         elif os.path.isdir(path):
             # recursive search of ilimodels paths
-            get_all_modeldir_in_path(path, self.process_local_ili_folder)
+            for subdir, ilifiles in get_model_directories(path):
+                self.process_local_ili_folder(subdir, ilifiles)
         else:
             self.download_repository(path)
 
-    def process_single_ili_file(self):
-        models = self.process_ili_file(self.single_ili_file)
-        self.repositories["no_repo"] = sorted(
-            models, key=lambda m: m['version'], reverse=True)
-        self.models_changed.emit()
+    def ili_file_models(self, ilifile):
+        """
+        Returns the models of a single ili file, newest versions first.
+
+        The models are not added to ``repositories``, so every caller only sees
+        the models of its own file. Pass the file to ``model_dependencies``,
+        ``model_versions`` and ``required_model_directories`` to include them.
+        """
+        return self._ili_file_models(ilifile, self.file_index)
+
+    def _ili_file_models(self, ilifile, file_index):
+        models = file_index.file_models(ilifile)
+        if models is None:
+            models = self.process_ili_file(ilifile)
+            file_index.update_file(ilifile, models)
+        return sorted(models, key=lambda m: model_version_key(m['version']), reverse=True)
+
+    def download_repository(self, url, depth=0):
+        """
+        Queues the repository at the provided url for download.
 
-    def download_repository(self, url):
+        Repositories are crawled breadth-first: the ilimodels.xml and
+        ilisite.xml files of up to ``max_parallel_downloads`` repositories are
+        downloaded at the same time and subsidiary sites are queued when their
+        parent ilisite.xml has been processed. Every repository is visited only
+        once per crawl and sites deeper than ``max_site_depth`` are ignored.
+        ``models_changed`` is emitted once the crawl is finished.
+        """
+        if not url.endswith('/'):
+            url += '/'
+        if url in self._visited_repositories or depth > self.max_site_depth:
+            return
+        self._visited_repositories.add(url)
+        self._repository_queue.append((url, depth))
+        self._download_next_repositories()
+
+    def _download_next_repositories(self):
+        while self._repository_queue and self._active_repositories < self.max_parallel_downloads:
+            url, depth = self._repository_queue.popleft()
+            self._active_repositories += 1
+            self._download_repository(url, depth)
+
+    def _download_repository(self, url, depth):
         """
         Downloads the ilimodels.xml and ilisite.xml files from the provided url
         and updates the local cache.
         """
-        netloc = urllib.parse.urlsplit(url)[1]
+        split_url = urllib.parse.urlsplit(url)
+        netloc = split_url.netloc
+        repository = (netloc + split_url.path).rstrip('/')
+        self._repository_urls[repository] = url
 
-        modeldir = os.path.join(self.cache_path, netloc)
+        path_segments = [segment for segment in split_url.path.split('/')
+                         if segment not in ('', '.', '..')]
+        modeldir = os.path.join(self.cache_path, netloc, *path_segments)
 
         os.makedirs(modeldir, exist_ok=True)
 
         ilimodels_url = urllib.parse.urljoin(url, 'ilimodels.xml')
-        ilimodels_path = os.path.join(self.cache_path, netloc, 'ilimodels.xml')
+        ilimodels_path = os.path.join(modeldir, 'ilimodels.xml')
         ilisite_url = urllib.parse.urljoin(url, 'ilisite.xml')
-        ilisite_path = os.path.join(self.cache_path, netloc, 'ilisite.xml')
+        ilisite_path = os.path.join(modeldir, 'ilisite.xml')
 
-        logger = logging.getLogger(__name__)
+        pending_files = [ilimodels_url, ilisite_url]
+        generation = self._generation
+
+        def process(function, *args):
+            # Downloads started before invalidate() must not add their models
+            if generation == self._generation:
+                function(*args)
+
+        def file_finished(file_url):
+            pending_files.remove(file_url)
+            if not pending_files:
+                self._repository_finished()
 
         # download ilimodels.xml
-        download_file(ilimodels_url, ilimodels_path,
-                      on_progress=lambda received, total: print(
-                          'Downloading ({}/{})'.format(received, total)),
-                      on_success=lambda: self._process_ilimodels(
-                          ilimodels_path, netloc),
-                      on_error=lambda error, error_string: logger.warning(self.tr(
-                          'Could not download {url} ({message})').format(url=ilimodels_url, message=error_string))
-                      )
+        self._download_repository_file(ilimodels_url, ilimodels_path,
+                                       lambda: process(self._process_ilimodels, ilimodels_path, repository, url),
+                                       lambda: file_finished(ilimodels_url))
 
         # download ilisite.xml
-        download_file(ilisite_url, ilisite_path,
+        self._download_repository_file(ilisite_url, ilisite_path,
+                                       lambda: process(self._process_ilisite, ilisite_path, depth),
+                                       lambda: file_finished(ilisite_url))
+
+    def _repository_finished(self):
+        self._active_repositories -= 1
+        self._download_next_repositories()
+        if not self._active_repositories and not self._repository_queue:
+            # The crawl is finished, the next refresh visits all repositories again
+            self._visited_repositories.clear()
+            if self._repositories_changed:
+                self._repositories_changed = False
+                self._schedule_models_changed()
+
+    def _download_repository_file(self, url, path, on_success, on_finished):
+        """
+        Downloads ``url`` to ``path`` unless the local copy is still valid.
+        ``on_finished`` is called in any case when the file has been handled.
+
+        A local copy which was checked less than ``repository_cache_ttl`` seconds
+        ago is used without network access. Otherwise the server is asked for a
+        newer version with the ETag and Last-Modified values of the local copy.
+        """
+        logger = logging.getLogger(__name__)
+        state = self.file_index.download_state(url) if os.path.isfile(path) else None
+
+        headers = dict()
+        if state:
+            if time.time() - state['checked'] < self.repository_cache_ttl:
+                on_success()
+                on_finished()
+                return
+            if state['etag']:
+                headers['If-None-Match'] = state['etag']
+            if state['last_modified']:
+                headers['If-Modified-Since'] = state['last_modified']
+
+        def on_reply(reply):
+            if not reply.error():
+                etag = bytes(reply.rawHeader(b'ETag')).decode() or None
+                last_modified = bytes(reply.rawHeader(b'Last-Modified')).decode() or None
+                if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) == 304 and state:
+                    etag = etag or state['etag']
+                    last_modified = last_modified or state['last_modified']
+                self.file_index.update_download_state(url, etag, last_modified)
+
+        def on_error(error, error_string):
+            logger.warning(self.tr('Could not download {url} ({message})').format(
+                url=url, message=error_string))
+            if state:
+                # Fall back to the previously downloaded copy
+                on_success()
+
+        download_file(url, path,
                       on_progress=lambda received, total: print(
                           'Downloading ({}/{})'.format(received, total)),
-                      on_success=lambda: self._process_ilisite(ilisite_path),
-                      on_error=lambda error, error_string: logger.warning(self.tr(
-                          'Could not download {url} ({message})').format(url=ilisite_url, message=error_string))
+                      on_success=on_success,
+                      on_error=on_error,
+                      on_finished=on_finished,
+                      headers=headers,
+                      on_reply=on_reply
                       )
 
-    def _process_ilisite(self, file):
+    @property
+    def repository_cache_ttl(self):
+        if self.base_configuration is None:
+            return 0
+        return self.base_configuration.repository_cache_ttl
+
+    def _process_ilisite(self, file, depth):
         """
-        Parses the ilisite.xml provided in ``file`` and recursively downloads any subidiary sites.
+        Parses the ilisite.xml provided in ``file`` and queues any subsidiary sites for download.
         """
         try:
             root = ET.parse(file).getroot()
@@ -118,90 +738,337 @@ class IliCache(QObject):
 
         for site in root.iter('{http://www.interlis.ch/INTERLIS2.3}IliSite09.SiteMetadata.Site'):
             subsite = site.find('ili23:subsidiarySite', self.ns)
-            if subsite:
+            if subsite is not None:
                 for location in subsite.findall('ili23:IliSite09.RepositoryLocation_', self.ns):
                     self.download_repository(
-                        location.find('ili23:value', self.ns).text)
+                        location.find('ili23:value', self.ns).text, depth + 1)
 
-    def _process_ilimodels(self, file, netloc):
+    def _process_ilimodels(self, file, repository, url=None):
         """
         Parses ilimodels.xml provided in ``file`` and updates the local repositories cache.
+        The ``url`` of the repository is used to resolve the urls of the model files.
+        The parsed models are kept in the file index, so an unchanged file is not parsed again.
         """
+        repo_models = self.file_index.file_models(file)
+        if repo_models is not None:
+            self.repositories[repository] = repo_models
+            self._repositories_changed = True
+            return
 
+        repo_models = list()
+        metadata_tag = '{http://www.interlis.ch/INTERLIS2.3}IliRepository09.RepositoryIndex.ModelMetadata'
+        # Elements which are started but not ended yet
+        parents = list()
         try:
-            root = ET.parse(file).getroot()
+            # The repository index may be huge, stream it and remove every
+            # model from its parent as soon as it has been read
+            for event, element in ET.iterparse(file, events=('start', 'end')):
+                if event == 'start':
+                    parents.append(element)
+                    continue
+                parents.pop()
+                if element.tag != metadata_tag:
+                    continue
+
+                model = dict()
+                model['name'] = element.findtext('ili23:Name', '', self.ns)
+                model['version'] = element.findtext('ili23:Version', '', self.ns)
+                model['file'] = element.findtext('ili23:File', '', self.ns)
+                model['url'] = urllib.parse.urljoin(url, model['file']) if url and model['file'] else ''
+                model['md5'] = element.findtext('ili23:md5', '', self.ns)
+                model['issuer'] = element.findtext('ili23:Issuer', '', self.ns)
+                model['depends_on'] = [depends_on.text for depends_on in element.iterfind(
+                    'ili23:dependsOnModel/ili23:IliRepository09.ModelName_/ili23:value', self.ns)]
+                repo_models.append(model)
+
+                if parents:
+                    parents[-1].remove(element)
         except ET.ParseError as e:
             QgsMessageLog.logMessage(self.tr('Could not parse ilimodels file `{file}` ({exception})'.format(
                 file=file, exception=str(e))), self.tr('Projectgenerator'))
             return
 
-        self.repositories[netloc] = list()
-        repo_models = list()
-        for repo in root.iter('{http://www.interlis.ch/INTERLIS2.3}IliRepository09.RepositoryIndex'):
-            for model_metadata in repo.findall('ili23:IliRepository09.RepositoryIndex.ModelMetadata', self.ns):
-                model = dict()
-                model['name'] = model_metadata.find('ili23:Name', self.ns).text
-                model['version'] = model_metadata.find(
-                    'ili23:Version', self.ns).text
-                repo_models.append(model)
+        self.repositories[repository] = sorted(
+            repo_models, key=lambda m: model_version_key(m['version']), reverse=True)
+        self.file_index.update_file(file, self.repositories[repository])
+        self._repositories_changed = True
 
-        self.repositories[netloc] = sorted(
-            repo_models, key=lambda m: m['version'], reverse=True)
-        self.models_changed.emit()
+    def newest_models(self, ilifile=None):
+        """
+        Returns a dict with all known model names and the models of ``ilifile``
+        mapped to the newest version of the model.
+        """
+        return {name: model for name, (repository, model) in self._newest_model_sources(ilifile).items()}
 
-    def process_local_ili_folder(self, path):
+    def _newest_model_sources(self, ilifile=None):
+        repositories = self.repositories
+        if ilifile:
+            repositories = dict(repositories, no_repo=self.ili_file_models(ilifile))
+        models = dict()
+        for repository, repo_models in repositories.items():
+            for model in repo_models:
+                if model['name'] not in models or \
+                        model_version_key(model['version']) > model_version_key(models[model['name']][1]['version']):
+                    models[model['name']] = (repository, model)
+        return models
+
+    def model_dependencies(self, models, ilifile=None):
         """
-        Parses all .ili files in the given ``path`` (non-recursively)
+        Returns a tuple with the set of the ``;`` separated ``models`` and all
+        models they import directly or indirectly, and the set of imported
+        models which are not known to any repository or ``ilifile``.
+
+        The IMPORTS of local ili files and the dependencies listed in
+        repository indexes are followed.
+        """
+        newest_models = self.newest_models(ilifile)
+        dependencies = set()
+        missing = set()
+        pending = [name.strip() for name in models.split(';') if name.strip()]
+        while pending:
+            name = pending.pop()
+            if name in dependencies or name in missing or name in ILI_BUILTIN_MODELS:
+                continue
+            model = newest_models.get(name)
+            if model is None:
+                missing.add(name)
+                continue
+            dependencies.add(name)
+            pending.extend(model.get('depends_on', list()))
+        return dependencies, missing
+
+    def model_versions(self, models, ilifile=None):
+        """
+        Returns ``name version md5`` for each of the ``;`` separated ``models``
+        and all models they import, as found in the repositories, model
+        directories and ``ilifile``. ``None`` is returned if some models are
+        unknown or the cache is still refreshing.
+        """
+        if self.refreshing:
+            return None
+        dependencies, missing = self.model_dependencies(models, ilifile)
+        if missing or not dependencies:
+            return None
+
+        newest_models = self.newest_models(ilifile)
+        return sorted('{} {} {}'.format(name, newest_models[name]['version'], newest_models[name].get('md5', ''))
+                      for name in dependencies)
+
+    def required_model_directories(self, models, ilifile=None):
+        """
+        Returns the model directories and repository urls which contain the
+        ``;`` separated ``models`` and all models they depend on, followed by
+        ``%JAR_DIR``. Models of ``ilifile`` are found in its directory.
+
+        Models of repositories are taken from the mirror if their file has been
+        mirrored. ``None`` is returned if some models are unknown or the cache
+        is still refreshing, the full model directories are needed then.
+        """
+        if self.refreshing:
+            return None
+        dependencies, missing = self.model_dependencies(models, ilifile)
+        if missing or not dependencies:
+            return None
+
+        mirror_enabled = self.base_configuration is None or self.base_configuration.mirror_models_enabled
+        model_sources = self._newest_model_sources(ilifile)
+        directories = list()
+        for name in sorted(dependencies):
+            repository, model = model_sources[name]
+            if model.get('url'):
+                if mirror_enabled and os.path.isfile(os.path.join(self.mirror_path, model['md5'].lower() + '.ili')):
+                    directory = self.mirror_path
+                elif repository in self._repository_urls:
+                    directory = self._repository_urls[repository]
+                else:
+                    return None
+            elif repository == 'no_repo':
+                directory = os.path.dirname(ilifile)
+            else:
+                directory = repository
+            if directory not in directories:
+                directories.append(directory)
+
+        if self.mirror_path in directories:
+            # The mirror is the fastest source, make sure it is searched first
+            directories.remove(self.mirror_path)
+            directories.insert(0, self.mirror_path)
+        return directories + ['%JAR_DIR']
+
+    @property
+    def mirror_path(self):
+        """
+        Directory with the mirrored model files, usable as ili2db model directory.
+        """
+        if self.base_configuration is not None:
+            return self.base_configuration.model_mirror_path
+        return os.path.join(self.cache_path, 'mirror')
+
+    def mirror_models(self, models):
+        """
+        Mirrors the files of the ``;`` separated ``models`` and of the models
+        they depend on from their repositories to ``mirror_path``.
+
+        Files are stored as ``<md5>.ili`` and only downloaded when the md5 in
+        the repository index changes. Files which are no longer referenced by
+        any mirrored model are removed, so every model is defined only once in
+        the mirror. Models which are no longer in the repository indexes or
+        have a new md5 there are removed as well. Returns once all downloads
+        are finished.
         """
+        mirrored_models = dict()
+        files = dict()
+        newest_models = self.newest_models()
+        for name in self.model_dependencies(models)[0]:
+            model = newest_models[name]
+            if not model.get('url') or not model.get('md5'):
+                continue
+            md5 = model['md5'].lower()
+            # All models defined in the same file share its mirror entry
+            for other in newest_models.values():
+                if other.get('url') == model['url'] and other['md5'].lower() == md5:
+                    mirrored_models[other['name']] = md5
+            files[md5] = model['url']
+
+        if not files:
+            return
+
+        os.makedirs(self.mirror_path, exist_ok=True)
+        missing_files = {md5: url for md5, url in files.items()
+                         if not os.path.isfile(os.path.join(self.mirror_path, md5 + '.ili'))}
+        loop = QEventLoop()
+
+        def file_finished(md5):
+            del missing_files[md5]
+            if not missing_files:
+                loop.quit()
+
+        for md5, url in list(missing_files.items()):
+            part_path = os.path.join(self.mirror_path, md5 + '.part')
+            download_file(url, part_path,
+                          on_success=functools.partial(self._mirror_file_downloaded, part_path, md5),
+                          on_error=lambda error, error_string, url=url: QgsMessageLog.logMessage(
+                              self.tr('Could not mirror model file `{url}` ({exception})').format(
+                                  url=url, exception=error_string), self.tr('Projectgenerator')),
+                          on_finished=functools.partial(file_finished, md5))
+        if missing_files:
+            loop.exec_()
+
+        self.file_index.update_mirror(mirrored_models)
+        self.file_index.prune_mirror({model['name']: model['md5'].lower() for model in newest_models.values()
+                                      if model.get('url') and model.get('md5')})
+        referenced_files = self.file_index.mirrored_files()
+        for ilifile in glob.glob(os.path.join(self.mirror_path, '*.ili')):
+            if os.path.splitext(os.path.basename(ilifile))[0] not in referenced_files:
+                os.remove(ilifile)
+
+    def _mirror_file_downloaded(self, part_path, md5):
+        with open(part_path, 'rb') as file:
+            file_md5 = hashlib.md5(file.read()).hexdigest()
+        if file_md5 == md5:
+            os.replace(part_path, os.path.join(self.mirror_path, md5 + '.ili'))
+        else:
+            os.remove(part_path)
+            QgsMessageLog.logMessage(self.tr('The downloaded model file `{md5}` has the md5 `{file_md5}` and is not mirrored').format(
+                md5=md5, file_md5=file_md5), self.tr('Projectgenerator'))
+
+    def process_local_ili_folder(self, path, ilifiles=None):
+        """
+        Parses all .ili files in the given ``path`` (non-recursively) or only
+        ``ilifiles`` if the files of the folder are already known.
+        Files which did not change since they were last parsed are loaded from
+        the file index.
+        """
+        self.repositories[path] = self._local_ili_folder_models(path, self.file_index, ilifiles)
+        self._schedule_models_changed()
+
+    def _local_ili_folder_models(self, path, file_index, ilifiles=None):
         models = list()
-        fileModels = list()
-        for ilifile in glob.iglob(os.path.join(path, '*.ili')):
-            fileModels = self.process_ili_file(ilifile)
+        indexed_entries = file_index.folder_entries(path)
+        entries = dict()
+        if ilifiles is None:
+            ilifiles = glob.iglob(os.path.join(path, '*.ili'))
+        for ilifile in ilifiles:
+            try:
+                stat = os.stat(ilifile)
+            except OSError:
+                continue
+            entry = indexed_entries.get(ilifile)
+            if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                fileModels = entry[2]
+            else:
+                fileModels = self.process_ili_file(ilifile)
+            entries[ilifile] = (stat.st_size, stat.st_mtime_ns, fileModels)
             models.extend(fileModels)
 
-        self.repositories[path] = sorted(
-            models, key=lambda m: m['version'], reverse=True)
-        self.models_changed.emit()
+        if entries != indexed_entries:
+            file_index.update_folder(path, entries)
+
+        return sorted(models, key=lambda m: model_version_key(m['version']), reverse=True)
 
     def process_ili_file(self, ilifile):
-        fileModels = list()
         try:
-            fileModels = self.parse_ili_file(ilifile, "utf-8")
-        except UnicodeDecodeError:
-            try:
-                fileModels = self.parse_ili_file(ilifile, "latin1")
-                self.new_message.emit(Qgis.Warning,
-                                      self.tr('Even though the ili file `{}` could be read, it is not in UTF-8. Please encode your ili models in UTF-8.'.format(os.path.basename(ilifile))))
-            except UnicodeDecodeError as e:
-                self.new_message.emit(Qgis.Critical,
-                                      self.tr('Could not parse ili file `{}` with UTF-8 nor Latin-1 encodings. Please encode your ili models in UTF-8.'.format(os.path.basename(ilifile))))
-                QgsMessageLog.logMessage(self.tr('Could not parse ili file `{ilifile}`. We suggest you to encode it in UTF-8. ({exception})'.format(
-                    ilifile=ilifile, exception=str(e))), self.tr('Projectgenerator'))
-                fileModels = list()
+            fileModels, encoding = self.parse_ili_file(ilifile)
+        except OSError as e:
+            self.new_message.emit(Qgis.Critical,
+                                  self.tr('Could not read ili file `{}`.'.format(os.path.basename(ilifile))))
+            QgsMessageLog.logMessage(self.tr('Could not read ili file `{ilifile}` ({exception})'.format(
+                ilifile=ilifile, exception=str(e))), self.tr('Projectgenerator'))
+            return list()
+
+        if encoding != 'utf-8':
+            self.new_message.emit(Qgis.Warning,
+                                  self.tr('Even though the ili file `{}` could be read, it is not in UTF-8. Please encode your ili models in UTF-8.'.format(os.path.basename(ilifile))))
 
         return fileModels
 
-    def parse_ili_file(self, ilipath, encoding):
+    def parse_ili_file(self, ilipath):
         """
-        Parses an ili file returning models and version data
+        Parses an ili file returning models with their version, the md5 of the
+        file and the imported models and the encoding of the file (``utf-8`` or
+        ``latin1``).
+
+        The whole file is read once as bytes, the md5 and the encoding check
+        need all of it and a file can hold any number of models. The encoding
+        is checked by decoding the whole buffer once, the models are then found
+        in a single forward pass which skips comments. Only occurrences of
+        ``MODEL`` outside of comments are matched with a precompiled pattern,
+        only the model names, versions and imports are decoded.
         """
+        with open(ilipath, 'rb') as file:
+            data = file.read()
+
+        try:
+            data.decode('utf-8')
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = 'latin1'
+
+        md5 = hashlib.md5(data).hexdigest()
         models = list()
-        re_model = re.compile(r'\s*MODEL\s*([\w\d_-]+)\s.*')
-        re_model_version = re.compile(r'VERSION "([ \w\d\._-]+)".*')
-        with open(ilipath, 'r', encoding=encoding) as file:
-            for line in file:
-                result = re_model.search(line)
-                if result:
-                    model = dict()
-                    model['name'] = result.group(1)
-                    model['version'] = ''
-                    models += [model]
-
-                result = re_model_version.search(line)
-                if result:
-                    model['version'] = result.group(1)
+        token = ILI_COMMENT_OR_MODEL_PATTERN.search(data)
+        while token:
+            position = token.end()
+            match = ILI_HEADER_PATTERN.match(data, token.start()) if token.group() == b'MODEL' else None
+            if match:
+                version = ILI_VERSION_PATTERN.search(match.group(2))
+                position = match.end()
+                depends_on = list()
+                imports = ILI_IMPORTS_PATTERN.match(data, position)
+                while imports:
+                    depends_on += [name.decode(encoding) for name in re.split(rb'[\s,]+', imports.group(1))
+                                   if name and name != b'UNQUALIFIED']
+                    position = imports.end()
+                    imports = ILI_IMPORTS_PATTERN.match(data, position)
+                models.append({
+                    'name': match.group(1).decode(encoding),
+                    'version': version.group(1).decode(encoding).strip() if version else '',
+                    'md5': md5,
+                    'depends_on': depends_on
+                })
+            token = ILI_COMMENT_OR_MODEL_PATTERN.search(data, position)
 
-        return models
+        return models, encoding
 
     @property
     def model_names(self):
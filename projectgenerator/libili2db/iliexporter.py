@@ -17,16 +17,32 @@
  *                                                                         *
  ***************************************************************************/
 """
-import os
 
+import os
 import re
-import functools
+import copy
 import locale
+import tempfile
+import functools
+import collections
 
-from projectgenerator.libili2db.ili2dbutils import get_ili2db_bin
+from projectgenerator.libili2db.ili2dbutils import (
+    get_ili2db_bin,
+    get_cds_args,
+    get_safe_command,
+    store_cds_archive,
+    run_ili2db_pool,
+    merge_xtf_files,
+    kill_process_tree
+)
+from projectgenerator.libili2db import ili2dbevents
+from projectgenerator.libili2db.ili2dbevents import Ili2dbOutputParser
+from projectgenerator.libili2db.iliworker import get_ili2db_worker
+from projectgenerator.libili2db.javaruntime import get_java_runtime, invalidate_java_runtimes
 from qgis.PyQt.QtCore import QObject, pyqtSignal, QProcess, QEventLoop
 
 from projectgenerator.libili2db.ili2dbconfig import ExportConfiguration, JavaNotFoundError, ili2db_tools
+from projectgenerator.libqgsprojectgen.dbconnector import pg_connector, gpkg_connector
 
 
 class Exporter(QObject):
@@ -38,85 +54,382 @@ class Exporter(QObject):
     stderr = pyqtSignal(str)
     process_started = pyqtSignal(str)
     process_finished = pyqtSignal(int, int)
+    # Ili2dbEvent for every line ili2db writes to stderr
+    progress_event = pyqtSignal(object)
+    # Result of start_run() once it is done
+    run_finished = pyqtSignal(int)
 
-    __done_pattern = None
     __result = None
+    # What currently runs ili2db, ended by cancel()
+    __proc = None
+    __worker = None
+    __canceled = False
+    # State of start_run()
+    __ili2db_bin = None
+    __java_path = None
+    __on_ili2db_finished = None
 
     def __init__(self, parent=None):
         QObject.__init__(self, parent)
         self.filename = None
         self.tool_name = None
         self.configuration = ExportConfiguration()
+        self.output_parser = None
         self.encoding = locale.getlocale()[1]
         # This might be unset
         # (https://stackoverflow.com/questions/1629699/locale-getlocale-problems-on-osx)
         if not self.encoding:
             self.encoding = 'UTF8'
 
+    def can_start(self):
+        """
+        Whether ``start()`` does the same as ``run()`` and ``start_run()``,
+        which otherwise run ili2db in a worker.
+        """
+        return not self.configuration.base_configuration.jvm_worker_enabled
+
+    def cancel(self):
+        """
+        Ends a running ``run()``, ``start_run()`` or ``start()``, which then
+        finishes with an error result.
+        """
+        self.__canceled = True
+        if self.__worker:
+            self.__worker.kill()
+        if self.__proc and self.__proc.state() != QProcess.NotRunning:
+            kill_process_tree(self.__proc)
+
     def run(self):
+        """
+        Runs the export and returns its result once it is finished, ``None``
+        if ili2db is not available. Meant for scripts without a running event
+        loop, see ``start_run()``.
+
+        Raises a JavaNotFoundError before anything is started if Java is
+        missing or too old.
+        """
         ili2db_bin = get_ili2db_bin(self.tool_name, self.stdout, self.stderr, ili2db_tools)
         if not ili2db_bin:
             return
+        java_path = get_java_runtime(self.configuration.base_configuration.java_path).path
+
+        result = list()
+        loop = QEventLoop()
+
+        def finished(run_result):
+            result.append(run_result)
+            loop.quit()
+
+        self.run_finished.connect(finished)
+        self.start_run(ili2db_bin, java_path)
+        if not result:
+            loop.exec()
+        self.run_finished.disconnect(finished)
+        return result[0]
+
+    def start_run(self, ili2db_bin, java_path):
+        """
+        Runs the same steps as ``run()`` without waiting for them and emits
+        ``run_finished`` with the result once they are done.
+        """
+        self.__ili2db_bin = ili2db_bin
+        self.__java_path = java_path
+        self.__on_ili2db_finished = self._finish_run
+        if self.__canceled:
+            self._ili2db_finished()
+            return
+
+        try:
+            java = get_java_runtime(java_path)
+            base_configuration = self.configuration.base_configuration
+            # The worker is compiled from source at startup, which needs Java 11
+            if base_configuration.jvm_worker_enabled and java.major_version >= 11:
+                # Workers run many jobs, they only use the options not depending on the input
+                worker_jvm_args = base_configuration.to_jvm_args()
+                worker = get_ili2db_worker(java.path, ili2db_bin, self.encoding, worker_jvm_args)
+                if worker:
+                    self.start_in_worker(worker, java.path, worker_jvm_args + ["-jar", ili2db_bin])
+                    return
+            self.start(ili2db_bin, java_path)
+        except JavaNotFoundError:
+            self.stderr.emit(self.tr('Java could not be found'))
+            self.__result = Exporter.ERROR
+            self._ili2db_finished()
+
+    def _ili2db_finished(self):
+        on_finished, self.__on_ili2db_finished = self.__on_ili2db_finished, None
+        if on_finished:
+            on_finished(Exporter.ERROR if self.__canceled else self.__result)
 
+    def _finish_run(self, result):
+        self.run_finished.emit(Exporter.ERROR if result is None else result)
+
+    def start(self, ili2db_bin, java_path):
+        """
+        Starts ili2db in a new process and returns the process without waiting
+        for it. ``process_finished`` is emitted once it ends.
+        """
         ili2db_jar_arg = ["-jar", ili2db_bin]
 
         self.configuration.tool_name = self.tool_name
 
         args = self.configuration.to_ili2db_args()
 
-        if self.configuration.base_configuration.java_path:
-            # A java path is configured: respect it no mather what
-            java_paths = [self.configuration.base_configuration.java_path]
+        jvm_args = self.configuration.to_jvm_args()
+
+        proc = QProcess(self)
+        proc.readyReadStandardError.connect(
+            functools.partial(self.stderr_ready, proc=proc))
+        proc.readyReadStandardOutput.connect(
+            functools.partial(self.stdout_ready, proc=proc))
+
+        if self.configuration.base_configuration.class_data_sharing_enabled:
+            java = get_java_runtime(java_path)
+            cds_args, cds_dump_path = get_cds_args(java, ili2db_bin)
         else:
-            # By default try JAVA_HOME and PATH
-            java_paths = []
-            if 'JAVA_HOME' in os.environ:
-                paths = os.environ['JAVA_HOME'].split(";")
-                for path in paths:
-                    java_paths += [os.path.join(path.replace("\"",
-                                                             "").replace("'", ""), 'java')]
-            java_paths += ['java']
-
-        proc = None
-        for java_path in java_paths:
-            proc = QProcess()
-            proc.readyReadStandardError.connect(
-                functools.partial(self.stderr_ready, proc=proc))
-            proc.readyReadStandardOutput.connect(
-                functools.partial(self.stdout_ready, proc=proc))
-
-            proc.start(java_path, ili2db_jar_arg + args)
-
-            if not proc.waitForStarted():
-                proc = None
-            else:
-                break
+            java, cds_args, cds_dump_path = None, list(), None
+
+        command_args = jvm_args + cds_args + ili2db_jar_arg + args
+        proc.start(java_path, command_args)
 
-        if not proc:
+        if not proc.waitForStarted():
+            invalidate_java_runtimes()
             raise JavaNotFoundError()
+        self.__proc = proc
 
-        safe_args = ili2db_jar_arg + self.configuration.to_ili2db_args(hide_password=True)
-        safe_command = java_path + ' ' + ' '.join(safe_args)
-        self.process_started.emit(safe_command)
+        self.process_started.emit(get_safe_command(java_path, command_args))
 
         self.__result = Exporter.ERROR
+        self.output_parser = Ili2dbOutputParser(self.encoding)
 
-        loop = QEventLoop()
-        proc.finished.connect(loop.exit)
-        loop.exec()
+        proc.finished.connect(
+            functools.partial(self.process_ended, proc=proc, cds_dump_path=cds_dump_path, java=java,
+                              ili2db_bin=ili2db_bin))
+        return proc
 
+    def process_ended(self, exit_code, exit_status, proc, cds_dump_path, java, ili2db_bin):
+        store_cds_archive(cds_dump_path, java, ili2db_bin)
+        self.output_ready(*self.output_parser.finish())
         self.process_finished.emit(proc.exitCode(), self.__result)
-        return self.__result
+        self._ili2db_finished()
+
+    def start_in_worker(self, worker, java_path, java_args):
+        """
+        Runs ili2db in ``worker`` without waiting for it. ``process_finished``
+        is emitted once it ends. Falls back to a process of its own if the
+        worker fails to start.
+        """
+        self.configuration.tool_name = self.tool_name
+
+        args = self.configuration.to_ili2db_args()
+
+        self.process_started.emit(get_safe_command(java_path, java_args + args))
+
+        self.__result = Exporter.ERROR
+        self.output_parser = Ili2dbOutputParser(self.encoding)
+
+        worker.stdout.connect(self.stdout)
+        worker.stderr.connect(self.stderr_text_ready)
+        worker.job_finished.connect(self.worker_job_finished)
+        worker.start_failed.connect(self.worker_start_failed)
+        self.__worker = worker
+        worker.submit(args)
+
+    def release_worker(self):
+        worker, self.__worker = self.__worker, None
+        worker.stdout.disconnect(self.stdout)
+        worker.stderr.disconnect(self.stderr_text_ready)
+        worker.job_finished.disconnect(self.worker_job_finished)
+        worker.start_failed.disconnect(self.worker_start_failed)
+
+    def worker_job_finished(self, exit_code):
+        self.release_worker()
+        self.output_ready(*self.output_parser.finish())
+
+        self.process_finished.emit(exit_code, self.__result)
+        self._ili2db_finished()
+
+    def worker_start_failed(self):
+        self.release_worker()
+        if self.__canceled:
+            self.process_finished.emit(1, Exporter.ERROR)
+            self._ili2db_finished()
+            return
+
+        self.stderr.emit(self.tr('The ili2db worker could not be started, ili2db runs in a process of its own'))
+        try:
+            self.start(self.__ili2db_bin, self.__java_path)
+        except JavaNotFoundError:
+            self.stderr.emit(self.tr('Java could not be found'))
+            self.process_finished.emit(1, Exporter.ERROR)
+            self._ili2db_finished()
 
     def stderr_ready(self, proc):
-        text = bytes(proc.readAllStandardError()).decode(self.encoding)
-        if not self.__done_pattern:
-            self.__done_pattern = re.compile(r"Info: ...export done")
-        if self.__done_pattern.search(text):
-            self.__result = Exporter.SUCCESS
+        self.stderr_text_ready(bytes(proc.readAllStandardError()))
 
-        self.stderr.emit(text)
+    def stderr_text_ready(self, text):
+        self.output_ready(*self.output_parser.feed(text))
+
+    def output_ready(self, text, events):
+        if text:
+            self.stderr.emit(text)
+        for event in events:
+            if event.kind == ili2dbevents.DONE and event.action == 'export':
+                self.__result = Exporter.SUCCESS
+            self.progress_event.emit(event)
 
     def stdout_ready(self, proc):
         text = bytes(proc.readAllStandardOutput()).decode(self.encoding)
         self.stdout.emit(text)
+
+
+BatchExportResult = collections.namedtuple('BatchExportResult', ['partition', 'xtffile', 'exit_code', 'result',
+                                                                 'seconds'])
+
+
+class BatchExporter(QObject):
+    """
+    Exports every dataset or basket of a schema into its own transfer file
+    with a pool of ili2db processes and optionally merges them into
+    ``configuration.xtffile`` afterwards.
+
+    On PostgreSQL the processes are asked to read the snapshot of one
+    transaction, which is kept open during the export. ili2db imports the
+    snapshot with its pre script and its post script makes the export of a
+    partition fail if ili2db did not read from that snapshot until the end.
+    """
+
+    stdout = pyqtSignal(str)
+    stderr = pyqtSignal(str)
+    file_started = pyqtSignal(str)
+    file_finished = pyqtSignal(str, int, float)
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self.tool_name = None
+        self.configuration = ExportConfiguration()
+        # 'dataset' or 'basket'
+        self.partition_by = 'dataset'
+        # 0 for one process per CPU
+        self.max_processes = 0
+        self.merge = True
+        self.consistent_snapshot = True
+
+    def process_count(self):
+        return self.max_processes or os.cpu_count() or 1
+
+    def partition_file(self, partition):
+        stem, extension = os.path.splitext(self.configuration.xtffile)
+        return '{}_{}{}'.format(stem, re.sub(r'[^\w.-]', '_', partition), extension)
+
+    def db_connector(self):
+        if self.tool_name == 'ili2pg':
+            return pg_connector.PGConnector(self.configuration.uri,
+                                            self.configuration.dbschema or self.configuration.database)
+        return gpkg_connector.GPKGConnector(self.configuration.uri, None)
+
+    def run(self):
+        """
+        Exports all datasets or baskets and returns a BatchExportResult for
+        each of them, or ``None`` if ili2db is not available. A schema without
+        baskets is exported as a whole.
+
+        Raises a JavaNotFoundError before anything is started if Java is
+        missing or too old.
+        """
+        ili2db_bin = get_ili2db_bin(self.tool_name, self.stdout, self.stderr, ili2db_tools)
+        if not ili2db_bin:
+            return None
+
+        java_path = get_java_runtime(self.configuration.base_configuration.java_path).path
+
+        self.configuration.tool_name = self.tool_name
+        connector = self.db_connector()
+        pre_script = None
+        post_script = None
+        try:
+            if self.tool_name == 'ili2pg' and self.consistent_snapshot:
+                snapshot = connector.export_snapshot()
+                with tempfile.NamedTemporaryFile('w', suffix='.sql', delete=False) as f:
+                    f.write("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;\n")
+                    f.write("SET TRANSACTION SNAPSHOT '{}';\n".format(snapshot))
+                    pre_script = f.name
+                # Whether ili2db reads in the transaction of its pre script is
+                # not documented. If it does not, it sees another snapshot here
+                # and the cast of the message fails the export.
+                with tempfile.NamedTemporaryFile('w', suffix='.sql', delete=False) as f:
+                    f.write("SELECT (CASE WHEN txid_current_snapshot()::text = '{}' THEN NULL "
+                            "ELSE 'ili2db did not export the snapshot of the batch export' END)::integer;\n".format(
+                                connector.transaction_snapshot()))
+                    post_script = f.name
+
+            if self.partition_by == 'basket':
+                partitions = connector.get_baskets()
+            else:
+                partitions = connector.get_datasets()
+
+            if partitions:
+                xtffiles = [self.partition_file(partition) for partition in partitions]
+            else:
+                partitions = ['']
+                xtffiles = [self.configuration.xtffile]
+
+            exporters = list()
+            for partition, xtffile in zip(partitions, xtffiles):
+                exporter = Exporter(parent=self)
+                exporter.tool_name = self.tool_name
+                exporter.configuration = copy.copy(self.configuration)
+                exporter.configuration.xtffile = xtffile
+                if self.partition_by == 'basket':
+                    exporter.configuration.baskets = partition
+                else:
+                    exporter.configuration.dataset = partition
+                if pre_script:
+                    exporter.configuration.pre_script = pre_script
+                    exporter.configuration.post_script = post_script
+
+                name = os.path.basename(xtffile)
+                exporter.stdout.connect(functools.partial(self.forward_output, signal=self.stdout, name=name))
+                exporter.stderr.connect(functools.partial(self.forward_output, signal=self.stderr, name=name))
+                exporters.append(exporter)
+
+            def finished(index, exit_code, result, seconds):
+                exporters[index].deleteLater()
+                self.file_finished.emit(xtffiles[index], result, seconds)
+
+            results = run_ili2db_pool(exporters, ili2db_bin, java_path, self.process_count(),
+                                      on_started=lambda index: self.file_started.emit(xtffiles[index]),
+                                      on_finished=finished)
+        finally:
+            # Ends the snapshot
+            connector.conn.close()
+            for script in (pre_script, post_script):
+                if script:
+                    os.remove(script)
+
+        results = [BatchExportResult(partition, xtffile, exit_code, result, seconds)
+                   for partition, xtffile, (exit_code, result, seconds) in zip(partitions, xtffiles, results)]
+
+        if self.merge and partitions != [''] and all(result.result == Exporter.SUCCESS for result in results):
+            self.merge_files(xtffiles)
+
+        return results
+
+    def merge_files(self, xtffiles):
+        if os.path.splitext(self.configuration.xtffile)[1].lower() not in ('.xtf', '.xml'):
+            self.stderr.emit(self.tr('Only INTERLIS 2 transfer files can be merged, the exported files are kept.'))
+            return
+
+        try:
+            merge_xtf_files(xtffiles, self.configuration.xtffile)
+        except (OSError, ValueError) as e:
+            self.stderr.emit(self.tr('The exported files could not be merged: {}').format(e))
+            return
+
+        for xtffile in xtffiles:
+            os.remove(xtffile)
+        self.stdout.emit(self.tr('Merged {count} files into {xtffile}').format(
+            count=len(xtffiles), xtffile=self.configuration.xtffile))
+
+    def forward_output(self, text, signal, name):
+        signal.emit(''.join('{}: {}'.format(name, line) for line in text.splitlines(True)))
@@ -17,14 +17,30 @@
  *                                                                         *
  ***************************************************************************/
 """
-import os
 
-import re
+import os
+import copy
+import sqlite3
 import locale
 import functools
+import collections
+import psycopg2
 
-from projectgenerator.libili2db.ili2dbutils import get_ili2db_bin
-from qgis.PyQt.QtCore import QObject, pyqtSignal, QProcess, QEventLoop
+from projectgenerator.libili2db.ili2dbutils import (
+    get_ili2db_bin,
+    get_cds_args,
+    get_safe_command,
+    store_cds_archive,
+    run_ili2db_pool,
+    run_task,
+    kill_process_tree
+)
+from projectgenerator.libili2db import ili2dbevents
+from projectgenerator.libili2db.ili2dbevents import Ili2dbOutputParser
+from projectgenerator.libili2db.iliworker import get_ili2db_worker
+from projectgenerator.libili2db.gpkgtemplates import GpkgTemplateStore
+from projectgenerator.libili2db.javaruntime import get_java_runtime, invalidate_java_runtimes
+from qgis.PyQt.QtCore import QObject, pyqtSignal, QProcess, QEventLoop, QTimer
 
 from projectgenerator.libili2db.ili2dbconfig import (
         SchemaImportConfiguration,
@@ -32,6 +48,8 @@ from projectgenerator.libili2db.ili2dbconfig import (
         JavaNotFoundError,
         ili2db_tools
 )
+from projectgenerator.libqgsprojectgen.dbconnector import pg_connector, gpkg_connector
+from projectgenerator.libqgsprojectgen.generator.config import TEMPLATE_SCHEMA_PREFIX
 
 
 class Importer(QObject):
@@ -43,9 +61,29 @@ class Importer(QObject):
     stderr = pyqtSignal(str)
     process_started = pyqtSignal(str)
     process_finished = pyqtSignal(int, int)
+    # Ili2dbEvent for every line ili2db writes to stderr
+    progress_event = pyqtSignal(object)
+    # Result of start_run() once all its steps are done
+    run_finished = pyqtSignal(int)
+
+    # Milliseconds between attempts to lock the template schema
+    lock_retry_interval = 200
 
-    __done_pattern = None
     __result = None
+    # Whether ili2db creates the GeoPackage
+    __new_gpkg = False
+    # Whether the indexes and foreign keys are rebuilt after the import
+    __deferred = False
+    # What currently runs ili2db, ended by cancel()
+    __proc = None
+    __worker = None
+    __template_importer = None
+    __canceled = False
+    # State of start_run()
+    __ili2db_bin = None
+    __java_path = None
+    __task = None
+    __on_ili2db_finished = None
 
     def __init__(self, dataImport=False, parent=None):
         QObject.__init__(self, parent)
@@ -56,82 +94,747 @@ class Importer(QObject):
             self.configuration = ImportDataConfiguration()
         else:
             self.configuration = SchemaImportConfiguration()
+        self.output_parser = None
         self.encoding = locale.getlocale()[1]
         # This might be unset
         # (https://stackoverflow.com/questions/1629699/locale-getlocale-problems-on-osx)
         if not self.encoding:
             self.encoding = 'UTF8'
 
+    def can_start(self):
+        """
+        Whether ``start()`` does the same as ``run()``. Otherwise the run takes
+        more steps than one ili2db process, e.g. for a template or a worker,
+        and needs ``run()`` or ``start_run()``. Indexes and foreign keys left
+        by an interrupted deferred import are only looked for by the latter.
+        """
+        if self.configuration.base_configuration.jvm_worker_enabled:
+            return False
+        if (not self.dataImport and self.tool_name == 'ili2pg' and self.configuration.use_template_schema and
+                self.configuration.can_reuse_schema()):
+            return False
+        if not self.dataImport and self.gpkg_template_store() and self.configuration.can_reuse_schema():
+            return False
+        if self.dataImport and self.tool_name == 'ili2pg' and self.configuration.defer_indexes:
+            return False
+        return True
+
+    def cancel(self):
+        """
+        Ends a running ``run()``, ``start_run()`` or ``start()``, which then
+        finishes with an error result. Deferred indexes and foreign keys are
+        still rebuilt.
+        """
+        self.__canceled = True
+        if self.__template_importer:
+            self.__template_importer.cancel()
+        if self.__worker:
+            self.__worker.kill()
+        if self.__proc and self.__proc.state() != QProcess.NotRunning:
+            kill_process_tree(self.__proc)
+
     def run(self):
+        """
+        Runs the import and returns its result once it is finished, ``None``
+        if ili2db is not available. Meant for scripts without a running event
+        loop, see ``start_run()``.
+
+        Raises a JavaNotFoundError before anything is started if Java is
+        missing or too old.
+        """
         ili2db_bin = get_ili2db_bin(self.tool_name, self.stdout, self.stderr, ili2db_tools)
         if not ili2db_bin:
             return
+        java_path = get_java_runtime(self.configuration.base_configuration.java_path).path
+
+        result = list()
+        loop = QEventLoop()
+
+        def finished(run_result):
+            result.append(run_result)
+            loop.quit()
+
+        self.run_finished.connect(finished)
+        self.start_run(ili2db_bin, java_path)
+        if not result:
+            loop.exec()
+        self.run_finished.disconnect(finished)
+        return result[0]
+
+    def start_run(self, ili2db_bin, java_path):
+        """
+        Runs the same steps as ``run()`` without waiting for them and emits
+        ``run_finished`` with the result once all of them are done. The
+        database work of the steps runs in background tasks.
+        """
+        self.__ili2db_bin = ili2db_bin
+        self.__java_path = java_path
+        self.configuration.tool_name = self.tool_name
+
+        if self.__canceled:
+            self._finish_run(Importer.ERROR)
+        elif (not self.dataImport and self.tool_name == 'ili2pg' and self.configuration.use_template_schema and
+                self.configuration.can_reuse_schema()):
+            self._run_step(self.tr('Connect to template schema'), self._connect_template_schema,
+                           self._template_schema_connected)
+        elif not self.dataImport and self.run_from_gpkg_template():
+            self._finish_run(Importer.SUCCESS)
+        elif self.dataImport and self.tool_name == 'ili2pg' and self.configuration.defer_indexes:
+            self._run_step(self.tr('Drop indexes and foreign keys'), self._drop_indexes, self._indexes_dropped)
+        elif self.dataImport and self.tool_name == 'ili2pg':
+            self._run_step(self.tr('Find dropped indexes and foreign keys'), self._find_pending_indexes,
+                           self._pending_indexes_found)
+        else:
+            self._start_ili2db(self._finish_run)
+
+    def _run_step(self, description, function, on_finished, *args):
+        """
+        Runs ``function(*args)`` in a background task and calls
+        ``on_finished(exception, result)`` once it ended.
+        """
+        def finished(exception, result):
+            self.__task = None
+            on_finished(exception, result)
+
+        self.__task = run_task(description, function, finished, *args)
+
+    def _start_ili2db(self, on_finished):
+        """
+        Starts ili2db in the worker or a process of its own and calls
+        ``on_finished(result)`` once it ended.
+        """
+        self.__on_ili2db_finished = on_finished
+        if self.__canceled:
+            self._ili2db_finished()
+            return
+
+        try:
+            java = get_java_runtime(self.__java_path)
+            base_configuration = self.configuration.base_configuration
+            # The worker is compiled from source at startup, which needs Java 11
+            if base_configuration.jvm_worker_enabled and java.major_version >= 11:
+                # Workers run many jobs, they only use the options not depending on the input
+                worker_jvm_args = base_configuration.to_jvm_args()
+                worker = get_ili2db_worker(java.path, self.__ili2db_bin, self.encoding, worker_jvm_args)
+                if worker:
+                    self.start_in_worker(worker, java.path, worker_jvm_args + ["-jar", self.__ili2db_bin])
+                    return
+            self.start(self.__ili2db_bin, self.__java_path)
+        except JavaNotFoundError:
+            self.stderr.emit(self.tr('Java could not be found'))
+            self.__result = Importer.ERROR
+            self._ili2db_finished()
+
+    def _ili2db_finished(self):
+        on_finished, self.__on_ili2db_finished = self.__on_ili2db_finished, None
+        if on_finished:
+            on_finished(Importer.ERROR if self.__canceled else self.__result)
+
+    def _finish_run(self, result):
+        self.run_finished.emit(Importer.ERROR if self.__canceled or result is None else result)
+
+    def _connect_template_schema(self):
+        """
+        Returns a connector to the template schema, ``None`` if the target
+        schema exists and gets a regular schema import.
+        """
+        if self.schema_exists():
+            return None
+        return pg_connector.PGConnector(self.configuration.uri, self.configuration.template_schema)
+
+    def _template_schema_connected(self, exception, connector):
+        if exception is not None:
+            self._template_failed(exception)
+        elif connector is None:
+            # Existing schemas get a regular schema import
+            self._start_ili2db(self._finish_run)
+        else:
+            # Schemas are cloned from the template in parallel while holding a
+            # shared lock, it is only set up with the exclusive lock
+            self._lock_template_schema(connector, True, self._template_schema_shared_locked)
+
+    def _lock_template_schema(self, connector, shared, on_locked):
+        """
+        Tries to lock the template schema every ``lock_retry_interval``
+        milliseconds and calls ``on_locked(connector)`` once it is locked.
+        Waiting does not block the event loop or a task.
+        """
+        if self.__canceled:
+            connector.conn.close()
+            self._finish_run(Importer.ERROR)
+            return
+
+        try:
+            locked = connector.try_lock_schema(shared)
+        except psycopg2.Error as e:
+            connector.conn.close()
+            self._template_failed(e)
+            return
+
+        if locked:
+            on_locked(connector)
+        else:
+            QTimer.singleShot(self.lock_retry_interval,
+                              functools.partial(self._lock_template_schema, connector, shared, on_locked))
+
+    def _template_schema_shared_locked(self, connector):
+        try:
+            unchanged = connector.get_schema_fingerprint() == self.configuration.schema_fingerprint()
+            if not unchanged:
+                connector.conn.commit()
+                connector.unlock_schema(shared=True)
+        except psycopg2.Error as e:
+            connector.conn.close()
+            self._template_failed(e)
+            return
+
+        if unchanged:
+            self._clone_from_template(connector, False)
+        else:
+            self._lock_template_schema(connector, False, self._template_schema_locked)
+
+    def _template_schema_locked(self, connector):
+        try:
+            # Another import may have set it up while waiting for the lock
+            setup = connector.get_schema_fingerprint() != self.configuration.schema_fingerprint()
+            connector.conn.commit()
+        except psycopg2.Error as e:
+            connector.conn.close()
+            self._template_failed(e)
+            return
+
+        if setup:
+            self.setup_template_schema(connector)
+        else:
+            self._clone_from_template(connector, True)
+
+    def _template_failed(self, error):
+        self.stderr.emit(self.tr('The schema could not be cloned from {template}: {error}').format(
+            template=self.configuration.template_schema, error=error))
+        self._finish_run(Importer.ERROR)
+
+    def setup_template_schema(self, connector):
+        """
+        Runs the schema import into the template schema while ``connector``
+        holds the exclusive lock on it.
+        """
+        importer = Importer(parent=self)
+        importer.tool_name = self.tool_name
+        importer.configuration = copy.copy(self.configuration)
+        importer.configuration.dbschema = self.configuration.template_schema
+        importer.configuration.use_template_schema = False
+        importer.stdout.connect(self.stdout)
+        importer.stderr.connect(self.stderr)
+        importer.process_started.connect(self.process_started)
+        importer.process_finished.connect(self.process_finished)
+        importer.progress_event.connect(self.progress_event)
+        importer.run_finished.connect(functools.partial(self._template_schema_set_up, connector=connector))
+        self.__template_importer = importer
+        importer.start_run(self.__ili2db_bin, self.__java_path)
+
+    def _template_schema_set_up(self, result, connector):
+        self.__template_importer.deleteLater()
+        self.__template_importer = None
+        if result != Importer.SUCCESS or self.__canceled:
+            # Releases the lock
+            connector.conn.close()
+            self._finish_run(result)
+        else:
+            self._clone_from_template(connector, True)
+
+    def _clone_from_template(self, connector, exclusive):
+        self.stdout.emit(self.tr('Cloning schema {schema} from {template}').format(
+            schema=self.configuration.dbschema or self.configuration.database,
+            template=self.configuration.template_schema))
+        self._run_step(self.tr('Clone schema'), self._clone_schema, self._schema_cloned, connector, exclusive)
+
+    def _clone_schema(self, connector, exclusive):
+        """
+        Clones the template and returns the template schemas which were
+        dropped afterwards, or the error which prevented it.
+        """
+        try:
+            if exclusive:
+                # Others may clone the template from now on, the session
+                # holding the exclusive lock gets the shared one right away
+                connector.lock_schema(shared=True)
+                connector.unlock_schema()
+            connector.clone_schema(self.configuration.dbschema or self.configuration.database)
+            try:
+                connector.mark_schema_used()
+                if exclusive:
+                    # A template has been set up, old ones may be dropped
+                    return connector.prune_template_schemas(
+                        TEMPLATE_SCHEMA_PREFIX, self.configuration.base_configuration.pg_template_schema_count)
+            except psycopg2.Error as e:
+                return e
+        finally:
+            connector.conn.close()
+
+    def _schema_cloned(self, exception, result):
+        if exception is not None:
+            self._template_failed(exception)
+            return
+
+        if isinstance(result, psycopg2.Error):
+            self.stderr.emit(self.tr('Unused template schemas could not be removed: {}').format(result))
+        elif result:
+            self.stdout.emit(self.tr('Removed unused template schemas {}').format(', '.join(result)))
+        self._finish_run(Importer.SUCCESS)
+
+    def _indexes_dropped(self, exception, deferred):
+        if exception is not None:
+            self.stderr.emit(self.tr('The indexes and foreign keys could not be dropped: {}').format(exception))
+            self._finish_run(Importer.ERROR)
+            return
+        if not deferred:
+            self._start_ili2db(self._finish_run)
+            return
+
+        self._report_dropped_indexes(deferred)
+        self.__deferred = True
+        self._start_ili2db(functools.partial(self._deferred_import_finished, deferred=deferred))
+
+    def _deferred_import_finished(self, result, deferred):
+        self.__deferred = False
+        self._start_rebuild(deferred, lambda errors: self._finish_run(Importer.ERROR if errors else result))
+
+    def _pending_indexes_found(self, exception, pending):
+        if exception is not None:
+            self.stderr.emit(self.tr('Rebuilding indexes and foreign keys failed: {}').format(exception))
+        if not pending:
+            self._start_ili2db(self._finish_run)
+            return
+
+        self.stdout.emit(self.tr('Found indexes and foreign keys dropped by an interrupted import'))
+        self._start_rebuild(pending, lambda errors: self._start_ili2db(self._finish_run))
+
+    def _start_rebuild(self, deferred, on_finished):
+        """
+        Rebuilds ``deferred`` in a background task and calls
+        ``on_finished(errors)`` once it ended.
+        """
+        def rebuilt(exception, errors):
+            errors = [str(exception)] if exception is not None else errors or list()
+            self._report_rebuild_errors(errors)
+            on_finished(errors)
+
+        self.stdout.emit(self.tr('Rebuilding indexes and foreign keys…'))
+        self._run_step(self.tr('Rebuild indexes and foreign keys'), self._rebuild_indexes, rebuilt, deferred)
+
+    def defer_indexes(self):
+        """
+        Drops the indexes and foreign keys of the data tables and returns
+        them, or ``None`` if the schema does not exist yet. Their definitions
+        are stored in the schema until they are rebuilt.
+        """
+        deferred = self._drop_indexes()
+        self._report_dropped_indexes(deferred)
+        return deferred
+
+    def rebuild_pending_indexes(self):
+        """
+        Rebuilds the indexes and foreign keys dropped by an import which was
+        interrupted before they were rebuilt. Returns the errors.
+        """
+        try:
+            deferred = self._find_pending_indexes()
+        except psycopg2.Error as e:
+            deferred = None
+            self.stderr.emit(self.tr('Rebuilding indexes and foreign keys failed: {}').format(e))
+
+        if not deferred:
+            return list()
+        self.stdout.emit(self.tr('Found indexes and foreign keys dropped by an interrupted import'))
+        return self.rebuild_indexes(deferred)
+
+    def rebuild_indexes(self, deferred):
+        self.stdout.emit(self.tr('Rebuilding indexes and foreign keys…'))
+        try:
+            errors = self._rebuild_indexes(deferred)
+        except psycopg2.Error as e:
+            errors = [str(e)]
+        self._report_rebuild_errors(errors)
+        return errors
+
+    def _drop_indexes(self):
+        connector = self.db_connector()
+        try:
+            return connector.defer_indexes_and_foreign_keys() if connector.metadata_exists() else None
+        finally:
+            connector.conn.close()
+
+    def _find_pending_indexes(self):
+        connector = self.db_connector()
+        try:
+            return connector.get_deferred_indexes() if connector.metadata_exists() else None
+        finally:
+            connector.conn.close()
+
+    def _rebuild_indexes(self, deferred):
+        connector = self.db_connector()
+        try:
+            return connector.rebuild_indexes_and_foreign_keys(deferred, os.cpu_count() or 1)
+        finally:
+            connector.conn.close()
+
+    def _report_dropped_indexes(self, deferred):
+        if deferred:
+            self.stdout.emit(self.tr('Dropped {indexes} indexes and {foreign_keys} foreign keys for the import').format(
+                indexes=len(deferred.indexes), foreign_keys=len(deferred.foreign_keys)))
+
+    def _report_rebuild_errors(self, errors):
+        for error in errors:
+            self.stderr.emit(self.tr('Rebuilding indexes and foreign keys failed: {}').format(error))
+
+    def ili2db_args(self):
+        return self.configuration.to_ili2db_args(with_indexes=not self.__deferred)
 
+    def start(self, ili2db_bin, java_path):
+        """
+        Starts ili2db in a new process and returns the process without waiting
+        for it. ``process_finished`` is emitted once it ends.
+        """
         ili2db_jar_arg = ["-jar", ili2db_bin]
 
         self.configuration.tool_name = self.tool_name
 
-        args = self.configuration.to_ili2db_args()
+        args = self.ili2db_args()
 
         if self.dataImport:
             args += [self.configuration.xtffile]
 
-        if self.configuration.base_configuration.java_path:
-            # A java path is configured: respect it no mather what
-            java_paths = [self.configuration.base_configuration.java_path]
+        jvm_args = self.configuration.to_jvm_args()
+
+        self.prepare_gpkg()
+
+        proc = QProcess(self)
+        proc.readyReadStandardError.connect(
+            functools.partial(self.stderr_ready, proc=proc))
+        proc.readyReadStandardOutput.connect(
+            functools.partial(self.stdout_ready, proc=proc))
+
+        if self.configuration.base_configuration.class_data_sharing_enabled:
+            java = get_java_runtime(java_path)
+            cds_args, cds_dump_path = get_cds_args(java, ili2db_bin)
         else:
-            # By default try JAVA_HOME and PATH
-            java_paths = []
-            if 'JAVA_HOME' in os.environ:
-                paths = os.environ['JAVA_HOME'].split(os.pathsep)
-                for path in paths:
-                    java_paths += [os.path.join(path.replace("\"",
-                                                             "").replace("'", ""), 'java')]
-            java_paths += ['java']
-
-        proc = None
-        for java_path in java_paths:
-            proc = QProcess()
-            proc.readyReadStandardError.connect(
-                functools.partial(self.stderr_ready, proc=proc))
-            proc.readyReadStandardOutput.connect(
-                functools.partial(self.stdout_ready, proc=proc))
-
-            proc.start(java_path, ili2db_jar_arg + args)
-
-            if not proc.waitForStarted():
-                proc = None
-            else:
-                break
-
-        if not proc:
+            java, cds_args, cds_dump_path = None, list(), None
+
+        command_args = jvm_args + cds_args + ili2db_jar_arg + args
+        proc.start(java_path, command_args)
+
+        if not proc.waitForStarted():
+            invalidate_java_runtimes()
             raise JavaNotFoundError()
+        self.__proc = proc
 
-        safe_args = ili2db_jar_arg + self.configuration.to_ili2db_args(hide_password=True)
-        safe_command = java_path + ' ' + ' '.join(safe_args)
-        self.process_started.emit(safe_command)
+        self.process_started.emit(get_safe_command(java_path, command_args))
 
         self.__result = Importer.ERROR
+        self.output_parser = Ili2dbOutputParser(self.encoding)
 
-        loop = QEventLoop()
-        proc.finished.connect(loop.exit)
-        loop.exec()
+        proc.finished.connect(
+            functools.partial(self.process_ended, proc=proc, cds_dump_path=cds_dump_path, java=java,
+                              ili2db_bin=ili2db_bin))
+        return proc
 
+    def process_ended(self, exit_code, exit_status, proc, cds_dump_path, java, ili2db_bin):
+        store_cds_archive(cds_dump_path, java, ili2db_bin)
+        self.output_ready(*self.output_parser.finish())
+        self.store_schema_fingerprint()
+        self.store_gpkg_template()
         self.process_finished.emit(proc.exitCode(), self.__result)
-        return self.__result
+        self._ili2db_finished()
+
+    def schema_exists(self):
+        connector = self.db_connector()
+        try:
+            return connector.db_or_schema_exists()
+        finally:
+            connector.conn.close()
+
+    def db_connector(self):
+        self.configuration.tool_name = self.tool_name
+        if self.tool_name == 'ili2pg':
+            return pg_connector.PGConnector(self.configuration.uri,
+                                            self.configuration.dbschema or self.configuration.database)
+        return gpkg_connector.GPKGConnector(self.configuration.uri, None)
+
+    def schema_unchanged(self):
+        """
+        Whether the target schema was created by a schema import with the same
+        models and options, in which case running it again can be skipped.
+        """
+        self.configuration.tool_name = self.tool_name
+        if not self.configuration.can_reuse_schema():
+            return False
+        if self.tool_name == 'ili2gpkg' and not os.path.isfile(self.configuration.dbfile):
+            return False
+
+        try:
+            connector = self.db_connector()
+            try:
+                fingerprint = connector.get_schema_fingerprint()
+            finally:
+                connector.conn.close()
+        except (psycopg2.Error, sqlite3.Error):
+            return False
+
+        return fingerprint == self.configuration.schema_fingerprint()
+
+    def store_schema_fingerprint(self):
+        if self.dataImport or self.__result != Importer.SUCCESS:
+            return
+
+        try:
+            connector = self.db_connector()
+            try:
+                connector.set_schema_fingerprint(self.configuration.schema_fingerprint())
+            finally:
+                connector.conn.close()
+        except (psycopg2.Error, sqlite3.Error) as e:
+            self.stderr.emit(self.tr('The fingerprint of the schema could not be stored: {}').format(e))
+
+    def gpkg_template_store(self):
+        base_configuration = self.configuration.base_configuration
+        if self.tool_name != 'ili2gpkg' or not base_configuration.gpkg_templates_enabled:
+            return None
+        return GpkgTemplateStore(base_configuration.gpkg_template_path,
+                                 base_configuration.gpkg_template_cache_size * 1024 * 1024)
+
+    def copy_gpkg_template(self):
+        """
+        Creates a new GeoPackage from the template for the models and options
+        and returns the path of the template, ``None`` if there was none.
+        """
+        store = self.gpkg_template_store()
+        if not store or os.path.exists(self.configuration.dbfile) or not self.configuration.can_reuse_schema():
+            return None
+
+        self.configuration.tool_name = self.tool_name
+        fingerprint = self.configuration.schema_fingerprint()
+        if not store.copy_to(fingerprint, self.configuration.dbfile):
+            return None
+        return store.template_path(fingerprint)
+
+    def run_from_gpkg_template(self):
+        """
+        Runs the schema import by copying the template for the models and
+        options if there is one, reported like an ili2db run. Returns whether
+        there was one.
+        """
+        template = self.copy_gpkg_template()
+        if not template:
+            return False
+
+        self.process_started.emit(self.tr('Copying {template} to {dbfile}').format(
+            template=template, dbfile=self.configuration.dbfile))
+        self.stdout.emit(self.tr('Created {} from a template with the same models and options').format(
+            self.configuration.dbfile))
+        self.process_finished.emit(0, Importer.SUCCESS)
+        return True
+
+    def prepare_gpkg(self):
+        self.__new_gpkg = self.tool_name == 'ili2gpkg' and not os.path.exists(self.configuration.dbfile)
+        # Data imports into new GeoPackages only fill in the data
+        if self.__new_gpkg and self.dataImport and self.copy_gpkg_template():
+            self.stdout.emit(self.tr('Created {} from a template with the same models and options').format(
+                self.configuration.dbfile))
+
+    def store_gpkg_template(self):
+        store = self.gpkg_template_store()
+        if (not store or not self.__new_gpkg or self.dataImport or self.__result != Importer.SUCCESS or
+                self.configuration.model_versions is None):
+            return
+
+        try:
+            store.add(self.configuration.schema_fingerprint(), self.configuration.dbfile)
+        except OSError as e:
+            self.stderr.emit(self.tr('The GeoPackage could not be stored as template: {}').format(e))
+
+    def start_in_worker(self, worker, java_path, java_args):
+        """
+        Runs ili2db in ``worker`` without waiting for it. ``process_finished``
+        is emitted once it ends. Falls back to a process of its own if the
+        worker fails to start.
+        """
+        args = self.ili2db_args()
+
+        if self.dataImport:
+            args += [self.configuration.xtffile]
+
+        self.prepare_gpkg()
+
+        self.process_started.emit(get_safe_command(java_path, java_args + args))
+
+        self.__result = Importer.ERROR
+        self.output_parser = Ili2dbOutputParser(self.encoding)
+
+        worker.stdout.connect(self.stdout)
+        worker.stderr.connect(self.stderr_text_ready)
+        worker.job_finished.connect(self.worker_job_finished)
+        worker.start_failed.connect(self.worker_start_failed)
+        self.__worker = worker
+        worker.submit(args)
+
+    def release_worker(self):
+        worker, self.__worker = self.__worker, None
+        worker.stdout.disconnect(self.stdout)
+        worker.stderr.disconnect(self.stderr_text_ready)
+        worker.job_finished.disconnect(self.worker_job_finished)
+        worker.start_failed.disconnect(self.worker_start_failed)
+
+    def worker_job_finished(self, exit_code):
+        self.release_worker()
+        self.output_ready(*self.output_parser.finish())
+        self.store_schema_fingerprint()
+        self.store_gpkg_template()
+
+        self.process_finished.emit(exit_code, self.__result)
+        self._ili2db_finished()
+
+    def worker_start_failed(self):
+        self.release_worker()
+        if self.__canceled:
+            self.process_finished.emit(1, Importer.ERROR)
+            self._ili2db_finished()
+            return
+
+        self.stderr.emit(self.tr('The ili2db worker could not be started, ili2db runs in a process of its own'))
+        try:
+            self.start(self.__ili2db_bin, self.__java_path)
+        except JavaNotFoundError:
+            self.stderr.emit(self.tr('Java could not be found'))
+            self.process_finished.emit(1, Importer.ERROR)
+            self._ili2db_finished()
 
     def stderr_ready(self, proc):
-        text = bytes(proc.readAllStandardError()).decode(self.encoding)
-        if not self.__done_pattern:
-            if self.dataImport:
-                self.__done_pattern = re.compile(r"Info: \.\.\.import done")
-            else:
-                self.__done_pattern = re.compile(r"Info: \.\.\.done")
-        if self.__done_pattern.search(text):
-            self.__result = Importer.SUCCESS
+        self.stderr_text_ready(bytes(proc.readAllStandardError()))
 
-        self.stderr.emit(text)
+    def stderr_text_ready(self, text):
+        self.output_ready(*self.output_parser.feed(text))
+
+    def output_ready(self, text, events):
+        if text:
+            self.stderr.emit(text)
+        for event in events:
+            if event.kind == ili2dbevents.DONE and event.action == ('import' if self.dataImport else None):
+                self.__result = Importer.SUCCESS
+            self.progress_event.emit(event)
 
     def stdout_ready(self, proc):
         text = bytes(proc.readAllStandardOutput()).decode(self.encoding)
         self.stdout.emit(text)
+
+
+BatchImportResult = collections.namedtuple('BatchImportResult', ['xtffile', 'dataset', 'exit_code', 'result', 'seconds'])
+
+
+class BatchImporter(QObject):
+    """
+    Imports many transfer files into the same database with a pool of ili2db
+    processes.
+
+    The first file is imported alone, it sets up the schema if needed and is
+    the only one deleting existing data if requested. The others are imported
+    by up to ``process_count()`` processes at the same time. A failing file
+    does not stop the others. With ``defer_indexes`` the indexes and foreign
+    keys of the data tables are dropped after the first file and rebuilt once
+    all files are imported.
+    """
+
+    stdout = pyqtSignal(str)
+    stderr = pyqtSignal(str)
+    file_started = pyqtSignal(str)
+    file_finished = pyqtSignal(str, int, float)
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self.tool_name = None
+        self.configuration = ImportDataConfiguration()
+        # Transfer files with their dataset names
+        self.files = list()
+        # 0 for one process per CPU
+        self.max_processes = 0
+
+    def add_file(self, xtffile, dataset=''):
+        self.files.append((xtffile, dataset))
+
+    def process_count(self):
+        if self.tool_name == 'ili2gpkg':
+            # A GeoPackage only takes one writer at a time
+            return 1
+        return self.max_processes or os.cpu_count() or 1
+
+    def run(self):
+        """
+        Imports all files and returns a BatchImportResult for each of them in
+        the order they were added, or ``None`` if ili2db is not available.
+
+        Raises a JavaNotFoundError before anything is started if Java is
+        missing or too old.
+        """
+        ili2db_bin = get_ili2db_bin(self.tool_name, self.stdout, self.stderr, ili2db_tools)
+        if not ili2db_bin:
+            return None
+
+        java_path = get_java_runtime(self.configuration.base_configuration.java_path).path
+
+        # The indexes and foreign keys are dropped once the first file has set
+        # up the schema and rebuilt after the last file
+        index_importer = None
+        deferred = None
+        if self.tool_name == 'ili2pg':
+            index_importer = Importer(dataImport=True, parent=self)
+            index_importer.tool_name = self.tool_name
+            index_importer.configuration = copy.copy(self.configuration)
+            index_importer.configuration.tool_name = self.tool_name
+            index_importer.stdout.connect(self.stdout)
+            index_importer.stderr.connect(self.stderr)
+            index_importer.rebuild_pending_indexes()
+
+        process_count = min(self.process_count(), max(len(self.files) - 1, 1))
+        importers = list()
+        for index, (xtffile, dataset) in enumerate(self.files):
+            importer = Importer(dataImport=True, parent=self)
+            importer.tool_name = self.tool_name
+            importer.configuration = copy.copy(self.configuration)
+            importer.configuration.defer_indexes = False
+            importer.configuration.xtffile = xtffile
+            importer.configuration.dataset = dataset
+            importer.configuration.delete_data = self.configuration.delete_data and index == 0
+            # The processes running at the same time share the memory
+            importer.configuration.process_count = 1 if index == 0 else process_count
+
+            name = os.path.basename(xtffile)
+            importer.stdout.connect(functools.partial(self.forward_output, signal=self.stdout, name=name))
+            importer.stderr.connect(functools.partial(self.forward_output, signal=self.stderr, name=name))
+            importers.append(importer)
+
+        def finished(index, exit_code, result, seconds):
+            nonlocal deferred
+            importers[index].deleteLater()
+            self.file_finished.emit(self.files[index][0], result, seconds)
+            # Called before the other files are started
+            if index == 0 and self.configuration.defer_indexes and index_importer and len(self.files) > 1:
+                try:
+                    deferred = index_importer.defer_indexes()
+                except psycopg2.Error as e:
+                    self.stderr.emit(self.tr('The indexes and foreign keys could not be dropped: {}').format(e))
+
+        # Nothing runs next to the first file
+        try:
+            results = run_ili2db_pool(importers, ili2db_bin, java_path, process_count, first_alone=True,
+                                      on_started=lambda index: self.file_started.emit(self.files[index][0]),
+                                      on_finished=finished)
+        finally:
+            if deferred:
+                index_importer.rebuild_indexes(deferred)
+            if index_importer:
+                index_importer.deleteLater()
+
+        return [BatchImportResult(xtffile, dataset, exit_code, result, seconds)
+                for (xtffile, dataset), (exit_code, result, seconds) in zip(self.files, results)]
+
+    def forward_output(self, text, signal, name):
+        signal.emit(''.join('{}: {}'.format(name, line) for line in text.splitlines(True)))
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                              -------------------
+        begin                : 18/10/26
+        git sha              : :%H$
+        copyright            : (C) 2026 by OPENGIS.ch
+        email                : info@opengis.ch
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import urllib.parse
+
+from qgis.PyQt.QtCore import QObject, pyqtSignal, QProcess, QEventLoop, QTimer
+
+WORKER_SOURCE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'worker', 'Ili2dbWorker.java')
+READY_MARKER = b'ILI2DB_WORKER_READY'
+DONE_MARKER = b'ILI2DB_WORKER_DONE '
+
+# Running workers by java path and ili2db jar, None if a worker could not be started
+_workers = dict()
+
+
+def get_ili2db_worker(java_path, ili2db_bin, encoding, jvm_args=None):
+    """
+    Returns a running or starting worker for ``ili2db_bin`` or ``None`` if no
+    worker can be started with ``java_path`` and ``jvm_args``, e.g. because
+    Java is older than version 11. A worker which fails while loading emits
+    ``start_failed``. Workers which failed to start are not tried again.
+
+    A worker runs one job at a time, ``None`` is returned as well while it is
+    busy with the job of another caller.
+    """
+    jvm_args = list(jvm_args or list())
+    key = (java_path, ili2db_bin, tuple(jvm_args))
+    if key in _workers and _workers[key] is None:
+        return None
+    worker = _workers.get(key)
+    if worker is None or not worker.running:
+        # Not started yet or ended by ili2db itself
+        worker = Ili2dbWorker(java_path, ili2db_bin, encoding, jvm_args)
+        worker.start_failed.connect(lambda: _workers.get(key) is worker and _workers.update({key: None}))
+        _workers[key] = worker if worker.start() else None
+    elif worker.busy:
+        return None
+    return _workers[key]
+
+
+def shutdown_ili2db_workers():
+    for worker in _workers.values():
+        if worker is not None:
+            worker.shutdown()
+    _workers.clear()
+
+
+class Ili2dbWorker(QObject):
+    """
+    A resident Java process which runs ili2db invocations one after the other
+    without paying the JVM startup and class loading for each of them.
+    """
+
+    stdout = pyqtSignal(str)
+    stderr = pyqtSignal(str)
+    job_finished = pyqtSignal(int)
+    # The worker ended before it was ready, a submitted job has not been run
+    start_failed = pyqtSignal()
+
+    # Milliseconds to wait for the worker to compile and load ili2db
+    start_timeout = 60000
+
+    def __init__(self, java_path, ili2db_bin, encoding, jvm_args=None, parent=None):
+        QObject.__init__(self, parent)
+        self.java_path = java_path
+        self.ili2db_bin = ili2db_bin
+        self.jvm_args = list(jvm_args or list())
+        self.encoding = encoding
+        self.running = False
+        self._ready = False
+        self._stderr_buffer = b''
+        self._proc = None
+        # Submitted before the worker was ready
+        self._queued_job = None
+        self._job_running = False
+        self._start_timer = QTimer(self)
+        self._start_timer.setSingleShot(True)
+        self._start_timer.timeout.connect(self.kill)
+
+    def start(self):
+        """
+        Starts the worker process without waiting until it has loaded ili2db
+        and returns whether it could be started. Jobs submitted until then
+        are run once it is ready, ``start_failed`` is emitted if it ends or
+        does not get ready within ``start_timeout`` milliseconds.
+        """
+        self._proc = QProcess()
+        self._proc.readyReadStandardError.connect(self._stderr_ready)
+        self._proc.readyReadStandardOutput.connect(self._stdout_ready)
+        self._proc.finished.connect(self._proc_finished)
+        self._proc.start(self.java_path, self.jvm_args + [WORKER_SOURCE, self.ili2db_bin])
+        if not self._proc.waitForStarted():
+            return False
+
+        self.running = True
+        self._start_timer.start(self.start_timeout)
+        return True
+
+    @property
+    def busy(self):
+        return self._job_running
+
+    def submit(self, args):
+        """
+        Runs ili2db with ``args`` without waiting for it. ``job_finished`` is
+        emitted with its exit code once it is finished. Output is reported
+        with the ``stdout`` and ``stderr`` signals.
+        """
+        self._job_running = True
+        if self._ready:
+            self._write_job(args)
+        else:
+            self._queued_job = args
+
+    def run(self, args):
+        """
+        Runs ili2db with ``args`` and returns its exit code once it is
+        finished, ``None`` if the worker failed to start. Meant for scripts
+        without a running event loop.
+        """
+        exit_code = list()
+        loop = QEventLoop()
+
+        def finished(code):
+            exit_code.append(code)
+            loop.quit()
+
+        self.job_finished.connect(finished)
+        self.start_failed.connect(loop.quit)
+        self.submit(args)
+        if not exit_code and self.running:
+            loop.exec_()
+        self.job_finished.disconnect(finished)
+        self.start_failed.disconnect(loop.quit)
+        return exit_code[0] if exit_code else None
+
+    def _write_job(self, args):
+        job = '\t'.join(urllib.parse.quote(arg, safe='') for arg in args)
+        self._proc.write((job + '\n').encode('utf-8'))
+
+    def kill(self):
+        """
+        Ends the running job, which finishes with an error. The next job gets
+        a new worker.
+        """
+        if self._proc is not None and self._proc.state() != QProcess.NotRunning:
+            self._proc.kill()
+
+    def shutdown(self):
+        self.running = False
+        if self._proc is not None and self._proc.state() != QProcess.NotRunning:
+            self._proc.closeWriteChannel()
+            if not self._proc.waitForFinished(1000):
+                self._proc.kill()
+                self._proc.waitForFinished(1000)
+
+    def _stdout_ready(self):
+        self.stdout.emit(bytes(self._proc.readAllStandardOutput()).decode(self.encoding))
+
+    def _stderr_ready(self):
+        self._stderr_buffer += bytes(self._proc.readAllStandardError())
+        # Markers are complete lines, keep an incomplete last line for later
+        lines, separator, self._stderr_buffer = self._stderr_buffer.rpartition(b'\n')
+        if not separator:
+            return
+
+        output = list()
+        for line in lines.split(b'\n'):
+            if line.rstrip() == READY_MARKER:
+                self._ready = True
+                self._start_timer.stop()
+                if self._queued_job is not None:
+                    self._write_job(self._queued_job)
+                    self._queued_job = None
+            elif line.startswith(DONE_MARKER):
+                self._emit_stderr(output)
+                output = list()
+                self._job_running = False
+                self.job_finished.emit(int(line[len(DONE_MARKER):].strip() or 1))
+            else:
+                output.append(line)
+        self._emit_stderr(output)
+
+    def _emit_stderr(self, lines):
+        if lines:
+            self.stderr.emit(b'\n'.join(lines).decode(self.encoding) + '\n')
+
+    def _proc_finished(self, exit_code, exit_status):
+        # ili2db exits the process on errors, a running job is finished with its exit code
+        was_running = self.running
+        self.running = False
+        self._job_running = False
+        self._start_timer.stop()
+        if self._stderr_buffer:
+            self._emit_stderr([self._stderr_buffer])
+            self._stderr_buffer = b''
+        if was_running and not self._ready:
+            self._queued_job = None
+            self.start_failed.emit()
+        elif was_running:
+            self.job_finished.emit(exit_code if exit_status == QProcess.NormalExit else 1)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                              -------------------
+        begin                : 18/10/26
+        git sha              : :%H$
+        copyright            : (C) 2026 by OPENGIS.ch
+        email                : info@opengis.ch
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import collections
+import os
+import re
+import shutil
+
+from qgis.PyQt.QtCore import QProcess
+
+from projectgenerator.libili2db.ili2dbconfig import JavaNotFoundError, JavaVersionError, MIN_JAVA_VERSION
+
+JavaRuntime = collections.namedtuple('JavaRuntime', ['path', 'version', 'major_version', 'vendor'])
+
+# Resolved runtimes by configured java path and the environment they were found in
+_java_runtimes = dict()
+# Probed runtimes by executable and its modification time
+_probed_runtimes = dict()
+
+
+def get_java_runtime(java_path=''):
+    """
+    Returns the JavaRuntime to run ili2db with.
+
+    A configured ``java_path`` is used no matter what, otherwise JAVA_HOME and
+    PATH are searched. The result is cached and only searched again when
+    ``java_path``, JAVA_HOME or PATH change or the executable disappears. An
+    executable is only probed again once it changed, no matter which path it
+    is found by.
+
+    Raises a JavaNotFoundError if no Java can be run and a JavaVersionError if
+    it is older than MIN_JAVA_VERSION.
+    """
+    key = (java_path, os.environ.get('JAVA_HOME'), os.environ.get('PATH'))
+    runtime = _java_runtimes.get(key)
+    if runtime is None or not os.path.isfile(runtime.path):
+        runtime = None
+        for candidate in _java_candidates(java_path):
+            runtime = probe_java(candidate)
+            if runtime:
+                break
+        if runtime is None:
+            raise JavaNotFoundError()
+        _java_runtimes[key] = runtime
+
+    if runtime.major_version < MIN_JAVA_VERSION:
+        raise JavaVersionError(runtime.path, runtime.version)
+    return runtime
+
+
+def invalidate_java_runtimes():
+    _java_runtimes.clear()
+    _probed_runtimes.clear()
+
+
+def _java_candidates(java_path):
+    if java_path:
+        # A java path is configured: respect it no matter what
+        return [java_path]
+
+    # By default try JAVA_HOME and PATH
+    candidates = list()
+    for path in os.environ.get('JAVA_HOME', '').split(os.pathsep):
+        path = path.replace('"', '').replace("'", '')
+        if path:
+            candidates += [os.path.join(path, 'bin', 'java'), os.path.join(path, 'java')]
+    candidates += ['java']
+    return candidates
+
+
+def find_executable(java_path):
+    """
+    Returns the path of the executable ``java_path`` refers to or ``None``.
+    """
+    executable = shutil.which(java_path)
+    if executable or os.name != 'nt' or os.path.splitext(java_path)[1]:
+        return executable
+
+    # Python before 3.12 only adds the PATHEXT suffixes to bare names like
+    # java, not to paths like %JAVA_HOME%\bin\java
+    for extension in os.environ.get('PATHEXT', '.COM;.EXE;.BAT;.CMD').split(os.pathsep):
+        executable = shutil.which(java_path + extension)
+        if executable:
+            return executable
+    return None
+
+
+def probe_java(java_path):
+    """
+    Runs ``java_path`` once and returns its JavaRuntime or ``None`` if it
+    cannot be run. The result is kept until the executable changes.
+    """
+    executable = find_executable(java_path)
+    if not executable:
+        return None
+    try:
+        key = (os.path.normcase(os.path.abspath(executable)), os.stat(executable).st_mtime_ns)
+    except OSError:
+        return None
+    if key not in _probed_runtimes:
+        runtime = _run_probe(executable)
+        if runtime is None:
+            return None
+        _probed_runtimes[key] = runtime
+    return _probed_runtimes[key]
+
+
+def _run_probe(executable):
+    proc = QProcess()
+    proc.setProcessChannelMode(QProcess.MergedChannels)
+    proc.start(executable, ['-XshowSettings:properties', '-version'])
+    if not proc.waitForStarted() or not proc.waitForFinished(30000):
+        proc.kill()
+        return None
+
+    output = bytes(proc.readAll()).decode('utf-8', 'replace')
+    properties = dict(re.findall(r'^\s*(java\.version|java\.vendor)\s*=\s*(.*?)\s*$', output, re.MULTILINE))
+    version = properties.get('java.version')
+    if not version:
+        # Not every runtime knows -XshowSettings
+        match = re.search(r'version "([^"]+)"', output)
+        if not match:
+            return None
+        version = match.group(1)
+
+    return JavaRuntime(executable, version, java_major_version(version), properties.get('java.vendor', ''))
+
+
+def java_major_version(version):
+    """
+    Returns the major version of a Java version string, e.g. 8 for ``1.8.0_292``
+    and 11 for ``11.0.2``.
+    """
+    numbers = [int(number) for number in re.findall(r'\d+', version)[:2]]
+    if not numbers:
+        return 0
+    if numbers[0] == 1 and len(numbers) > 1:
+        return numbers[1]
+    return numbers[0]
@@ -0,0 +1,74 @@
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.InputStreamReader;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.net.URLDecoder;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.jar.Attributes;
+import java.util.jar.JarFile;
+
+/**
+ * Resident ili2db process of the QGIS Project Generator.
+ *
+ * Loads the ili2db jar passed as the only argument once and runs one ili2db
+ * invocation for every line read from stdin. The arguments of an invocation
+ * are URL encoded and separated by tabs. When an invocation is finished, a
+ * marker line with its exit code is written to stderr.
+ *
+ * Started with the source file launcher of Java 11 or newer:
+ * java Ili2dbWorker.java ili2pg.jar
+ */
+public class Ili2dbWorker {
+    public static void main(String[] args) throws Exception {
+        File jar = new File(args[0]);
+        String mainClassName;
+        try (JarFile jarFile = new JarFile(jar)) {
+            mainClassName = jarFile.getManifest().getMainAttributes().getValue(Attributes.Name.MAIN_CLASS);
+        }
+        URLClassLoader loader = new URLClassLoader(new URL[]{jar.toURI().toURL()},
+                Ili2dbWorker.class.getClassLoader());
+        Thread.currentThread().setContextClassLoader(loader);
+        Method main = Class.forName(mainClassName, true, loader).getMethod("main", String[].class);
+
+        System.err.println("ILI2DB_WORKER_READY");
+        System.err.flush();
+
+        BufferedReader jobs = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        String job;
+        while ((job = jobs.readLine()) != null) {
+            List<String> jobArgs = new ArrayList<>();
+            if (!job.isEmpty()) {
+                for (String arg : job.split("\t", -1)) {
+                    jobArgs.add(URLDecoder.decode(arg, "UTF-8"));
+                }
+            }
+            int exitCode = 0;
+            try {
+                main.invoke(null, (Object) jobArgs.toArray(new String[0]));
+            } catch (InvocationTargetException e) {
+                e.getCause().printStackTrace();
+                exitCode = 1;
+            }
+            // ili2db exits the process itself on errors, the worker is
+            // restarted for the next invocation then
+            System.out.flush();
+            System.err.println();
+            System.err.println("ILI2DB_WORKER_DONE " + exitCode);
+            System.err.flush();
+        }
+    }
+}
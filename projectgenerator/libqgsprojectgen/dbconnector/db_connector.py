@@ -17,6 +17,10 @@
  ***************************************************************************/
 """
 
+# Tag of the setting in t_ili2db_settings holding the fingerprint of the
+# schema import which created the schema
+SCHEMA_FINGERPRINT_TAG = 'ch.opengis.projectgenerator.schemaFingerprint'
+
 
 class DBConnector:
     '''SuperClass for all DB connectors.'''
@@ -120,6 +124,33 @@ class DBConnector:
         '''
         return []
 
+    def get_datasets(self):
+        '''
+        Names of the datasets in t_ili2db_dataset, empty if the schema has no
+        baskets.
+        '''
+        return []
+
+    def get_baskets(self):
+        '''
+        Transfer ids (t_ili_tid) of the baskets in t_ili2db_basket, empty if the
+        schema has no baskets.
+        '''
+        return []
+
+    def get_schema_fingerprint(self):
+        '''
+        Fingerprint of the schema import stored with set_schema_fingerprint,
+        None if there is none.
+        '''
+        return None
+
+    def set_schema_fingerprint(self, fingerprint):
+        '''
+        Stores the fingerprint of a schema import in t_ili2db_settings.
+        '''
+        pass
+
     def get_domainili_domaindb_mapping(self, domains):
         """TODO: remove when ili2db issue #19 is solved"""
         return {}
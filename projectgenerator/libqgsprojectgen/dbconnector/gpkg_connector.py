@@ -20,7 +20,7 @@ import os
 import re
 import sqlite3
 import qgis.utils
-from .db_connector import DBConnector
+from .db_connector import DBConnector, SCHEMA_FINGERPRINT_TAG
 from ..generator.config import GPKG_FILTER_TABLES_MATCHING_PREFIX_SUFFIX
 
 GPKG_METADATA_TABLE = 'T_ILI2DB_TABLE_PROP'
@@ -260,6 +260,51 @@ class GPKGConnector(DBConnector):
         cursor.close()
         return complete_records
 
+    def get_datasets(self):
+        if self._table_exists('T_ILI2DB_DATASET'):
+            cursor = self.conn.cursor()
+            cursor.execute("""SELECT datasetName
+                              FROM T_ILI2DB_DATASET
+                              ORDER BY datasetName
+                           """)
+            return [record[0] for record in cursor]
+
+        return []
+
+    def get_baskets(self):
+        if self._table_exists('T_ILI2DB_BASKET'):
+            cursor = self.conn.cursor()
+            cursor.execute("""SELECT T_Ili_Tid
+                              FROM T_ILI2DB_BASKET
+                              ORDER BY T_Id
+                           """)
+            return [record[0] for record in cursor]
+
+        return []
+
+    def get_schema_fingerprint(self):
+        if self._table_exists('T_ILI2DB_SETTINGS'):
+            cursor = self.conn.cursor()
+            cursor.execute("""SELECT setting
+                              FROM T_ILI2DB_SETTINGS
+                              WHERE tag = ?
+                           """, (SCHEMA_FINGERPRINT_TAG,))
+            record = cursor.fetchone()
+            return record[0] if record else None
+
+        return None
+
+    def set_schema_fingerprint(self, fingerprint):
+        if self._table_exists('T_ILI2DB_SETTINGS'):
+            cursor = self.conn.cursor()
+            cursor.execute("""DELETE FROM T_ILI2DB_SETTINGS
+                              WHERE tag = ?
+                           """, (SCHEMA_FINGERPRINT_TAG,))
+            cursor.execute("""INSERT INTO T_ILI2DB_SETTINGS (tag, setting)
+                              VALUES (?, ?)
+                           """, (SCHEMA_FINGERPRINT_TAG, fingerprint))
+            self.conn.commit()
+
     def get_domainili_domaindb_mapping(self, domains):
         """TODO: remove when ili2db issue #19 is solved"""
         # Map domain ili name with its correspondent pg name
@@ -17,15 +17,30 @@
  *                                                                         *
  ***************************************************************************/
 """
+import collections
+import json
 import psycopg2
 import psycopg2.extras
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-from .db_connector import DBConnector
+from .db_connector import DBConnector, SCHEMA_FINGERPRINT_TAG
 
 PG_METADATA_TABLE = 't_ili2db_table_prop'
 PG_METAATTRS_TABLE = 't_ili2db_meta_attrs'
 
+# Statements creating the indexes of the data tables, their foreign keys as
+# (table, name, definition) and the data tables
+DeferredIndexes = collections.namedtuple('DeferredIndexes', ['indexes', 'foreign_keys', 'tables'])
+
+# Dropped indexes and foreign keys are kept in t_ili2db_settings until they
+# are rebuilt, split into rows of at most this many characters
+DEFERRED_INDEXES_TAG = 'ch.opengis.projectgenerator.deferredIndexes'
+SETTING_CHUNK_SIZE = 255
+
+# Seconds since the epoch when a template schema was last cloned
+TEMPLATE_USED_TAG = 'ch.opengis.projectgenerator.templateUsed'
+
 
 class PGConnector(DBConnector):
     _geom_parse_regexp = None
@@ -33,6 +48,7 @@ class PGConnector(DBConnector):
     def __init__(self, uri, schema):
         DBConnector.__init__(self, uri, schema)
         self.conn = psycopg2.connect(uri)
+        self.uri = uri
         self.schema = schema
         self._bMetadataTable = self._metadata_exists()
         self.iliCodeName = 'ilicode'
@@ -318,6 +334,402 @@ class PGConnector(DBConnector):
 
         return []
 
+    def get_datasets(self):
+        if self.schema and self._table_exists('t_ili2db_dataset'):
+            cur = self.conn.cursor()
+            cur.execute("""SELECT datasetname
+                           FROM {schema}.t_ili2db_dataset
+                           ORDER BY datasetname
+                        """.format(schema=self.schema))
+            return [record[0] for record in cur]
+
+        return []
+
+    def get_baskets(self):
+        if self.schema and self._table_exists('t_ili2db_basket'):
+            cur = self.conn.cursor()
+            cur.execute("""SELECT t_ili_tid
+                           FROM {schema}.t_ili2db_basket
+                           ORDER BY t_id
+                        """.format(schema=self.schema))
+            return [record[0] for record in cur]
+
+        return []
+
+    def export_snapshot(self):
+        '''
+        Starts a read only transaction on this connection and returns the id of
+        its snapshot. Other sessions see exactly the same data after
+        SET TRANSACTION SNAPSHOT as long as this connection is not closed.
+        '''
+        self.conn.rollback()
+        self.conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        cur = self.conn.cursor()
+        cur.execute("SELECT pg_export_snapshot()")
+        return cur.fetchone()[0]
+
+    def transaction_snapshot(self):
+        '''
+        Returns the snapshot of the current transaction as text. It stays the
+        same in a REPEATABLE READ transaction and in the transactions which
+        imported its snapshot.
+        '''
+        cur = self.conn.cursor()
+        cur.execute("SELECT txid_current_snapshot()::text")
+        return cur.fetchone()[0]
+
+    def get_schema_fingerprint(self):
+        if self.schema and self._table_exists('t_ili2db_settings'):
+            cur = self.conn.cursor()
+            cur.execute("""SELECT setting
+                           FROM {schema}.t_ili2db_settings
+                           WHERE tag = %s
+                        """.format(schema=self.schema), (SCHEMA_FINGERPRINT_TAG,))
+            record = cur.fetchone()
+            return record[0] if record else None
+
+        return None
+
+    def set_schema_fingerprint(self, fingerprint):
+        if self.schema and self._table_exists('t_ili2db_settings'):
+            cur = self.conn.cursor()
+            cur.execute("""DELETE FROM {schema}.t_ili2db_settings
+                           WHERE tag = %s
+                        """.format(schema=self.schema), (SCHEMA_FINGERPRINT_TAG,))
+            cur.execute("""INSERT INTO {schema}.t_ili2db_settings (tag, setting)
+                           VALUES (%s, %s)
+                        """.format(schema=self.schema), (SCHEMA_FINGERPRINT_TAG, fingerprint))
+            self.conn.commit()
+
+    def lock_schema(self, shared=False):
+        '''
+        Waits for an advisory lock on the name of the schema. Any number of
+        sessions can hold a shared lock at the same time, an exclusive lock is
+        only granted to one session without shared locks. It is held until
+        ``unlock_schema`` is called or the connection is closed.
+        '''
+        cur = self.conn.cursor()
+        cur.execute("SELECT pg_advisory_lock{}(hashtext(%s))".format('_shared' if shared else ''), (self.schema,))
+        self.conn.commit()
+
+    def try_lock_schema(self, shared=False):
+        '''
+        Takes the advisory lock of ``lock_schema`` without waiting for it and
+        returns whether it was granted.
+        '''
+        cur = self.conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock{}(hashtext(%s))".format('_shared' if shared else ''),
+                    (self.schema,))
+        locked = cur.fetchone()[0]
+        self.conn.commit()
+        return locked
+
+    def unlock_schema(self, shared=False):
+        cur = self.conn.cursor()
+        cur.execute("SELECT pg_advisory_unlock{}(hashtext(%s))".format('_shared' if shared else ''), (self.schema,))
+        self.conn.commit()
+
+    def clone_schema(self, target):
+        '''
+        Creates the schema ``target`` with the tables, sequences, indexes,
+        constraints and rows of this schema in one transaction. Meant for
+        schemas which only went through a schema import, the rows are the
+        ili2db metadata and enumerations.
+        '''
+        cur = self.conn.cursor()
+        try:
+            # Expressions are written without the schema name and resolve
+            # to the objects of the target schema later on
+            cur.execute("SET LOCAL search_path = {schema}, public".format(schema=self.schema))
+            cur.execute("""SELECT c.relname, c.relkind
+                           FROM pg_class c
+                           JOIN pg_namespace n ON n.oid = c.relnamespace
+                           WHERE n.nspname = %s AND c.relkind IN ('r', 'S')
+                           ORDER BY c.relname
+                        """, (self.schema,))
+            relations = cur.fetchall()
+            tables = [name for name, kind in relations if kind == 'r']
+            cur.execute("""SELECT sequencename, data_type, increment_by, min_value, max_value, start_value,
+                                  cache_size, cycle
+                           FROM pg_sequences
+                           WHERE schemaname = %s
+                        """, (self.schema,))
+            sequence_parameters = {record[0]: record[1:] for record in cur.fetchall()}
+            sequences = list()
+            for name in [name for name, kind in relations if kind == 'S']:
+                cur.execute("SELECT last_value, is_called FROM {schema}.{sequence}".format(
+                    schema=self.schema, sequence=name))
+                sequences.append((name,) + cur.fetchone() + sequence_parameters[name])
+            cur.execute("""SELECT c.relname, a.attname, pg_get_expr(d.adbin, d.adrelid)
+                           FROM pg_attrdef d
+                           JOIN pg_class c ON c.oid = d.adrelid
+                           JOIN pg_namespace n ON n.oid = c.relnamespace
+                           JOIN pg_attribute a ON a.attrelid = d.adrelid AND a.attnum = d.adnum
+                           WHERE n.nspname = %s AND c.relkind = 'r'
+                        """, (self.schema,))
+            defaults = cur.fetchall()
+            cur.execute("""SELECT c.relname, con.conname, pg_get_constraintdef(con.oid)
+                           FROM pg_constraint con
+                           JOIN pg_class c ON c.oid = con.conrelid
+                           JOIN pg_namespace n ON n.oid = c.relnamespace
+                           WHERE n.nspname = %s AND con.contype = 'f'
+                           ORDER BY c.relname, con.conname
+                        """, (self.schema,))
+            foreign_keys = cur.fetchall()
+
+            cur.execute("CREATE SCHEMA {target}".format(target=target))
+            cur.execute("SET LOCAL search_path = {target}, public".format(target=target))
+            for name, last_value, is_called, data_type, increment, minimum, maximum, start, cache, cycle in sequences:
+                cur.execute("""CREATE SEQUENCE {target}.{sequence} AS {data_type}
+                               INCREMENT BY %s MINVALUE %s MAXVALUE %s START WITH %s CACHE %s {cycle}
+                            """.format(target=target, sequence=name, data_type=data_type,
+                                       cycle='CYCLE' if cycle else 'NO CYCLE'),
+                            (increment, minimum, maximum, start, cache))
+                cur.execute("SELECT setval(%s, %s, %s)", ('{}.{}'.format(target, name), last_value, is_called))
+            for table in tables:
+                # Copies columns, defaults, checks, unique and primary keys,
+                # indexes and comments, but no foreign keys
+                cur.execute("CREATE TABLE {target}.{table} (LIKE {schema}.{table} INCLUDING ALL)".format(
+                    target=target, schema=self.schema, table=table))
+            for table, column, expression in defaults:
+                cur.execute("ALTER TABLE {target}.{table} ALTER COLUMN {column} SET DEFAULT {expression}".format(
+                    target=target, table=table, column=column, expression=expression))
+            for table in tables:
+                cur.execute("INSERT INTO {target}.{table} SELECT * FROM {schema}.{table}".format(
+                    target=target, schema=self.schema, table=table))
+            for table, name, definition in foreign_keys:
+                cur.execute("ALTER TABLE {target}.{table} ADD CONSTRAINT {name} {definition}".format(
+                    target=target, table=table, name=name, definition=definition))
+        except psycopg2.Error:
+            self.conn.rollback()
+            raise
+
+        self.conn.commit()
+
+    def mark_schema_used(self):
+        '''
+        Stores the current time of the server in the settings of this schema,
+        see ``prune_template_schemas``.
+        '''
+        if self.schema and self._table_exists('t_ili2db_settings'):
+            cur = self.conn.cursor()
+            cur.execute("""DELETE FROM {schema}.t_ili2db_settings
+                           WHERE tag = %s
+                        """.format(schema=self.schema), (TEMPLATE_USED_TAG,))
+            cur.execute("""INSERT INTO {schema}.t_ili2db_settings (tag, setting)
+                           VALUES (%s, extract(epoch FROM now())::bigint::text)
+                        """.format(schema=self.schema), (TEMPLATE_USED_TAG,))
+            self.conn.commit()
+
+    def prune_template_schemas(self, prefix, count):
+        '''
+        Drops the schemas starting with ``prefix`` except for the ``count``
+        ones which were used most recently by ``mark_schema_used``, and
+        returns their names. This schema and schemas locked by other sessions,
+        e.g. while they are cloned, are kept.
+        '''
+        cur = self.conn.cursor()
+        cur.execute("""SELECT nspname
+                       FROM pg_namespace
+                       WHERE nspname LIKE %s
+                    """, (prefix.replace('_', '\\_') + '%',))
+        schemas = list()
+        for schema in [record[0] for record in cur.fetchall()]:
+            cur.execute("SELECT to_regclass(%s)", ('{}.t_ili2db_settings'.format(schema),))
+            used = None
+            if cur.fetchone()[0] is not None:
+                cur.execute("""SELECT setting
+                               FROM {schema}.t_ili2db_settings
+                               WHERE tag = %s
+                            """.format(schema=schema), (TEMPLATE_USED_TAG,))
+                record = cur.fetchone()
+                used = record[0] if record else None
+            # Templates which were never cloned are the oldest ones
+            schemas.append((int(used) if used and used.isdigit() else 0, schema))
+        self.conn.commit()
+
+        dropped = list()
+        for used, schema in sorted(schemas, reverse=True)[count:]:
+            if schema == self.schema:
+                continue
+            cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (schema,))
+            locked = cur.fetchone()[0]
+            self.conn.commit()
+            if not locked:
+                continue
+            try:
+                cur.execute("DROP SCHEMA {schema} CASCADE".format(schema=schema))
+                self.conn.commit()
+                dropped.append(schema)
+            except psycopg2.Error:
+                self.conn.rollback()
+                raise
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (schema,))
+                self.conn.commit()
+        return dropped
+
+    def get_deferred_indexes(self):
+        '''
+        Returns the DeferredIndexes dropped by defer_indexes_and_foreign_keys
+        which have not been rebuilt yet, e.g. because the import was
+        interrupted, or ``None``.
+        '''
+        if not self.schema or not self._table_exists('t_ili2db_settings'):
+            return None
+
+        cur = self.conn.cursor()
+        cur.execute("""SELECT setting
+                       FROM {schema}.t_ili2db_settings
+                       WHERE tag LIKE %s
+                       ORDER BY tag
+                    """.format(schema=self.schema), (DEFERRED_INDEXES_TAG + '.%',))
+        chunks = [record[0] or '' for record in cur]
+        if not chunks:
+            return None
+        deferred = json.loads(''.join(chunks))
+        return DeferredIndexes(deferred['indexes'], [tuple(foreign_key) for foreign_key in deferred['foreign_keys']],
+                               deferred['tables'])
+
+    def _store_deferred_indexes(self, cur, deferred):
+        cur.execute("""DELETE FROM {schema}.t_ili2db_settings
+                       WHERE tag LIKE %s
+                    """.format(schema=self.schema), (DEFERRED_INDEXES_TAG + '.%',))
+        if deferred:
+            setting = json.dumps(deferred._asdict())
+            cur.executemany("""INSERT INTO {schema}.t_ili2db_settings (tag, setting)
+                               VALUES (%s, %s)
+                            """.format(schema=self.schema),
+                            [('{}.{:04d}'.format(DEFERRED_INDEXES_TAG, index // SETTING_CHUNK_SIZE),
+                              setting[index:index + SETTING_CHUNK_SIZE])
+                             for index in range(0, len(setting), SETTING_CHUNK_SIZE)])
+
+    def defer_indexes_and_foreign_keys(self):
+        '''
+        Drops the foreign keys and the indexes which are neither primary keys
+        nor unique of the data tables and returns them as DeferredIndexes for
+        rebuild_indexes_and_foreign_keys. The ili2db tables keep theirs.
+
+        The definitions are stored in the schema in the same transaction, so
+        the ones of an interrupted import are not lost. They are included in
+        the result until they have been rebuilt.
+        '''
+        pending = self.get_deferred_indexes()
+        cur = self.conn.cursor()
+        try:
+            cur.execute("""SELECT c.relname
+                           FROM pg_class c
+                           JOIN pg_namespace n ON n.oid = c.relnamespace
+                           WHERE n.nspname = %s AND c.relkind = 'r' AND c.relname NOT LIKE 't\\_ili2db\\_%%'
+                           ORDER BY c.relname
+                        """, (self.schema,))
+            tables = [record[0] for record in cur]
+            cur.execute("""SELECT c.relname, con.conname, pg_get_constraintdef(con.oid)
+                           FROM pg_constraint con
+                           JOIN pg_class c ON c.oid = con.conrelid
+                           WHERE c.relname = ANY(%s) AND c.relnamespace = %s::regnamespace AND con.contype = 'f'
+                           ORDER BY c.relname, con.conname
+                        """, (tables, self.schema))
+            foreign_keys = cur.fetchall()
+            cur.execute("""SELECT i.relname, pg_get_indexdef(ix.indexrelid)
+                           FROM pg_index ix
+                           JOIN pg_class i ON i.oid = ix.indexrelid
+                           JOIN pg_class c ON c.oid = ix.indrelid
+                           WHERE c.relname = ANY(%s) AND c.relnamespace = %s::regnamespace
+                             AND NOT ix.indisprimary AND NOT ix.indisunique
+                             AND NOT EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conindid = ix.indexrelid)
+                           ORDER BY i.relname
+                        """, (tables, self.schema))
+            indexes = cur.fetchall()
+
+            deferred = DeferredIndexes([definition for name, definition in indexes], foreign_keys, tables)
+            if pending:
+                deferred = DeferredIndexes(
+                    pending.indexes + [index for index in deferred.indexes if index not in pending.indexes],
+                    pending.foreign_keys + [foreign_key for foreign_key in deferred.foreign_keys
+                                            if foreign_key not in pending.foreign_keys],
+                    sorted(set(pending.tables) | set(deferred.tables)))
+            self._store_deferred_indexes(cur, deferred)
+
+            for table, name, definition in foreign_keys:
+                cur.execute("ALTER TABLE {schema}.{table} DROP CONSTRAINT {name}".format(
+                    schema=self.schema, table=table, name=name))
+            for name, definition in indexes:
+                cur.execute("DROP INDEX {schema}.{name}".format(schema=self.schema, name=name))
+        except psycopg2.Error:
+            self.conn.rollback()
+            raise
+
+        self.conn.commit()
+        return deferred
+
+    def rebuild_indexes_and_foreign_keys(self, deferred, connection_count):
+        '''
+        Creates the indexes and foreign keys of ``deferred`` again, validates
+        the foreign keys and analyzes the tables. The indexes, validations and
+        analyses run over up to ``connection_count`` connections at the same
+        time. Returns the errors, a foreign key which does not hold stays
+        NOT VALID.
+
+        Indexes and foreign keys which exist already, e.g. from an interrupted
+        rebuild, are skipped. The stored definitions are removed once all of
+        them have been rebuilt.
+        '''
+        errors = list()
+
+        cur = self.conn.cursor()
+        cur.execute("""SELECT c.relname, con.conname
+                       FROM pg_constraint con
+                       JOIN pg_class c ON c.oid = con.conrelid
+                       WHERE c.relnamespace = %s::regnamespace AND con.contype = 'f'
+                    """, (self.schema,))
+        existing_foreign_keys = set(cur.fetchall())
+        self.conn.commit()
+
+        def execute(statements):
+            conn = psycopg2.connect(self.uri)
+            conn.autocommit = True
+            try:
+                for statement in statements:
+                    try:
+                        conn.cursor().execute(statement)
+                    except psycopg2.Error as e:
+                        errors.append('{}: {}'.format(statement, e))
+            finally:
+                conn.close()
+
+        def execute_parallel(statements):
+            with ThreadPoolExecutor(max_workers=max(connection_count, 1)) as executor:
+                list(executor.map(execute, statements))
+
+        execute_parallel([[re.sub(r'^CREATE INDEX ', 'CREATE INDEX IF NOT EXISTS ', statement)]
+                          for statement in deferred.indexes])
+
+        # Adding foreign keys without checking the rows is quick but locks
+        # both tables, validating them later on only blocks writers
+        execute(["ALTER TABLE {schema}.{table} ADD CONSTRAINT {name} {definition} NOT VALID".format(
+            schema=self.schema, table=table, name=name, definition=definition)
+            for table, name, definition in deferred.foreign_keys if (table, name) not in existing_foreign_keys])
+        validations = collections.OrderedDict()
+        for table, name, definition in deferred.foreign_keys:
+            validations.setdefault(table, list()).append(
+                "ALTER TABLE {schema}.{table} VALIDATE CONSTRAINT {name}".format(
+                    schema=self.schema, table=table, name=name))
+        execute_parallel(list(validations.values()))
+
+        execute_parallel([["ANALYZE {schema}.{table}".format(schema=self.schema, table=table)]
+                          for table in deferred.tables])
+
+        if not errors:
+            cur = self.conn.cursor()
+            try:
+                self._store_deferred_indexes(cur, None)
+            except psycopg2.Error:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+        return errors
+
     def get_domainili_domaindb_mapping(self, domains):
         """TODO: remove when ili2db issue #19 is solved"""
         # Map domain ili name with its correspondent pg name
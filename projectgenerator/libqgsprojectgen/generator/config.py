@@ -3,6 +3,9 @@ IGNORED_SCHEMAS = [
     'information_schema'
 ]
 
+# Schemas holding the structure new schemas are cloned from
+TEMPLATE_SCHEMA_PREFIX = 'ili2db_template_'
+
 IGNORED_TABLES = [
     'spatial_ref_sys',
     't_ili2db_import_object',
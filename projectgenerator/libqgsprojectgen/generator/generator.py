@@ -28,7 +28,7 @@ from projectgenerator.libqgsprojectgen.dataobjects.layers import Layer
 from projectgenerator.libqgsprojectgen.dataobjects.relations import Relation
 from ..dbconnector import pg_connector, gpkg_connector
 from .domain_relations_generator import DomainRelationGenerator
-from .config import IGNORED_SCHEMAS, IGNORED_TABLES, IGNORED_FIELDNAMES, READONLY_FIELDNAMES
+from .config import IGNORED_SCHEMAS, IGNORED_TABLES, IGNORED_FIELDNAMES, READONLY_FIELDNAMES, TEMPLATE_SCHEMA_PREFIX
 
 
 class Generator:
@@ -55,7 +55,7 @@ class Generator:
             if self.schema:
                 if record['schemaname'] != self.schema:
                     continue
-            elif record['schemaname'] in IGNORED_SCHEMAS:
+            elif record['schemaname'] in IGNORED_SCHEMAS or (record['schemaname'] or '').startswith(TEMPLATE_SCHEMA_PREFIX):
                 continue
 
             if record['tablename'] in IGNORED_TABLES:
@@ -289,7 +289,7 @@ class Generator:
             if self.schema:
                 if record['schemaname'] != self.schema:
                     continue
-            elif record['schemaname'] in IGNORED_SCHEMAS:
+            elif record['schemaname'] in IGNORED_SCHEMAS or (record['schemaname'] or '').startswith(TEMPLATE_SCHEMA_PREFIX):
                 continue
 
             if record['tablename'] in IGNORED_TABLES:
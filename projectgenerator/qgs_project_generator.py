@@ -33,6 +33,8 @@ from qgis.PyQt.QtCore import QObject, QTranslator, QSettings, QLocale, QCoreAppl
 
 from projectgenerator.gui.options import OptionsDialog
 from projectgenerator.libili2db.ili2dbconfig import BaseConfiguration
+from projectgenerator.libili2db.ilicache import IliCache
+from projectgenerator.libili2db.iliworker import shutdown_ili2db_workers
 
 
 class QgsProjectGeneratorPlugin(QObject):
@@ -63,6 +65,9 @@ class QgsProjectGeneratorPlugin(QObject):
         settings.beginGroup('QgsProjectGenerator/ili2db')
         self.ili2db_configuration.restore(settings)
 
+        # Shared by all dialogs, so models are only read once per session
+        self.ilicache = IliCache(self.ili2db_configuration)
+
     def initGui(self):
         self.__generate_action = QAction(self.tr('Generate'), None)
         self.__export_action = QAction(
@@ -110,6 +115,7 @@ class QgsProjectGeneratorPlugin(QObject):
             self.tr('Project Generator'), self.__help_action)
         self.iface.removePluginDatabaseMenu(
             self.tr('Project Generator'), self.__about_action)
+        shutdown_ili2db_workers()
         del self.__generate_action
         del self.__export_action
         del self.__importdata_action
@@ -118,7 +124,7 @@ class QgsProjectGeneratorPlugin(QObject):
         del self.__about_action
 
     def show_generate_dialog(self):
-        dlg = GenerateProjectDialog(self.iface, self.ili2db_configuration)
+        dlg = GenerateProjectDialog(self.iface, self.ili2db_configuration, ilicache=self.ilicache)
         dlg.exec_()
 
     def show_options_dialog(self):
@@ -129,11 +135,11 @@ class QgsProjectGeneratorPlugin(QObject):
             self.ili2db_configuration.save(settings)
 
     def show_export_dialog(self):
-        dlg = ExportDialog(self.ili2db_configuration)
+        dlg = ExportDialog(self.ili2db_configuration, ilicache=self.ilicache)
         dlg.exec_()
 
     def show_importdata_dialog(self):
-        dlg = ImportDataDialog(self.ili2db_configuration)
+        dlg = ImportDataDialog(self.ili2db_configuration, ilicache=self.ilicache)
         dlg.exec_()
 
     def show_help_documentation(self):
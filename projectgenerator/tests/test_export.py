@@ -22,6 +22,7 @@ import datetime
 import shutil
 import tempfile
 import nose2
+import psycopg2
 import xml.etree.ElementTree as ET
 
 from projectgenerator.libili2db import (iliexporter,
@@ -130,6 +131,145 @@ class TestExport(unittest.TestCase):
         self.compare_xtfs(testdata_path(
             'xtf/test_ciaf_ladm.xtf'), obtained_xtf_path)
 
+    def test_batch_export_postgis(self):
+        # Schema Import
+        importer = iliimporter.Importer()
+        importer.tool_name = 'ili2pg'
+        importer.configuration = iliimporter_config(importer.tool_name,
+                                                    'ilimodels/CIAF_LADM')
+        importer.configuration.ilimodels = 'CIAF_LADM'
+        importer.configuration.dbschema = 'ciaf_ladm_b_{:%Y%m%d%H%M%S%f}'.format(
+            datetime.datetime.now())
+        importer.configuration.epsg = 3116
+        importer.configuration.inheritance = 'smart2'
+        importer.configuration.create_basket_col = True
+        importer.stdout.connect(self.print_info)
+        importer.stderr.connect(self.print_error)
+        self.assertEqual(importer.run(), iliimporter.Importer.SUCCESS)
+
+        # Import data into a dataset
+        dataImporter = iliimporter.Importer(dataImport=True)
+        dataImporter.tool_name = 'ili2pg'
+        dataImporter.configuration = ilidataimporter_config(
+            dataImporter.tool_name, 'ilimodels/CIAF_LADM')
+        dataImporter.configuration.ilimodels = 'CIAF_LADM'
+        dataImporter.configuration.dbschema = importer.configuration.dbschema
+        dataImporter.configuration.create_basket_col = True
+        dataImporter.configuration.xtffile = testdata_path('xtf/test_ciaf_ladm.xtf')
+        dataImporter.configuration.dataset = 'full'
+        dataImporter.stdout.connect(self.print_info)
+        dataImporter.stderr.connect(self.print_error)
+        self.assertEqual(dataImporter.run(),
+                         iliimporter.Importer.SUCCESS)
+
+        # Export every dataset and merge the results
+        exporter = iliexporter.BatchExporter()
+        exporter.tool_name = 'ili2pg'
+        exporter.configuration = iliexporter_config(exporter.tool_name)
+        exporter.configuration.ilimodels = 'CIAF_LADM'
+        exporter.configuration.dbschema = importer.configuration.dbschema
+        obtained_xtf_path = os.path.join(
+            self.basetestpath, 'tmp_test_ciaf_ladm_batch.xtf')
+        exporter.configuration.xtffile = obtained_xtf_path
+        exporter.stdout.connect(self.print_info)
+        exporter.stderr.connect(self.print_error)
+        results = exporter.run()
+
+        self.assertEqual(['full'], [result.partition for result in results])
+        self.assertEqual([iliexporter.Exporter.SUCCESS], [result.result for result in results])
+        self.assertFalse(any(os.path.exists(result.xtffile) for result in results))
+        self.compare_xtfs(testdata_path(
+            'xtf/test_ciaf_ladm.xtf'), obtained_xtf_path)
+
+    def test_batch_export_postgis_snapshot(self):
+        # Schema Import
+        importer = iliimporter.Importer()
+        importer.tool_name = 'ili2pg'
+        importer.configuration = iliimporter_config(importer.tool_name,
+                                                    'ilimodels/CIAF_LADM')
+        importer.configuration.ilimodels = 'CIAF_LADM'
+        importer.configuration.dbschema = 'ciaf_ladm_s_{:%Y%m%d%H%M%S%f}'.format(
+            datetime.datetime.now())
+        importer.configuration.epsg = 3116
+        importer.configuration.inheritance = 'smart2'
+        importer.configuration.create_basket_col = True
+        importer.stdout.connect(self.print_info)
+        importer.stderr.connect(self.print_error)
+        self.assertEqual(importer.run(), iliimporter.Importer.SUCCESS)
+
+        schema = importer.configuration.dbschema
+        uri = importer.configuration.uri
+
+        # Import the data into two datasets, the basket of the first one is
+        # renamed to keep the basket ids unique
+        for dataset in ('first', 'second'):
+            dataImporter = iliimporter.Importer(dataImport=True)
+            dataImporter.tool_name = 'ili2pg'
+            dataImporter.configuration = ilidataimporter_config(
+                dataImporter.tool_name, 'ilimodels/CIAF_LADM')
+            dataImporter.configuration.ilimodels = 'CIAF_LADM'
+            dataImporter.configuration.dbschema = schema
+            dataImporter.configuration.create_basket_col = True
+            dataImporter.configuration.xtffile = testdata_path('xtf/test_ciaf_ladm.xtf')
+            dataImporter.configuration.dataset = dataset
+            dataImporter.stdout.connect(self.print_info)
+            dataImporter.stderr.connect(self.print_error)
+            self.assertEqual(dataImporter.run(),
+                             iliimporter.Importer.SUCCESS)
+
+            if dataset == 'first':
+                conn = psycopg2.connect(uri)
+                cur = conn.cursor()
+                cur.execute("UPDATE {}.t_ili2db_basket SET t_ili_tid = 'CIAF_LADM.Catastro.first'".format(schema))
+                conn.commit()
+                conn.close()
+
+        def change_second_dataset(xtffile, result, seconds):
+            # Called after the first partition, before the second one is started
+            if not xtffile.endswith('_first.xtf'):
+                return
+            conn = psycopg2.connect(uri)
+            cur = conn.cursor()
+            cur.execute("""UPDATE {schema}.persona SET nombre = 'Changed between the partitions'
+                           WHERE t_basket IN (SELECT b.t_id
+                                              FROM {schema}.t_ili2db_basket b
+                                              JOIN {schema}.t_ili2db_dataset d ON b.dataset = d.t_id
+                                              WHERE d.datasetname = 'second')
+                        """.format(schema=schema))
+            conn.commit()
+            conn.close()
+
+        exporter = iliexporter.BatchExporter()
+        exporter.tool_name = 'ili2pg'
+        exporter.configuration = iliexporter_config(exporter.tool_name)
+        exporter.configuration.ilimodels = 'CIAF_LADM'
+        exporter.configuration.dbschema = schema
+        exporter.max_processes = 1
+        obtained_xtf_path = os.path.join(
+            self.basetestpath, 'tmp_test_ciaf_ladm_snapshot.xtf')
+        exporter.configuration.xtffile = obtained_xtf_path
+        exporter.file_finished.connect(change_second_dataset)
+        exporter.stdout.connect(self.print_info)
+        exporter.stderr.connect(self.print_error)
+        results = exporter.run()
+        self.assertEqual(['first', 'second'], [result.partition for result in results])
+        self.assertEqual([iliexporter.Exporter.SUCCESS] * 2, [result.result for result in results])
+
+        # The change was committed before the second partition was exported,
+        # but the merged file only contains the data of the snapshot
+        conn = psycopg2.connect(uri)
+        cur = conn.cursor()
+        cur.execute("SELECT nombre FROM {}.persona ORDER BY nombre".format(schema))
+        self.assertEqual([('Changed between the partitions',), ('Pepito Perez',)], cur.fetchall())
+        conn.close()
+        self.assertFalse(any(os.path.exists(result.xtffile) for result in results))
+        with open(obtained_xtf_path, encoding='utf-8') as f:
+            content = f.read()
+        self.assertNotIn('Changed between the partitions', content)
+        self.assertEqual(2, content.count('<Nombre>Pepito Perez</Nombre>'))
+        self.assertIn('BID="CIAF_LADM.Catastro.first"', content)
+        self.assertIn('BID="CIAF_LADM.Catastro"', content)
+
     def print_info(self, text):
         print(text)
 
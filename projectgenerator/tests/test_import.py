@@ -25,13 +25,19 @@ import nose2
 import psycopg2
 import psycopg2.extras
 
-from projectgenerator.libili2db import iliimporter, iliimporter
+from projectgenerator.libili2db import iliimporter, iliimporter, ili2dbjob
+from projectgenerator.libqgsprojectgen.dbconnector import pg_connector
 from projectgenerator.tests.utils import iliimporter_config, ilidataimporter_config, testdata_path
 from qgis.testing import unittest, start_app
 from qgis import utils
 
 start_app()
 
+# Model versions of the test models as resolved by the IliCache
+CIAF_LADM_VERSIONS = ['CIAF_LADM 2017-08-01 33e09413a08e96db278828bf0244a332',
+                      'Catastro_COL_ES_V2_1_6 2017-07-12 V2.1.6 806a24a65e53b8ffd9d5310d9025edec',
+                      'ISO19107_V1_MAGNABOG 2016-03-07 cfaa4a99f81b829e767de36c0c71570a']
+
 
 class TestImport(unittest.TestCase):
 
@@ -176,6 +182,451 @@ class TestImport(unittest.TestCase):
         cursor.close()
         conn.close()
 
+    def test_import_deferred_indexes_postgis(self):
+        # Schema Import
+        importer = iliimporter.Importer()
+        importer.tool_name = 'ili2pg'
+        importer.configuration = iliimporter_config(
+            importer.tool_name, 'ilimodels/CIAF_LADM')
+        importer.configuration.ilimodels = 'CIAF_LADM'
+        importer.configuration.dbschema = 'ciaf_ladm_{:%Y%m%d%H%M%S%f}'.format(
+            datetime.datetime.now())
+        importer.configuration.epsg = 3116
+        importer.stdout.connect(self.print_info)
+        importer.stderr.connect(self.print_error)
+        self.assertEqual(importer.run(), iliimporter.Importer.SUCCESS)
+
+        conn = psycopg2.connect(importer.configuration.uri)
+        cursor = conn.cursor()
+
+        def indexes_and_foreign_keys():
+            cursor.execute("""
+                    SELECT indexname, indexdef
+                    FROM pg_indexes
+                    WHERE schemaname = %s
+                    ORDER BY indexname
+                """, (importer.configuration.dbschema,))
+            indexes = cursor.fetchall()
+            cursor.execute("""
+                    SELECT con.conname, con.convalidated
+                    FROM pg_constraint con
+                    JOIN pg_namespace n ON n.oid = con.connamespace
+                    WHERE n.nspname = %s AND con.contype = 'f'
+                    ORDER BY con.conname
+                """, (importer.configuration.dbschema,))
+            return indexes, cursor.fetchall()
+
+        before = indexes_and_foreign_keys()
+        self.assertTrue(before[1])
+
+        # Import data
+        dataImporter = iliimporter.Importer(dataImport=True)
+        dataImporter.tool_name = 'ili2pg'
+        dataImporter.configuration = ilidataimporter_config(
+            dataImporter.tool_name, 'ilimodels/CIAF_LADM')
+        dataImporter.configuration.ilimodels = 'CIAF_LADM'
+        dataImporter.configuration.dbschema = importer.configuration.dbschema
+        dataImporter.configuration.xtffile = testdata_path(
+            'xtf/test_ciaf_ladm.xtf')
+        dataImporter.configuration.defer_indexes = True
+        dataImporter.stdout.connect(self.print_info)
+        dataImporter.stderr.connect(self.print_error)
+        self.assertEqual(dataImporter.run(),
+                         iliimporter.Importer.SUCCESS)
+
+        # The same indexes and foreign keys are back and validated
+        self.assertEqual(before, indexes_and_foreign_keys())
+        cursor.execute("""
+                SELECT count(*)
+                FROM {}.predio
+            """.format(importer.configuration.dbschema))
+        self.assertEqual(1, cursor.fetchone()[0])
+        self.assertIsNone(dataImporter.db_connector().get_deferred_indexes())
+
+        # An import killed before the rebuild leaves the definitions in the
+        # schema, the next import rebuilds them
+        connector = dataImporter.db_connector()
+        deferred = connector.defer_indexes_and_foreign_keys()
+        connector.conn.close()
+        self.assertNotEqual(before, indexes_and_foreign_keys())
+        self.assertEqual(deferred, dataImporter.db_connector().get_deferred_indexes())
+
+        dataImporter = iliimporter.Importer(dataImport=True)
+        dataImporter.tool_name = 'ili2pg'
+        dataImporter.configuration = ilidataimporter_config(
+            dataImporter.tool_name, 'ilimodels/CIAF_LADM')
+        dataImporter.configuration.ilimodels = 'CIAF_LADM'
+        dataImporter.configuration.dbschema = importer.configuration.dbschema
+        dataImporter.configuration.xtffile = testdata_path(
+            'xtf/test_empty_ciaf_ladm.xtf')
+        dataImporter.stdout.connect(self.print_info)
+        dataImporter.stderr.connect(self.print_error)
+        self.assertTrue(dataImporter.can_start())
+        job = ili2dbjob.Ili2dbJob(dataImporter)
+        self.assertTrue(job.start())
+        # The check for dropped indexes runs in the background
+        self.assertTrue(job.running)
+        self.assertEqual(job.wait(),
+                         iliimporter.Importer.SUCCESS)
+
+        self.assertEqual(before, indexes_and_foreign_keys())
+        self.assertIsNone(dataImporter.db_connector().get_deferred_indexes())
+        conn.close()
+
+    def test_template_schema_postgis(self):
+        schemas = list()
+        for index in range(2):
+            importer = iliimporter.Importer()
+            importer.tool_name = 'ili2pg'
+            importer.configuration = iliimporter_config(
+                importer.tool_name, 'ilimodels/CIAF_LADM')
+            importer.configuration.ilimodels = 'CIAF_LADM'
+            importer.configuration.dbschema = 'ciaf_ladm_{:%Y%m%d%H%M%S%f}'.format(
+                datetime.datetime.now())
+            importer.configuration.epsg = 3116
+            importer.configuration.use_template_schema = True
+            importer.configuration.model_versions = CIAF_LADM_VERSIONS
+            importer.stdout.connect(self.print_info)
+            importer.stderr.connect(self.print_error)
+            self.assertEqual(importer.run(), iliimporter.Importer.SUCCESS)
+            self.assertTrue(importer.schema_unchanged())
+            schemas.append(importer.configuration.dbschema)
+
+        conn = psycopg2.connect(importer.configuration.uri)
+        cursor = conn.cursor()
+        cursor.execute("""
+                SELECT count(*)
+                FROM pg_namespace
+                WHERE nspname = %s
+            """, (importer.configuration.template_schema,))
+        self.assertEqual(1, cursor.fetchone()[0])
+
+        # Clones hold the same metadata and take data
+        cursor.execute("""
+                SELECT iliname, sqlname
+                FROM {}.t_ili2db_classname
+                ORDER BY iliname
+            """.format(importer.configuration.template_schema))
+        classnames = cursor.fetchall()
+        for schema in schemas:
+            cursor.execute("""
+                    SELECT iliname, sqlname
+                    FROM {}.t_ili2db_classname
+                    ORDER BY iliname
+                """.format(schema))
+            self.assertEqual(classnames, cursor.fetchall())
+
+        # Sequences keep their parameters
+        sequences_query = """
+                SELECT sequencename, data_type, start_value, min_value, max_value, increment_by, cycle, cache_size
+                FROM pg_sequences
+                WHERE schemaname = %s
+                ORDER BY sequencename
+            """
+        cursor.execute(sequences_query, (importer.configuration.template_schema,))
+        sequences = cursor.fetchall()
+        self.assertTrue(sequences)
+        for schema in schemas:
+            cursor.execute(sequences_query, (schema,))
+            self.assertEqual(sequences, cursor.fetchall())
+
+        # Clones do not wait for each other, only for the template being set up
+        cursor.execute("SELECT pg_advisory_lock_shared(hashtext(%s))", (importer.configuration.template_schema,))
+        importer.configuration.dbschema = 'ciaf_ladm_{:%Y%m%d%H%M%S%f}'.format(datetime.datetime.now())
+        self.assertEqual(importer.run(), iliimporter.Importer.SUCCESS)
+        cursor.execute("SELECT pg_advisory_unlock_shared(hashtext(%s))", (importer.configuration.template_schema,))
+
+        dataImporter = iliimporter.Importer(dataImport=True)
+        dataImporter.tool_name = 'ili2pg'
+        dataImporter.configuration = ilidataimporter_config(
+            dataImporter.tool_name, 'ilimodels/CIAF_LADM')
+        dataImporter.configuration.ilimodels = 'CIAF_LADM'
+        dataImporter.configuration.dbschema = schemas[-1]
+        dataImporter.configuration.xtffile = testdata_path(
+            'xtf/test_ciaf_ladm.xtf')
+        dataImporter.stdout.connect(self.print_info)
+        dataImporter.stderr.connect(self.print_error)
+        self.assertEqual(dataImporter.run(),
+                         iliimporter.Importer.SUCCESS)
+
+        cursor.execute("""
+                SELECT count(*)
+                FROM {}.predio
+            """.format(schemas[-1]))
+        self.assertEqual(1, cursor.fetchone()[0])
+        conn.close()
+
+    def test_prune_template_schemas_postgis(self):
+        importer = iliimporter.Importer()
+        importer.tool_name = 'ili2pg'
+        importer.configuration = iliimporter_config(importer.tool_name, 'ilimodels/CIAF_LADM')
+        prefix = 'ili2db_template_prune{:%Y%m%d%H%M%S%f}_'.format(datetime.datetime.now())
+
+        conn = psycopg2.connect(importer.configuration.uri)
+        cursor = conn.cursor()
+        for name, used in (('current', None), ('new', '300'), ('old', '100'), ('locked', '50'), ('never', None)):
+            cursor.execute("CREATE SCHEMA {}{}".format(prefix, name))
+            cursor.execute("CREATE TABLE {}{}.t_ili2db_settings (tag varchar(60) PRIMARY KEY, setting varchar(255))".format(
+                prefix, name))
+            if used:
+                cursor.execute("INSERT INTO {}{}.t_ili2db_settings VALUES (%s, %s)".format(prefix, name),
+                               (pg_connector.TEMPLATE_USED_TAG, used))
+        conn.commit()
+        # Being cloned by another session
+        cursor.execute("SELECT pg_advisory_lock_shared(hashtext(%s))", (prefix + 'locked',))
+        conn.commit()
+
+        connector = pg_connector.PGConnector(importer.configuration.uri, prefix + 'current')
+        connector.mark_schema_used()
+        # Only the current one and the newest other one are kept, unless locked
+        self.assertEqual([prefix + 'old', prefix + 'never'], connector.prune_template_schemas(prefix, 2))
+        connector.conn.close()
+
+        cursor.execute("SELECT pg_advisory_unlock_shared(hashtext(%s))", (prefix + 'locked',))
+        cursor.execute("SELECT nspname FROM pg_namespace WHERE nspname LIKE %s ORDER BY nspname",
+                       (prefix.replace('_', '\\_') + '%',))
+        self.assertEqual([prefix + name for name in ('current', 'locked', 'new')],
+                         [record[0] for record in cursor.fetchall()])
+        for name in ('current', 'locked', 'new'):
+            cursor.execute("DROP SCHEMA {}{} CASCADE".format(prefix, name))
+        conn.commit()
+        conn.close()
+
+    def test_template_schema_jobs_postgis(self):
+        # Jobs taking more than one step run at the same time
+        jobs = list()
+        for index in range(2):
+            importer = iliimporter.Importer()
+            importer.tool_name = 'ili2pg'
+            importer.configuration = iliimporter_config(
+                importer.tool_name, 'ilimodels/CIAF_LADM')
+            importer.configuration.ilimodels = 'CIAF_LADM'
+            importer.configuration.dbschema = 'ciaf_ladm_job_{:%Y%m%d%H%M%S%f}'.format(
+                datetime.datetime.now())
+            importer.configuration.epsg = 3116
+            importer.configuration.use_template_schema = True
+            importer.configuration.model_versions = CIAF_LADM_VERSIONS
+            importer.stdout.connect(self.print_info)
+            importer.stderr.connect(self.print_error)
+            job = ili2dbjob.Ili2dbJob(importer)
+            self.assertTrue(job.start())
+            jobs.append(job)
+
+        self.assertTrue(all(job.running for job in jobs))
+        self.assertEqual([iliimporter.Importer.SUCCESS] * 2, [job.wait() for job in jobs])
+        for job in jobs:
+            self.assertTrue(job.runner.schema_unchanged())
+
+    def test_skip_unchanged_schema_geopackage(self):
+        importer = iliimporter.Importer()
+        importer.tool_name = 'ili2gpkg'
+        importer.configuration = iliimporter_config(
+            importer.tool_name, 'ilimodels/CIAF_LADM')
+        importer.configuration.ilimodels = 'CIAF_LADM'
+        importer.configuration.dbfile = os.path.join(
+            self.basetestpath, 'tmp_import_fingerprint_gpkg.gpkg')
+        importer.configuration.epsg = 3116
+        importer.configuration.model_versions = CIAF_LADM_VERSIONS
+        importer.stdout.connect(self.print_info)
+        importer.stderr.connect(self.print_error)
+        self.assertFalse(importer.schema_unchanged())
+        self.assertEqual(importer.run(), iliimporter.Importer.SUCCESS)
+        self.assertTrue(importer.schema_unchanged())
+
+        # Other options or model versions need a new schema import
+        importer.configuration.inheritance = 'smart2'
+        self.assertFalse(importer.schema_unchanged())
+        importer.configuration.inheritance = 'smart1'
+        self.assertTrue(importer.schema_unchanged())
+        importer.configuration.model_versions = ['CIAF_LADM 2018-01-01 d3b07384d113edec49eaa6238ad5ff00']
+        self.assertFalse(importer.schema_unchanged())
+
+        # Unknown model versions or forcing the import never skip it
+        importer.configuration.model_versions = None
+        self.assertFalse(importer.schema_unchanged())
+        importer.configuration.model_versions = CIAF_LADM_VERSIONS
+        importer.configuration.force_schema_import = True
+        self.assertFalse(importer.schema_unchanged())
+
+    def test_gpkg_template_geopackage(self):
+        base_configuration = iliimporter_config('ili2gpkg', 'ilimodels/CIAF_LADM').base_configuration
+        base_configuration.gpkg_template_path = os.path.join(self.basetestpath, 'gpkg_templates')
+
+        dbfiles = list()
+        for index in range(2):
+            importer = iliimporter.Importer()
+            importer.tool_name = 'ili2gpkg'
+            importer.configuration = iliimporter_config(
+                importer.tool_name, 'ilimodels/CIAF_LADM')
+            importer.configuration.base_configuration = base_configuration
+            importer.configuration.ilimodels = 'CIAF_LADM'
+            importer.configuration.dbfile = os.path.join(
+                self.basetestpath, 'tmp_import_template_{}.gpkg'.format(index))
+            importer.configuration.epsg = 3116
+            importer.configuration.model_versions = CIAF_LADM_VERSIONS
+            process_started = list()
+            process_finished = list()
+            importer.process_started.connect(process_started.append)
+            importer.process_finished.connect(lambda exit_code, result: process_finished.append((exit_code, result)))
+            importer.stdout.connect(self.print_info)
+            importer.stderr.connect(self.print_error)
+            self.assertEqual(importer.run(), iliimporter.Importer.SUCCESS)
+            self.assertTrue(importer.schema_unchanged())
+            # Only the first GeoPackage is created by ili2db, copies are reported the same way
+            self.assertEqual(1, len(process_started))
+            self.assertEqual(index == 0, '--schemaimport' in process_started[0])
+            self.assertEqual([(0, iliimporter.Importer.SUCCESS)], process_finished)
+            dbfiles.append(importer.configuration.dbfile)
+
+        # The copy takes data
+        dataImporter = iliimporter.Importer(dataImport=True)
+        dataImporter.tool_name = 'ili2gpkg'
+        dataImporter.configuration = ilidataimporter_config(
+            dataImporter.tool_name, 'ilimodels/CIAF_LADM')
+        dataImporter.configuration.ilimodels = 'CIAF_LADM'
+        dataImporter.configuration.dbfile = dbfiles[-1]
+        dataImporter.configuration.xtffile = testdata_path(
+            'xtf/test_ciaf_ladm.xtf')
+        dataImporter.stdout.connect(self.print_info)
+        dataImporter.stderr.connect(self.print_error)
+        self.assertEqual(dataImporter.run(),
+                         iliimporter.Importer.SUCCESS)
+
+        conn = utils.spatialite_connect(dbfiles[-1])
+        cursor = conn.cursor()
+        cursor.execute("SELECT count(*) FROM predio")
+        self.assertEqual(1, cursor.fetchone()[0])
+        cursor.close()
+        conn.close()
+
+    def test_import_job_geopackage(self):
+        importer = iliimporter.Importer()
+        importer.tool_name = 'ili2gpkg'
+        importer.configuration = iliimporter_config(
+            importer.tool_name, 'ilimodels/CIAF_LADM')
+        importer.configuration.ilimodels = 'CIAF_LADM'
+        importer.configuration.dbfile = os.path.join(
+            self.basetestpath, 'tmp_import_job_gpkg.gpkg')
+        importer.configuration.epsg = 3116
+        importer.stdout.connect(self.print_info)
+        importer.stderr.connect(self.print_error)
+
+        # Starting returns right away and the job reports its progress
+        job = ili2dbjob.Ili2dbJob(importer)
+        progress = list()
+        job.progress_changed.connect(progress.append)
+        self.assertTrue(job.start())
+        self.assertTrue(job.running)
+        self.assertEqual(iliimporter.Importer.SUCCESS, job.wait())
+        self.assertFalse(job.running)
+        self.assertEqual(sorted(progress), progress)
+        self.assertEqual(100, progress[-1])
+
+        # Canceled jobs fail
+        importer = iliimporter.Importer()
+        importer.tool_name = 'ili2gpkg'
+        importer.configuration = iliimporter_config(
+            importer.tool_name, 'ilimodels/CIAF_LADM')
+        importer.configuration.ilimodels = 'CIAF_LADM'
+        importer.configuration.dbfile = os.path.join(
+            self.basetestpath, 'tmp_import_job_canceled_gpkg.gpkg')
+        job = ili2dbjob.Ili2dbJob(importer)
+        self.assertTrue(job.start())
+        job.cancel()
+        self.assertEqual(iliimporter.Importer.ERROR, job.wait())
+        self.assertTrue(job.canceled)
+
+    def test_import_job_geopackage_template(self):
+        # Jobs of importers taking more than one step go through start_run()
+        results = list()
+        for name in ('tmp_import_job_template_gpkg.gpkg', 'tmp_import_job_from_template_gpkg.gpkg'):
+            importer = iliimporter.Importer()
+            importer.tool_name = 'ili2gpkg'
+            importer.configuration = iliimporter_config(
+                importer.tool_name, 'ilimodels/CIAF_LADM')
+            importer.configuration.ilimodels = 'CIAF_LADM'
+            importer.configuration.dbfile = os.path.join(self.basetestpath, name)
+            importer.configuration.epsg = 3116
+            importer.configuration.model_versions = CIAF_LADM_VERSIONS
+            importer.configuration.base_configuration.gpkg_templates_enabled = True
+            importer.configuration.base_configuration.gpkg_template_path = os.path.join(
+                self.basetestpath, 'job_templates')
+            importer.stdout.connect(self.print_info)
+            importer.stderr.connect(self.print_error)
+            self.assertFalse(importer.can_start())
+
+            job = ili2dbjob.Ili2dbJob(importer)
+            finished = list()
+            job.finished.connect(finished.append)
+            self.assertTrue(job.start())
+            # Copying the template finishes right away, the signal follows once start() returned
+            self.assertEqual([], finished)
+            results.append(job.wait())
+            self.assertEqual(100, job.progress)
+            self.assertTrue(os.path.isfile(importer.configuration.dbfile))
+
+        self.assertEqual([iliimporter.Importer.SUCCESS] * 2, results)
+        self.assertEqual(1, len(os.listdir(os.path.join(self.basetestpath, 'job_templates'))))
+
+    def test_batch_import_postgis(self):
+        # Schema Import
+        importer = iliimporter.Importer()
+        importer.tool_name = 'ili2pg'
+        importer.configuration = iliimporter_config(
+            importer.tool_name, 'ilimodels/CIAF_LADM')
+        importer.configuration.ilimodels = 'CIAF_LADM'
+        importer.configuration.dbschema = 'ciaf_ladm_{:%Y%m%d%H%M%S%f}'.format(
+            datetime.datetime.now())
+        importer.configuration.epsg = 3116
+        importer.configuration.inheritance = 'smart2'
+        importer.configuration.create_basket_col = True
+        importer.stdout.connect(self.print_info)
+        importer.stderr.connect(self.print_error)
+        self.assertEqual(importer.run(), iliimporter.Importer.SUCCESS)
+
+        # Import data, a failing file does not stop the others
+        batchImporter = iliimporter.BatchImporter()
+        batchImporter.tool_name = 'ili2pg'
+        batchImporter.configuration = ilidataimporter_config(
+            batchImporter.tool_name, 'ilimodels/CIAF_LADM')
+        batchImporter.configuration.ilimodels = 'CIAF_LADM'
+        batchImporter.configuration.dbschema = importer.configuration.dbschema
+        batchImporter.configuration.create_basket_col = True
+        batchImporter.configuration.defer_indexes = True
+        batchImporter.add_file(testdata_path('xtf/test_ciaf_ladm.xtf'), 'full')
+        batchImporter.add_file(os.path.join(self.basetestpath, 'missing.xtf'), 'missing')
+        batchImporter.add_file(testdata_path('xtf/test_empty_ciaf_ladm.xtf'), 'empty')
+        batchImporter.stdout.connect(self.print_info)
+        batchImporter.stderr.connect(self.print_error)
+        results = batchImporter.run()
+
+        self.assertEqual(['full', 'missing', 'empty'], [result.dataset for result in results])
+        self.assertEqual([iliimporter.Importer.SUCCESS, iliimporter.Importer.ERROR, iliimporter.Importer.SUCCESS],
+                         [result.result for result in results])
+
+        conn = psycopg2.connect(importer.configuration.uri)
+        cursor = conn.cursor()
+        cursor.execute("""
+                SELECT datasetname
+                FROM {}.t_ili2db_dataset
+            """.format(importer.configuration.dbschema))
+        self.assertEqual({'full', 'empty'}, {record[0] for record in cursor})
+
+        # The indexes and foreign keys dropped after the first file are back
+        cursor.execute("""
+                SELECT count(*)
+                FROM pg_constraint con
+                JOIN pg_namespace n ON n.oid = con.connamespace
+                WHERE n.nspname = %s AND con.contype = 'f' AND con.convalidated
+            """, (importer.configuration.dbschema,))
+        self.assertTrue(cursor.fetchone()[0])
+        cursor.execute("""
+                SELECT count(*)
+                FROM {}.t_ili2db_settings
+                WHERE tag LIKE 'ch.opengis.projectgenerator.deferredIndexes.%'
+            """.format(importer.configuration.dbschema))
+        self.assertEqual(0, cursor.fetchone()[0])
+
     def print_info(self, text):
         print(text)
 
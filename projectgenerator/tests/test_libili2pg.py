@@ -2,13 +2,26 @@ import qgis
 from qgis.testing import unittest, start_app
 start_app()
 from projectgenerator.libili2db import ilicache
+from projectgenerator.libili2db import ili2dbconfig, ili2dbutils, ili2dbevents, iliexporter, javaruntime, gpkgtemplates, iliworker
 from projectgenerator.libili2db.ili2dbconfig import BaseConfiguration
 
 import os
+import re
 import nose2
-
+import shutil
+import threading
+import functools
+import http.server
+import hashlib
+import zipfile
+import sys
+import stat
 
 import tempfile
+from unittest import mock
+from qgis.PyQt.QtCore import QEventLoop, QTimer, QLockFile
+from projectgenerator.tests.utils import testdata_path
+from projectgenerator.utils.qt_utils import download_file_resumable, NetworkError
 
 
 class IliCacheTest(unittest.TestCase):
@@ -20,5 +33,1070 @@ class IliCacheTest(unittest.TestCase):
         ic.cache_path = tempfile.mkdtemp()
         ic.refresh()
 
+    def test_model_directories(self):
+        root = tempfile.mkdtemp()
+        for directory in ('a', 'a/.hidden', 'b/c', 'd'):
+            os.makedirs(os.path.join(root, directory))
+        for ilifile in ('a/x.ili', 'a/.hidden/y.ili', 'b/c/z.ili', 'd/readme.txt'):
+            open(os.path.join(root, ilifile), 'w').close()
+
+        model_directories = ili2dbutils.get_model_directories(root)
+        self.assertEqual([(os.path.join(root, 'a'), [os.path.join(root, 'a/x.ili')]),
+                          (os.path.join(root, 'b/c'), [os.path.join(root, 'b/c/z.ili')])], model_directories)
+        self.assertEqual('{};{}'.format(os.path.join(root, 'a'), os.path.join(root, 'b/c')),
+                         ili2dbutils.get_all_modeldir_in_path(root))
+
+        # Unmodified trees are not walked again
+        self.assertIs(model_directories, ili2dbutils.get_model_directories(root))
+        open(os.path.join(root, 'd/w.ili'), 'w').close()
+        self.assertEqual(os.path.join(root, 'd'), ili2dbutils.get_model_directories(root)[-1][0])
+
+    def test_merge_xtf_files(self):
+        root = tempfile.mkdtemp()
+        xtffiles = list()
+        for name, datasection in (('a', '<DATASECTION>\n<M.T BID="a"><M.T.C TID="1"/></M.T>\n</DATASECTION>'),
+                                  ('b', '<DATASECTION/>'),
+                                  ('c', '<DATASECTION>\n<M.T BID="c"><M.T.C TID="2"/></M.T>\n</DATASECTION>')):
+            xtffiles.append(os.path.join(root, '{}.xtf'.format(name)))
+            with open(xtffiles[-1], 'w') as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?><TRANSFER xmlns="http://www.interlis.ch/INTERLIS2.3">\n'
+                        '<HEADERSECTION SENDER="{}" VERSION="2.3"><MODELS/></HEADERSECTION>\n'
+                        '{}\n</TRANSFER>'.format(name, datasection))
+
+        target = os.path.join(root, 'merged.xtf')
+        ili2dbutils.merge_xtf_files(xtffiles[1:] + xtffiles[:1], target, chunk_size=7)
+        with open(target) as f:
+            merged = f.read()
+        self.assertIn('SENDER="b"', merged)
+        self.assertEqual(['c', 'a'], re.findall(r'BID="(\w+)"', merged))
+        self.assertTrue(merged.endswith('</DATASECTION>\n</TRANSFER>'))
+
+    def test_ili2db_output_parser(self):
+        output = ('Info: compile models…\n'
+                  'Warning: Straße\n'
+                  'Info: process data file <data.xtf>...\n'
+                  'Info: 4 objects in CLASS CIAF_LADM.Catastro.Predio\n'
+                  'Info: ...import done\n').encode('utf-8')
+        parser = ili2dbevents.Ili2dbOutputParser('utf-8')
+        text = ''
+        events = list()
+        # Chunks split lines and multibyte characters
+        for position in range(0, len(output), 5):
+            chunk_text, chunk_events = parser.feed(output[position:position + 5])
+            text += chunk_text
+            events += chunk_events
+        self.assertEqual(output.decode('utf-8'), text)
+        self.assertEqual(('', []), parser.finish())
+
+        self.assertEqual([ili2dbevents.PHASE_STARTED, ili2dbevents.WARNING, ili2dbevents.PHASE_FINISHED,
+                          ili2dbevents.PHASE_STARTED, ili2dbevents.OBJECT_COUNT, ili2dbevents.PHASE_FINISHED,
+                          ili2dbevents.DONE], [event.kind for event in events])
+        self.assertEqual('Warning: Straße', events[1].text)
+        self.assertEqual((4, 'CIAF_LADM.Catastro.Predio'), (events[4].count, events[4].name))
+        self.assertEqual('import', events[-1].action)
+        self.assertEqual(['compile models', 'process data file <data.xtf>'], list(parser.phase_durations))
+
+    def test_java_major_version(self):
+        self.assertEqual(6, javaruntime.java_major_version('1.6.0_45'))
+        self.assertEqual(8, javaruntime.java_major_version('1.8.0_292'))
+        self.assertEqual(11, javaruntime.java_major_version('11.0.2'))
+        self.assertEqual(17, javaruntime.java_major_version('17'))
+        self.assertEqual(0, javaruntime.java_major_version(''))
+
+    def test_java_runtime(self):
+        basetestpath = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basetestpath, True)
+        self.addCleanup(javaruntime.invalidate_java_runtimes)
+        java_path = os.path.join(basetestpath, 'java')
+        with open(java_path, 'w') as f:
+            f.write('#!{}\nimport sys\nsys.stderr.write("    java.version = 17.0.2\\n")\n'.format(sys.executable))
+        os.chmod(java_path, os.stat(java_path).st_mode | stat.S_IEXEC)
+
+        # The configured and the resolved path share one probe
+        with mock.patch.object(javaruntime, '_run_probe', wraps=javaruntime._run_probe) as run_probe:
+            runtime = javaruntime.get_java_runtime(java_path)
+            self.assertEqual(17, runtime.major_version)
+            self.assertEqual(runtime, javaruntime.get_java_runtime(runtime.path))
+            self.assertEqual(1, run_probe.call_count)
+
+        # Windows finds executables without their extension
+        with mock.patch.object(javaruntime.os, 'name', 'nt'), \
+                mock.patch.dict(javaruntime.os.environ, {'PATHEXT': '.EXE'}), \
+                mock.patch.object(javaruntime.shutil, 'which',
+                                  side_effect=lambda path: path if path.endswith('.EXE') else None):
+            self.assertEqual(r'C:\Java\bin\java.EXE', javaruntime.find_executable(r'C:\Java\bin\java'))
+
+    def test_jvm_profile_args(self):
+        gigabyte = 1024 * 1024 * 1024
+        with mock.patch.object(ili2dbutils, 'get_physical_memory', return_value=(16 * gigabyte, 12 * gigabyte)), \
+                mock.patch.object(ili2dbutils.os, 'cpu_count', return_value=4):
+            # Small transfer files run with the JVM defaults
+            self.assertEqual([], ili2dbutils.get_jvm_profile_args(0))
+            self.assertEqual([], ili2dbutils.get_jvm_profile_args(ili2dbutils.JVM_PROFILE_MIN_INPUT_SIZE - 1))
+
+            # Never less than the default heap of a quarter of the memory
+            self.assertEqual(['-Xmx4096m', '-XX:+UseParallelGC', '-XX:ParallelGCThreads=4'],
+                             ili2dbutils.get_jvm_profile_args(ili2dbutils.JVM_PROFILE_MIN_INPUT_SIZE))
+            # Four times the transfer file plus 512 MB
+            self.assertEqual('-Xmx8704m', ili2dbutils.get_jvm_profile_args(2 * gigabyte)[0])
+            # Not more than the available memory
+            self.assertEqual('-Xmx12288m', ili2dbutils.get_jvm_profile_args(10 * gigabyte)[0])
+            # Processes running at the same time share the memory and the CPUs
+            self.assertEqual(['-Xmx3072m', '-XX:+UseParallelGC', '-XX:ParallelGCThreads=1'],
+                             ili2dbutils.get_jvm_profile_args(10 * gigabyte, process_count=4))
+            self.assertEqual(['-Xmx2048m', '-XX:+UseParallelGC', '-XX:ParallelGCThreads=2'],
+                             ili2dbutils.get_jvm_profile_args(ili2dbutils.JVM_PROFILE_MIN_INPUT_SIZE, 2))
+
+            configuration = ili2dbconfig.ImportDataConfiguration()
+            configuration.base_configuration.jvm_options = ''
+            configuration.base_configuration.jvm_auto_options_enabled = True
+            configuration.xtffile = os.path.join(tempfile.mkdtemp(), 'data.xtf')
+            with open(configuration.xtffile, 'wb') as f:
+                f.truncate(2 * gigabyte)
+            self.assertEqual('-Xmx8704m', configuration.to_jvm_args()[0])
+            configuration.process_count = 4
+            self.assertEqual('-Xmx3072m', configuration.to_jvm_args()[0])
+            shutil.rmtree(os.path.dirname(configuration.xtffile), True)
+
+        with mock.patch.object(ili2dbutils, 'get_physical_memory', return_value=(16 * gigabyte, None)), \
+                mock.patch.object(ili2dbutils.os, 'cpu_count', return_value=32):
+            # Three quarters of the memory if the available memory is unknown
+            # and not more than 8 garbage collector threads
+            self.assertEqual(['-Xmx12288m', '-XX:+UseParallelGC', '-XX:ParallelGCThreads=8'],
+                             ili2dbutils.get_jvm_profile_args(10 * gigabyte))
+
+        with mock.patch.object(ili2dbutils, 'get_physical_memory', return_value=(None, None)):
+            self.assertEqual([], ili2dbutils.get_jvm_profile_args(10 * gigabyte))
+
+        with mock.patch.object(ili2dbutils, 'get_physical_memory', return_value=(16 * gigabyte, 2 * gigabyte)), \
+                mock.patch.object(ili2dbutils.os, 'cpu_count', return_value=None):
+            # The floor of a quarter of the memory wins over little available memory
+            self.assertEqual(['-Xmx4096m', '-XX:+UseParallelGC', '-XX:ParallelGCThreads=1'],
+                             ili2dbutils.get_jvm_profile_args(10 * gigabyte))
+
+    def test_jvm_options(self):
+        configuration = BaseConfiguration()
+        configuration.jvm_auto_options_enabled = False
+        self.assertEqual([], configuration.to_jvm_args())
+        configuration.jvm_options = '-Xmx2g  -Dfile.encoding=UTF-8 "-Djava.io.tmpdir=C:\\Users\\My User\\Temp" ' \
+                                    "-Dhttp.nonProxyHosts='localhost|*.example.com'"
+        self.assertEqual(['-Xmx2g', '-Dfile.encoding=UTF-8', '-Djava.io.tmpdir=C:\\Users\\My User\\Temp',
+                          '-Dhttp.nonProxyHosts=localhost|*.example.com'], configuration.to_jvm_args())
+
+    def test_cds_archive(self):
+        basetestpath = tempfile.mkdtemp()
+        java_path = os.path.join(basetestpath, 'java')
+        ili2db_bin = os.path.join(basetestpath, 'ili2pg.jar')
+        for path in (java_path, ili2db_bin):
+            with open(path, 'w') as f:
+                f.write('1')
+        java = javaruntime.JavaRuntime(java_path, '17.0.1', 17, 'Vendor')
+
+        # No archive yet: the JVM dumps one at exit
+        args, dump_path = ili2dbutils.get_cds_args(java, ili2db_bin)
+        self.assertEqual(['-XX:+IgnoreUnrecognizedVMOptions', '-XX:ArchiveClassesAtExit={}'.format(dump_path)], args)
+        self.assertNotEqual(dump_path, ili2dbutils.get_cds_args(java, ili2db_bin)[1])
+
+        # The JVM did not dump an archive (e.g. Java < 13)
+        ili2dbutils.store_cds_archive(dump_path, java, ili2db_bin)
+        self.assertIsNotNone(ili2dbutils.get_cds_args(java, ili2db_bin)[1])
+
+        with open(dump_path, 'w') as f:
+            f.write('archive')
+        ili2dbutils.store_cds_archive(dump_path, java, ili2db_bin)
+        self.assertFalse(os.path.exists(dump_path))
+        args, archive_dump_path = ili2dbutils.get_cds_args(java, ili2db_bin)
+        self.assertIsNone(archive_dump_path)
+        archive_path = args[1][len('-XX:SharedArchiveFile='):]
+        with open(archive_path) as f:
+            self.assertEqual('archive', f.read())
+
+        # Archives are not used with another Java, a Java or an ili2db updated in place
+        self.assertIsNotNone(ili2dbutils.get_cds_args(java._replace(version='17.0.2'), ili2db_bin)[1])
+        self.assertIsNotNone(ili2dbutils.get_cds_args(java._replace(path=ili2db_bin), ili2db_bin)[1])
+        for path in (java_path, ili2db_bin):
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+            self.assertIsNotNone(ili2dbutils.get_cds_args(java, ili2db_bin)[1])
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertIsNone(ili2dbutils.get_cds_args(java, ili2db_bin)[1])
+
+    def test_safe_command(self):
+        self.assertEqual('java -Xmx2G -jar ili2pg.jar --dbusr user --dbpwd ****** --dbschema secret x.xtf',
+                         ili2dbutils.get_safe_command('java', ['-Xmx2G', '-jar', 'ili2pg.jar', '--dbusr', 'user',
+                                                               '--dbpwd', 'secret', '--dbschema', 'secret', 'x.xtf']))
+
+    @unittest.skipIf(os.name == 'nt', 'The fake java is a shell script')
+    def test_process_started_command(self):
+        basetestpath = tempfile.mkdtemp()
+        java_path = os.path.join(basetestpath, 'java')
+        with open(java_path, 'w') as f:
+            f.write('#!/bin/sh\necho "    java.version = 17.0.2"\n')
+        os.chmod(java_path, 0o755)
+        ili2db_bin = os.path.join(basetestpath, 'ili2pg.jar')
+        open(ili2db_bin, 'w').close()
+
+        exporter = iliexporter.Exporter()
+        exporter.tool_name = 'ili2pg'
+        exporter.configuration.dbhost = 'localhost'
+        exporter.configuration.dbusr = 'user'
+        exporter.configuration.dbpwd = 'secret'
+        exporter.configuration.database = 'db'
+        exporter.configuration.xtffile = os.path.join(basetestpath, 'x.xtf')
+        commands = list()
+        exporter.process_started.connect(commands.append)
+        proc = exporter.start(ili2db_bin, java_path)
+        proc.waitForFinished()
+
+        # The logged command is the one which was started, with the password masked
+        self.assertEqual([ili2dbutils.get_safe_command(java_path, proc.arguments())], commands)
+        self.assertIn('-XX:ArchiveClassesAtExit=', commands[0])
+        self.assertIn('--dbpwd ******', commands[0])
+        self.assertNotIn('secret', commands[0])
+        shutil.rmtree(basetestpath, True)
+
+    def test_schema_fingerprint(self):
+        configuration = ili2dbconfig.SchemaImportConfiguration()
+        configuration.tool_name = 'ili2pg'
+        configuration.ilimodels = 'CIAF_LADM'
+        configuration.dbschema = 'first'
+        fingerprint = configuration.schema_fingerprint()
+
+        # Connection parameters do not change the schema
+        configuration.dbschema = 'second'
+        configuration.dbhost = 'example.com'
+        self.assertEqual(fingerprint, configuration.schema_fingerprint())
+
+        # Options and models do
+        configuration.inheritance = 'smart2'
+        self.assertNotEqual(fingerprint, configuration.schema_fingerprint())
+        configuration.inheritance = 'smart1'
+        configuration.ilimodels = 'CIAF_LADM;Catastro_COL_ES'
+        self.assertNotEqual(fingerprint, configuration.schema_fingerprint())
+
+        # So does the content of the ili file
+        basetestpath = tempfile.mkdtemp()
+        configuration.ilimodels = 'CIAF_LADM'
+        configuration.ilifile = os.path.join(basetestpath, 'model.ili')
+        shutil.copy(testdata_path('ilimodels/CIAF_LADM/CIAF_LADM.ili'), configuration.ilifile)
+        fingerprint = configuration.schema_fingerprint()
+        with open(configuration.ilifile, 'a') as f:
+            f.write('\n')
+        self.assertNotEqual(fingerprint, configuration.schema_fingerprint())
+        shutil.rmtree(basetestpath, True)
+
+        # And new versions of the models
+        configuration.ilifile = ''
+        self.assertFalse(configuration.can_reuse_schema())
+        configuration.model_versions = ['CIAF_LADM 2017-08-01 c407a562e1e4ecbf4669228ffaa3e050']
+        fingerprint = configuration.schema_fingerprint()
+        self.assertTrue(configuration.can_reuse_schema())
+        configuration.model_versions = ['CIAF_LADM 2017-08-01 d3b07384d113edec49eaa6238ad5ff00']
+        self.assertNotEqual(fingerprint, configuration.schema_fingerprint())
+
+        # Schemas are not reused if forced
+        configuration.force_schema_import = True
+        self.assertFalse(configuration.can_reuse_schema())
+
+    def test_deferred_index_args(self):
+        configuration = ili2dbconfig.ImportDataConfiguration()
+        configuration.tool_name = 'ili2pg'
+        configuration.defer_indexes = True
+        args = configuration.to_ili2db_args()
+        self.assertIn('--createFk', args)
+        args = configuration.to_ili2db_args(with_indexes=False)
+        for arg in ['--createGeomIdx', '--createFk', '--createFkIdx']:
+            self.assertNotIn(arg, args)
+        self.assertIn('--createUnique', args)
+
+    def test_gpkg_template_store(self):
+        basetestpath = tempfile.mkdtemp()
+        store = gpkgtemplates.GpkgTemplateStore(os.path.join(basetestpath, 'templates'), 250)
+        for fingerprint in ['a', 'b', 'c']:
+            source = os.path.join(basetestpath, 'source.gpkg')
+            with open(source, 'wb') as f:
+                f.write(fingerprint.encode('ascii') * 100)
+            store.add(fingerprint, source)
+            # Distinct modification times
+            os.utime(store.template_path(fingerprint), (len(os.listdir(store.path)),) * 2)
+
+        # The least recently used template does not fit anymore
+        self.assertFalse(os.path.exists(store.template_path('a')))
+        target = os.path.join(basetestpath, 'target.gpkg')
+        self.assertFalse(store.copy_to('a', target))
+        self.assertFalse(os.path.exists(target))
+
+        self.assertTrue(store.copy_to('b', target))
+        with open(target, 'rb') as f:
+            self.assertEqual(b'b' * 100, f.read())
+        shutil.rmtree(basetestpath, True)
+
+    def test_local_ili_file_index(self):
+        modeldir = tempfile.mkdtemp()
+        shutil.copy(testdata_path('ilimodels/Units-20120220.ili'), modeldir)
+        cache_path = tempfile.mkdtemp()
+
+        ic = ilicache.IliCache(None)
+        ic.cache_path = cache_path
+        ic.process_local_ili_folder(modeldir)
+        self.assertEqual(['Units'], ic.model_names)
+
+        # A second cache must load the unchanged file from the index
+        ic = ilicache.IliCache(None)
+        ic.cache_path = cache_path
+        ic.process_ili_file = lambda ilifile: self.fail('{} was parsed again'.format(ilifile))
+        ic.process_local_ili_folder(modeldir)
+        self.assertEqual(['Units'], ic.model_names)
+
+        # New files are parsed and added to the index
+        shutil.copy(testdata_path('ilimodels/CoordSys-20151124.ili'), modeldir)
+        ic = ilicache.IliCache(None)
+        ic.cache_path = cache_path
+        ic.process_local_ili_folder(modeldir)
+        self.assertEqual(['CoordSys', 'Units'], sorted(ic.model_names))
+
+    def test_background_refresh(self):
+        modeldir = tempfile.mkdtemp()
+        shutil.copy(testdata_path('ilimodels/Units-20120220.ili'), modeldir)
+        os.mkdir(os.path.join(modeldir, 'sub'))
+        shutil.copy(testdata_path('ilimodels/CoordSys-20151124.ili'), os.path.join(modeldir, 'sub'))
+
+        config = BaseConfiguration()
+        config.custom_model_directories_enabled = True
+        config.custom_model_directories = modeldir
+        ic = ilicache.IliCache(config)
+        ic.cache_path = tempfile.mkdtemp()
+        notifications = list()
+        loop = QEventLoop()
+        ic.models_changed.connect(lambda: notifications.append(True))
+        ic.models_changed.connect(loop.quit)
+        QTimer.singleShot(5000, loop.quit)
+        ic.refresh(background=True)
+        self.assertEqual([], ic.model_names)
+        loop.exec_()
+
+        # Both directories are reported with a single notification
+        self.assertEqual(1, len(notifications))
+        self.assertEqual(['CoordSys', 'Units'], sorted(ic.model_names))
+        self.assertEqual(['CoordSys', 'Units'], sorted(name for name, version in ic.model_index.search('')))
+
+    def test_overlapping_background_refresh(self):
+        config = BaseConfiguration()
+        config.custom_model_directories_enabled = True
+        config.custom_model_directories = tempfile.mkdtemp()
+        ic = ilicache.IliCache(config)
+        ic.cache_path = tempfile.mkdtemp()
+        ic.refresh(background=True)
+        ic.refresh(background=True)
+        self.assertTrue(ic.refreshing)
+
+        # Refreshing until the last scan finished
+        first, second = sorted(ic._refresh_tasks)
+        ic._local_models_scanned(ic._generation, first, None, {})
+        self.assertTrue(ic.refreshing)
+        ic._local_models_scanned(ic._generation, second, None, {})
+        self.assertFalse(ic.refreshing)
+
+    def test_parse_ili_file(self):
+        ic = ilicache.IliCache(BaseConfiguration())
+        # Model names in comments are ignored
+        ilifile = testdata_path('ilimodels/CHBase_Part1_GEOMETRY_20110830.ili')
+        with open(ilifile, 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        models, encoding = ic.parse_ili_file(ilifile)
+        self.assertEqual('utf-8', encoding)
+        self.assertEqual([{'name': 'GeometryCHLV03_V1', 'version': '2017-12-04', 'md5': md5,
+                           'depends_on': ['INTERLIS', 'Units', 'CoordSys']},
+                          {'name': 'GeometryCHLV95_V1', 'version': '2017-12-04', 'md5': md5,
+                           'depends_on': ['INTERLIS', 'Units', 'CoordSys']}], models)
+        models, encoding = ic.parse_ili_file(testdata_path('ilimodels/CHBase_Part2_LOCALISATION_20110830.ili'))
+        self.assertEqual('latin1', encoding)
+        self.assertEqual(['InternationalCodes_V1', 'Localisation_V1', 'LocalisationCH_V1',
+                          'Dictionaries_V1', 'DictionariesCH_V1'], [model['name'] for model in models])
+
+        basetestpath = tempfile.mkdtemp()
+        ilifile = os.path.join(basetestpath, 'comments.ili')
+        with open(ilifile, 'w') as f:
+            f.write('INTERLIS 2.3;\n'
+                    '/* MODEL Block1 = !! MODEL Block2 = */\n'
+                    '!! MODEL Line = /*\n'
+                    'MODEL Real (en) AT "http://example.com" VERSION "2020-01-01" =\n'
+                    '  /* IMPORTS Ignored; */ IMPORTS Units;\n'
+                    'END Real.\n'
+                    '/* MODEL Unterminated =\n')
+        models, encoding = ic.parse_ili_file(ilifile)
+        with open(ilifile, 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        self.assertEqual([{'name': 'Real', 'version': '2020-01-01', 'md5': md5, 'depends_on': ['Units']}], models)
+        shutil.rmtree(basetestpath, True)
+
+    def test_model_versions(self):
+        ic = ilicache.IliCache(None)
+        ic.repositories = {
+            'http://models.example.com': [
+                {'name': 'Units', 'version': '2012-02-20', 'md5': 'aa', 'depends_on': []},
+                {'name': 'Units', 'version': '2010-01-01', 'md5': 'bb', 'depends_on': []},
+                {'name': 'Unused', 'version': '2012-02-20', 'md5': 'cc', 'depends_on': []}],
+            '/models': [
+                {'name': 'Base', 'version': '2020-01-01', 'md5': 'dd', 'depends_on': ['INTERLIS', 'Units']},
+                {'name': 'Orphan', 'version': '', 'md5': 'ee', 'depends_on': ['Missing']}]
+        }
+        self.assertEqual(['Base 2020-01-01 dd', 'Units 2012-02-20 aa'], ic.model_versions('Base'))
+        self.assertIsNone(ic.model_versions('Orphan'))
+        self.assertIsNone(ic.model_versions('Missing'))
+        self.assertIsNone(ic.model_versions(''))
+
+        # A new version in a repository changes the versions
+        ic.repositories['http://models.example.com'].append(
+            {'name': 'Units', 'version': '2020-01-01', 'md5': 'ff', 'depends_on': []})
+        self.assertEqual(['Base 2020-01-01 dd', 'Units 2020-01-01 ff'], ic.model_versions('Base'))
+
+    def test_model_dependencies(self):
+        ic = ilicache.IliCache(None)
+        ic.cache_path = tempfile.mkdtemp()
+        ic.process_local_ili_folder(testdata_path('ilimodels'))
+        ic._process_ilimodels(testdata_path('ilimodels/repo/ilimodels.xml'), 'repo')
+
+        # Local IMPORTS and repository dependencies are followed
+        dependencies, missing = ic.model_dependencies('KbS_LV95_V1_3;ZG_Naturschutz_und_Erholung_V1_0')
+        self.assertEqual({'KbS_LV95_V1_3', 'KbS_Basis_V1_3', 'LocalisationCH_V1', 'Localisation_V1',
+                          'InternationalCodes_V1', 'GeometryCHLV95_V1', 'Units', 'CoordSys',
+                          'ZG_Naturschutz_und_Erholung_V1_0'}, dependencies)
+        self.assertEqual(set(), missing)
+
+        ic.repositories[testdata_path('ilimodels')] = [
+            model for model in ic.repositories[testdata_path('ilimodels')] if model['name'] != 'CoordSys']
+        self.assertEqual({'CoordSys'}, ic.model_dependencies('Hazard_Mapping_LV95_V1_2')[1])
+
+    def test_required_model_directories(self):
+        config = BaseConfiguration()
+        config.model_mirror_path = tempfile.mkdtemp()
+        ic = ilicache.IliCache(config)
+        ic.cache_path = tempfile.mkdtemp()
+        ic.process_local_ili_folder(testdata_path('ilimodels'))
+        ic._repository_urls['repo'] = 'http://example.com/models/'
+        ic._process_ilimodels(testdata_path('ilimodels/repo/ilimodels.xml'), 'repo', 'http://example.com/models/')
+
+        self.assertEqual([testdata_path('ilimodels'), '%JAR_DIR'],
+                         ic.required_model_directories('Hazard_Mapping_LV95_V1_2'))
+        self.assertEqual([testdata_path('ilimodels'), 'http://example.com/models/', '%JAR_DIR'],
+                         ic.required_model_directories('ZG_Naturschutz_und_Erholung_V1_0'))
+
+        # Mirrored files are taken from the mirror
+        open(os.path.join(config.model_mirror_path, '39106630171ec5f52c68ae07074fb263.ili'), 'w').close()
+        directories = ic.required_model_directories('ZG_Naturschutz_und_Erholung_V1_0')
+        self.assertEqual([config.model_mirror_path, testdata_path('ilimodels'), '%JAR_DIR'], directories)
+
+        configuration = ili2dbconfig.SchemaImportConfiguration()
+        configuration.base_configuration = config
+        configuration.required_model_directories = directories
+        args = configuration.to_ili2db_args()
+        self.assertEqual(';'.join(directories), args[args.index('--modeldir') + 1])
+
+        # Unknown models need all model directories
+        self.assertIsNone(ic.required_model_directories('Hazard_Mapping_LV95_V1_2;Unknown_V1'))
+
+    def serve_files(self, files, requests):
+        """
+        Serves the ``files`` dict of paths and contents with support for range
+        requests and records the path and range of every request.
+        """
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append((self.path, self.headers.get('Range')))
+                if self.path not in files:
+                    self.send_error(404)
+                    return
+                data = files[self.path]
+                start = 0
+                if self.headers.get('Range'):
+                    start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(data) - start))
+                self.end_headers()
+                self.wfile.write(data[start:])
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('localhost', 0), RequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        return 'http://localhost:{}'.format(server.server_port)
+
+    def test_download_file_resumable(self):
+        data = os.urandom(100000)
+        requests = list()
+        url = self.serve_files({'/file.zip': data}, requests)
+        basetestpath = tempfile.mkdtemp()
+        filename = os.path.join(basetestpath, 'file.zip')
+
+        # Interrupted downloads are resumed
+        with open(filename + '.part', 'wb') as f:
+            f.write(data[:1000])
+        download_file_resumable(url + '/file.zip', filename)
+        self.assertEqual([('/file.zip', 'bytes=1000-')], requests)
+        with open(filename, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertFalse(os.path.exists(filename + '.part'))
+
+        # Error replies are not kept to resume from
+        filename = os.path.join(basetestpath, 'missing.zip')
+        with open(filename + '.part', 'wb') as f:
+            f.write(data[:1000])
+        with self.assertRaises(NetworkError):
+            download_file_resumable(url + '/missing.zip', filename)
+        self.assertFalse(os.path.exists(filename + '.part'))
+        self.assertFalse(os.path.exists(filename))
+        shutil.rmtree(basetestpath, True)
+
+    def test_install_ili2db(self):
+        basetestpath = tempfile.mkdtemp()
+        zip_file = os.path.join(basetestpath, 'ili2pg-9.9.9.zip')
+        with zipfile.ZipFile(zip_file, 'w') as z:
+            z.writestr('ili2pg-9.9.9/ili2pg.jar', b'jar content')
+        with open(zip_file, 'rb') as f:
+            data = f.read()
+        requests = list()
+        # A flipped byte in the stored jar only shows in its CRC
+        url = self.serve_files({'/ili2pg-9.9.9.zip': data,
+                                '/damaged/ili2pg-9.9.9.zip': data.replace(b'content', b'c0ntent', 1)}, requests)
+
+        tools_dir = ili2dbutils.ILI2DB_TOOLS_DIR
+        lock_timeout = ili2dbutils.ILI2DB_INSTALL_LOCK_TIMEOUT
+        ili2dbutils.ILI2DB_TOOLS_DIR = os.path.join(basetestpath, 'tools')
+        ili2dbutils.ILI2DB_INSTALL_LOCK_TIMEOUT = 200
+        messages = list()
+
+        class Signal(object):
+            def emit(self, text):
+                messages.append(text)
+
+        try:
+            # A wrong checksum is not installed
+            ili2db_tools = {'ili2pg': {'version': '9.9.9', 'url': url + '/ili2pg-9.9.9.zip', 'sha256': '0' * 64}}
+            self.assertIsNone(ili2dbutils.get_ili2db_bin('ili2pg', Signal(), Signal(), ili2db_tools))
+            self.assertTrue([message for message in messages if 'checksum' in message])
+            self.assertFalse(os.path.exists(os.path.join(ili2dbutils.ILI2DB_TOOLS_DIR, 'ili2pg-9.9.9.zip')))
+
+            # Without a checksum damaged files are not installed either
+            del messages[:]
+            ili2db_tools = {'ili2pg': {'version': '9.9.9', 'url': url + '/damaged/ili2pg-9.9.9.zip'}}
+            self.assertIsNone(ili2dbutils.get_ili2db_bin('ili2pg', Signal(), Signal(), ili2db_tools))
+            self.assertTrue([message for message in messages if 'no checksum' in message])
+            self.assertTrue([message for message in messages if 'damaged' in message])
+            self.assertFalse(os.path.exists(os.path.join(ili2dbutils.ILI2DB_TOOLS_DIR, 'ili2pg-9.9.9')))
+
+            # Waiting for another installation ends
+            ili2db_tools = {'ili2pg': {'version': '9.9.9', 'url': url + '/ili2pg-9.9.9.zip'}}
+            ili2db_tools['ili2pg']['sha256'] = hashlib.sha256(data).hexdigest()
+            lock = QLockFile(os.path.join(ili2dbutils.ILI2DB_TOOLS_DIR, 'ili2pg-9.9.9.lock'))
+            self.assertTrue(lock.tryLock())
+            del messages[:]
+            self.assertIsNone(ili2dbutils.get_ili2db_bin('ili2pg', Signal(), Signal(), ili2db_tools))
+            self.assertTrue([message for message in messages if 'Gave up' in message])
+            lock.unlock()
+
+            # Matching files are installed and used
+            ili2db_bin = ili2dbutils.get_ili2db_bin('ili2pg', Signal(), Signal(), ili2db_tools)
+            self.assertEqual(os.path.join(ili2dbutils.ILI2DB_TOOLS_DIR, 'ili2pg-9.9.9', 'ili2pg.jar'), ili2db_bin)
+            del requests[:]
+            self.assertEqual(ili2db_bin, ili2dbutils.get_ili2db_bin('ili2pg', Signal(), Signal(), ili2db_tools))
+            self.assertEqual([], requests)
+        finally:
+            ili2dbutils.ILI2DB_TOOLS_DIR = tools_dir
+            ili2dbutils.ILI2DB_INSTALL_LOCK_TIMEOUT = lock_timeout
+            shutil.rmtree(basetestpath, True)
+
+    def test_model_name_search(self):
+        index = ilicache.IliModelNameIndex()
+        index.update({
+            'a': [{'name': 'Units', 'version': '2012-02-20'},
+                  {'name': 'GeometryCHLV95_V1', 'version': '2015-11-12'}],
+            'b': [{'name': 'Units', 'version': '2016-01-01'},
+                  {'name': 'GeometryCHLV03_V1', 'version': '2015-11-12'},
+                  {'name': 'ZG_Naturschutz_und_Erholung_V1_0', 'version': '2016-03-11'}]
+        })
+
+        # Duplicates are merged and the newest version is kept
+        self.assertEqual([('Units', '2016-01-01')], index.search('units'))
+        # Prefix matches come before substring and fuzzy matches
+        self.assertEqual(['GeometryCHLV03_V1', 'GeometryCHLV95_V1', 'ZG_Naturschutz_und_Erholung_V1_0'],
+                         [name for name, version in index.search('geo')])
+        self.assertEqual(['ZG_Naturschutz_und_Erholung_V1_0'],
+                         [name for name, version in index.search('zgnatur')])
+        # Recently used models come first
+        index.mark_used(['GeometryCHLV95_V1'])
+        self.assertEqual(['GeometryCHLV95_V1', 'GeometryCHLV03_V1', 'ZG_Naturschutz_und_Erholung_V1_0'],
+                         [name for name, version in index.search('geo')])
+        self.assertEqual([], index.search('xyz'))
+
+        # Versions are compared by their numbers
+        index.update({'a': [{'name': 'Units', 'version': '9.0'}],
+                      'b': [{'name': 'Units', 'version': '10.0'}]})
+        self.assertEqual([('Units', '10.0')], index.search('units'))
+
+        # The fuzzy lookup stops when its time is up, after the first chunk
+        index.update({'a': [{'name': 'A_Model_Start', 'version': ''},
+                            {'name': 'Z_Model_End', 'version': ''}] +
+                           [{'name': 'Filler{:04}'.format(i), 'version': ''} for i in range(2000)]})
+        index.fuzzy_search_time = 0
+        self.assertEqual(['A_Model_Start'], [name for name, version in index.search('mdl')])
+        index.fuzzy_search_time = 10
+        self.assertEqual(['A_Model_Start', 'Z_Model_End'], [name for name, version in index.search('mdl')])
+
+    def test_source_ttl_and_invalidation(self):
+        units_dir = tempfile.mkdtemp()
+        shutil.copy(testdata_path('ilimodels/Units-20120220.ili'), units_dir)
+        coordsys_dir = tempfile.mkdtemp()
+        shutil.copy(testdata_path('ilimodels/CoordSys-20151124.ili'), coordsys_dir)
+
+        config = BaseConfiguration()
+        config.custom_model_directories_enabled = True
+        config.custom_model_directories = units_dir
+        ic = ilicache.IliCache(config)
+        ic.cache_path = tempfile.mkdtemp()
+        ic.refresh()
+        self.assertEqual(['Units'], ic.model_names)
+
+        # Within the TTL the directory is not scanned again
+        scan = ic._local_ili_folder_models
+        ic._local_ili_folder_models = lambda path, *args: self.fail('{} was scanned again'.format(path))
+        ic.refresh()
+        self.assertEqual(['Units'], ic.model_names)
+        ic._local_ili_folder_models = scan
+
+        # Changing the model directories discards the previous models
+        config.custom_model_directories = coordsys_dir
+        ic.refresh()
+        self.assertEqual(['CoordSys'], ic.model_names)
+
+    def test_ili_file_per_caller(self):
+        ilifile = testdata_path('ilimodels/Units-20120220.ili')
+        ic = ilicache.IliCache(None)
+        ic.cache_path = tempfile.mkdtemp()
+
+        # The models of the file are only known to the caller which passes it
+        self.assertEqual((set(), {'Units'}), ic.model_dependencies('Units'))
+        self.assertEqual(({'Units'}, set()), ic.model_dependencies('Units', ilifile))
+        self.assertEqual([os.path.dirname(ilifile), '%JAR_DIR'], ic.required_model_directories('Units', ilifile))
+        self.assertEqual([], ic.model_names)
+
+        with_file = ilicache.IliModelCompleterModel(ic)
+        with_file.set_ili_file(ilifile)
+        without_file = ilicache.IliModelCompleterModel(ic)
+        self.assertEqual(['Units'], [with_file.data(with_file.index(row)) for row in range(with_file.rowCount())])
+        self.assertEqual(0, without_file.rowCount())
+        with_file.set_ili_file(None)
+        self.assertEqual(0, with_file.rowCount())
+
+    def test_invalidate_drops_downloads(self):
+        server = http.server.HTTPServer(('localhost', 0), functools.partial(
+            http.server.SimpleHTTPRequestHandler, directory=testdata_path('ilimodels/repo')))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        config = BaseConfiguration()
+        config.custom_model_directories_enabled = True
+        config.custom_model_directories = 'http://localhost:{}/'.format(server.server_port)
+        config.repository_cache_ttl = 0
+        ic = ilicache.IliCache(config)
+        ic.cache_path = tempfile.mkdtemp()
+        ic.refresh()
+        self.assertTrue(ic.refreshing)
+
+        # The repository is downloaded, but its models are not added anymore
+        ic.invalidate()
+        loop = QEventLoop()
+        timer = QTimer()
+        timer.timeout.connect(lambda: ic.refreshing or loop.quit())
+        timer.start(10)
+        QTimer.singleShot(5000, loop.quit)
+        loop.exec_()
+        timer.stop()
+        server.shutdown()
+
+        self.assertFalse(ic.refreshing)
+        self.assertEqual({}, ic.repositories)
+
+    def test_ilimodels_metadata(self):
+        ic = ilicache.IliCache(None)
+        ic.cache_path = tempfile.mkdtemp()
+        ic._process_ilimodels(testdata_path('ilimodels/repo/ilimodels.xml'), 'repo')
+
+        models = {model['name']: model for model in ic.repositories['repo']}
+        self.assertEqual(4, len(models))
+        model = models['GeometryCHLV95_V1']
+        self.assertEqual('2017-12-04', model['version'])
+        self.assertEqual('CHBase_Part1_GEOMETRY_20110830.ili', model['file'])
+        self.assertEqual('c407a562e1e4ecbf4669228ffaa3e050', model['md5'])
+        self.assertEqual('http://www.geo.admin.ch', model['issuer'])
+        self.assertEqual(['Units', 'CoordSys'], model['depends_on'])
+        self.assertEqual([], models['Units']['depends_on'])
+
+    def test_ilimodels_streaming(self):
+        # Read models do not stay in the tree
+        elements = list()
+        iterparse = ilicache.ET.iterparse
+
+        def recording_iterparse(*args, **kwargs):
+            for event, element in iterparse(*args, **kwargs):
+                elements.append(element)
+                yield event, element
+
+        ic = ilicache.IliCache(None)
+        ic.cache_path = tempfile.mkdtemp()
+        ilicache.ET.iterparse = recording_iterparse
+        try:
+            ic._process_ilimodels(testdata_path('ilimodels/repo/ilimodels.xml'), 'repo')
+        finally:
+            ilicache.ET.iterparse = iterparse
+
+        self.assertEqual(4, len(ic.repositories['repo']))
+        self.assertFalse([element for element in elements for child in element
+                          if child.tag.endswith('RepositoryIndex.ModelMetadata')])
+
+    def test_repository_revalidation(self):
+        requests = list()
+
+        class RequestHandler(http.server.SimpleHTTPRequestHandler):
+            def log_request(self, code='-', size='-'):
+                requests.append((self.path, int(code)))
+
+        server = http.server.HTTPServer(('localhost', 0), functools.partial(
+            RequestHandler, directory=testdata_path('ilimodels/repo')))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        config = BaseConfiguration()
+        config.custom_model_directories_enabled = True
+        config.custom_model_directories = 'http://localhost:{}/'.format(server.server_port)
+        config.repository_cache_ttl = 0
+        cache_path = tempfile.mkdtemp()
+
+        def refreshed_cache():
+            ic = ilicache.IliCache(config)
+            ic.cache_path = cache_path
+            loop = QEventLoop()
+            ic.models_changed.connect(loop.quit)
+            QTimer.singleShot(5000, loop.quit)
+            ic.refresh()
+            if not ic.model_names:
+                loop.exec_()
+            return ic
+
+        ic = refreshed_cache()
+        self.assertIn('ZG_Naturschutz_und_Erholung_V1_0', ic.model_names)
+        self.assertIn(('/ilimodels.xml', 200), requests)
+
+        # The server replies with 304 Not Modified, the cached models are reused
+        del requests[:]
+        ic = refreshed_cache()
+        self.assertIn('ZG_Naturschutz_und_Erholung_V1_0', ic.model_names)
+        self.assertIn(('/ilimodels.xml', 304), requests)
+
+        # Within the TTL the network is not accessed at all
+        del requests[:]
+        config.repository_cache_ttl = 3600
+        ic = refreshed_cache()
+        self.assertIn('ZG_Naturschutz_und_Erholung_V1_0', ic.model_names)
+        self.assertNotIn('/ilimodels.xml', [path for path, code in requests])
+
+        server.shutdown()
+
+    def test_model_mirror(self):
+        requests = list()
+
+        class RequestHandler(http.server.SimpleHTTPRequestHandler):
+            def log_request(self, code='-', size='-'):
+                requests.append(self.path)
+
+        server = http.server.HTTPServer(('localhost', 0), functools.partial(
+            RequestHandler, directory=testdata_path('ilimodels/repo')))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        config = BaseConfiguration()
+        config.custom_model_directories_enabled = True
+        config.custom_model_directories = 'http://localhost:{}/'.format(server.server_port)
+        config.model_mirror_path = tempfile.mkdtemp()
+        ic = ilicache.IliCache(config)
+        ic.cache_path = tempfile.mkdtemp()
+        loop = QEventLoop()
+        ic.models_changed.connect(loop.quit)
+        QTimer.singleShot(5000, loop.quit)
+        ic.refresh()
+        loop.exec_()
+
+        # The model and its dependencies are mirrored, CoordSys is not in the repository
+        ic.mirror_models('ZG_Naturschutz_und_Erholung_V1_0')
+        self.assertEqual(['39106630171ec5f52c68ae07074fb263.ili',
+                          'c407a562e1e4ecbf4669228ffaa3e050.ili',
+                          'e2a198a0599581673d55bbc2c968a9f8.ili'], sorted(os.listdir(config.model_mirror_path)))
+
+        # Unchanged files are not downloaded again
+        del requests[:]
+        ic.mirror_models('ZG_Naturschutz_und_Erholung_V1_0;Units')
+        self.assertEqual([], requests)
+
+        # Files are replaced when their md5 changes
+        for model in ic.repositories['localhost:{}'.format(server.server_port)]:
+            if model['name'] == 'Units':
+                model['md5'] = '0' * 32
+        ic.mirror_models('Units')
+        self.assertNotIn('e2a198a0599581673d55bbc2c968a9f8.ili', os.listdir(config.model_mirror_path))
+        self.assertEqual(['/Units-20120220.ili'], requests)
+
+        # The mirror is searched before the repositories, but after local model directories
+        args = config.to_ili2db_args()
+        self.assertEqual([config.model_mirror_path, config.custom_model_directories],
+                         args[args.index('--modeldir') + 1].split(';'))
+        config.custom_model_directories = '{};{}'.format(testdata_path('ilimodels/CIAF_LADM'),
+                                                         config.custom_model_directories)
+        args = config.to_ili2db_args()
+        self.assertEqual([testdata_path('ilimodels/CIAF_LADM'), config.model_mirror_path,
+                          'http://localhost:{}/'.format(server.server_port)],
+                         args[args.index('--modeldir') + 1].split(';'))
+
+        # Models which are no longer in the repository index are removed
+        del ic.repositories['localhost:{}'.format(server.server_port)]
+        ic.repositories['other'] = [{'name': 'Other', 'version': '1', 'file': 'Other.ili', 'url': 'http://other/Other.ili',
+                                     'md5': 'c407a562e1e4ecbf4669228ffaa3e050', 'issuer': '', 'depends_on': []}]
+        ic.mirror_models('Other')
+        self.assertEqual({'Other': 'c407a562e1e4ecbf4669228ffaa3e050'},
+                         dict(ic.file_index.conn.execute('SELECT model, md5 FROM mirror')))
+        self.assertEqual(['c407a562e1e4ecbf4669228ffaa3e050.ili'], os.listdir(config.model_mirror_path))
+
+        server.shutdown()
+
+    def test_repository_crawl(self):
+        requests = list()
+
+        class RequestHandler(http.server.SimpleHTTPRequestHandler):
+            def log_request(self, code='-', size='-'):
+                requests.append((self.path, int(code)))
+
+        repository_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(repository_path, 'sub'))
+        server = http.server.ThreadingHTTPServer(('localhost', 0), functools.partial(
+            RequestHandler, directory=repository_path))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://localhost:{}/'.format(server.server_port)
+
+        # The sites reference each other
+        ilisite = """<?xml version="1.0" encoding="UTF-8"?>
+<TRANSFER xmlns="http://www.interlis.ch/INTERLIS2.3">
+<DATASECTION>
+<IliSite09.SiteMetadata BID="b1">
+<IliSite09.SiteMetadata.Site TID="1">
+<Name>test</Name>
+<subsidiarySite>
+<IliSite09.RepositoryLocation_><value>{}</value></IliSite09.RepositoryLocation_>
+<IliSite09.RepositoryLocation_><value>{}</value></IliSite09.RepositoryLocation_>
+</subsidiarySite>
+</IliSite09.SiteMetadata.Site>
+</IliSite09.SiteMetadata>
+</DATASECTION>
+</TRANSFER>"""
+        for directory in ['', 'sub']:
+            shutil.copy(testdata_path('ilimodels/repo/ilimodels.xml'),
+                        os.path.join(repository_path, directory))
+            with open(os.path.join(repository_path, directory, 'ilisite.xml'), 'w') as f:
+                f.write(ilisite.format(url, url + 'sub'))
+
+        config = BaseConfiguration()
+        config.custom_model_directories_enabled = True
+        config.custom_model_directories = url
+        ic = ilicache.IliCache(config)
+        ic.cache_path = tempfile.mkdtemp()
+        notifications = list()
+        loop = QEventLoop()
+        ic.models_changed.connect(lambda: notifications.append(True))
+        ic.models_changed.connect(loop.quit)
+        QTimer.singleShot(5000, loop.quit)
+        ic.refresh()
+        loop.exec_()
+
+        self.assertEqual(1, len(notifications))
+        self.assertEqual(1, requests.count(('/ilimodels.xml', 200)))
+        self.assertEqual(1, requests.count(('/sub/ilimodels.xml', 200)))
+        self.assertEqual(2, len(ic.repositories))
+
+        server.shutdown()
+
+
+# Stands in for java running Ili2dbWorker.java: prints the decoded arguments
+# of every job and exits the process like ili2db does for "exit <code>"
+FAKE_WORKER = """#!{python}
+import sys
+import urllib.parse
+
+sys.stderr.write('starting\\nILI2DB_WORKER_READY\\n')
+sys.stderr.flush()
+for job in sys.stdin:
+    args = [urllib.parse.unquote(arg) for arg in job.rstrip('\\n').split('\\t')]
+    if args[0] == 'exit':
+        sys.stderr.write('Error: {{}}\\n'.format(args[1]))
+        sys.stderr.flush()
+        sys.exit(int(args[1]))
+    sys.stdout.write('\\n'.join(args) + '\\n')
+    sys.stdout.flush()
+    sys.stderr.write('Info: done\\n\\nILI2DB_WORKER_DONE 0\\n')
+    sys.stderr.flush()
+"""
+
+# Stands in for a Java older than 11 which cannot run source files
+OLD_JAVA = """#!{python}
+import sys
+
+sys.stderr.write('Error: Could not find or load main class Ili2dbWorker.java\\n')
+sys.exit(1)
+"""
+
+
+class FakeProcess(object):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def readAllStandardError(self):
+        return self.chunks.pop(0)
+
+
+class Ili2dbWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.basetestpath = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.basetestpath, True)
+        self.addCleanup(iliworker.shutdown_ili2db_workers)
+
+    def executable(self, name, source):
+        path = os.path.join(self.basetestpath, name)
+        with open(path, 'w') as f:
+            f.write(source.format(python=sys.executable))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+    def test_marker_parsing(self):
+        worker = iliworker.Ili2dbWorker('java', 'ili2pg.jar', 'utf-8')
+        stderr = list()
+        finished = list()
+        worker.stderr.connect(stderr.append)
+        worker.job_finished.connect(finished.append)
+
+        # Markers split across reads are only recognized as complete lines
+        worker._proc = FakeProcess([b'Loading\nILI2DB_WORK', b'ER_READY\nInfo: a\nInfo: b',
+                                    b'\n\nILI2DB_WORKER_DONE 0\nInfo: c\nILI2DB_WORKER_DONE 2\n'])
+        worker._stderr_ready()
+        self.assertFalse(worker._ready)
+        self.assertEqual(['Loading\n'], stderr)
+        worker._stderr_ready()
+        self.assertTrue(worker._ready)
+        self.assertEqual([], finished)
+        worker._stderr_ready()
+        self.assertEqual(['Loading\n', 'Info: a\n', 'Info: b\n\n', 'Info: c\n'], stderr)
+        self.assertEqual([0, 2], finished)
+
+        # A job ended by the process exiting finishes with the process exit code
+        worker.running = True
+        worker._stderr_buffer = b'Error: failed'
+        worker._proc_finished(3, iliworker.QProcess.NormalExit)
+        self.assertEqual('Error: failed\n', stderr[-1])
+        self.assertEqual([0, 2, 3], finished)
+        self.assertFalse(worker.running)
+        worker._proc_finished(0, iliworker.QProcess.NormalExit)
+        self.assertEqual([0, 2, 3], finished)
+
+    def test_worker_jobs(self):
+        java = self.executable('java', FAKE_WORKER)
+        worker = iliworker.get_ili2db_worker(java, 'ili2pg.jar', 'utf-8')
+        self.assertTrue(worker.running)
+        self.assertIs(worker, iliworker.get_ili2db_worker(java, 'ili2pg.jar', 'utf-8'))
+
+        stdout = list()
+        stderr = list()
+        worker.stdout.connect(stdout.append)
+        worker.stderr.connect(stderr.append)
+        args = ['--schemaimport', '--dbschema', 'tab\tschema', '--models', 'Model A;Modèle%B', '--dbpwd', '']
+        self.assertEqual(0, worker.run(args))
+        self.assertEqual(args, ''.join(stdout).split('\n')[:-1])
+        self.assertIn('Info: done\n', ''.join(stderr))
+
+        # ili2db exiting the process ends the job, the next one gets a new worker
+        self.assertEqual(4, worker.run(['exit', '4']))
+        self.assertIn('Error: 4', ''.join(stderr))
+        self.assertFalse(worker.running)
+        restarted = iliworker.get_ili2db_worker(java, 'ili2pg.jar', 'utf-8')
+        self.assertIsNot(worker, restarted)
+        self.assertTrue(restarted.running)
+        self.assertEqual(0, restarted.run(['--version']))
+
+    def test_worker_fallback(self):
+        java = self.executable('java', OLD_JAVA)
+        worker = iliworker.get_ili2db_worker(java, 'ili2pg.jar', 'utf-8')
+        failed = list()
+        worker.start_failed.connect(lambda: failed.append(True))
+        # The job submitted while loading is not run
+        self.assertIsNone(worker.run(['--version']))
+        self.assertEqual([True], failed)
+        self.assertFalse(worker.running)
+        # Not tried again, callers run ili2db in a process of its own
+        os.remove(java)
+        self.assertIsNone(iliworker.get_ili2db_worker(java, 'ili2pg.jar', 'utf-8'))
+
+    def test_busy_worker(self):
+        java = self.executable('java', FAKE_WORKER)
+        worker = iliworker.get_ili2db_worker(java, 'ili2pg.jar', 'utf-8')
+        finished = list()
+        worker.job_finished.connect(finished.append)
+
+        # Jobs submitted before the worker is ready run once it is
+        worker.submit(['--version'])
+        self.assertTrue(worker.busy)
+        # Other callers do not share a busy worker
+        self.assertIsNone(iliworker.get_ili2db_worker(java, 'ili2pg.jar', 'utf-8'))
+
+        loop = iliworker.QEventLoop()
+        worker.job_finished.connect(loop.quit)
+        loop.exec_()
+        self.assertEqual([0], finished)
+        self.assertFalse(worker.busy)
+        self.assertIs(worker, iliworker.get_ili2db_worker(java, 'ili2pg.jar', 'utf-8'))
+
+    @unittest.skipIf('TRAVIS' in os.environ, 'Downloads ili2db')
+    def test_worker_ili2db(self):
+        try:
+            java = javaruntime.get_java_runtime()
+        except ili2dbconfig.JavaNotFoundError:
+            raise unittest.SkipTest('No java available')
+        if java.major_version < 11:
+            raise unittest.SkipTest('The worker needs Java 11, found {}'.format(java.version))
+
+        output = list()
+
+        class Signal(object):
+            def emit(self, text):
+                output.append(text)
+
+        ili2db_bin = ili2dbutils.get_ili2db_bin('ili2gpkg', Signal(), Signal(), ili2dbconfig.ili2db_tools)
+        if ili2db_bin is None:
+            raise unittest.SkipTest('ili2gpkg could not be installed')
+
+        worker = iliworker.get_ili2db_worker(java.path, ili2db_bin, 'utf-8')
+        self.assertIsNotNone(worker)
+        worker.stderr.connect(output.append)
+        gpkg = os.path.join(self.basetestpath, 'worker test.gpkg')
+        args = ['--schemaimport', '--dbfile', gpkg, '--coalesceCatalogueRef', '--createEnumTabs',
+                '--createNumChecks', '--coalesceMultiSurface', '--createGeomIdx', '--createFk',
+                '--createMetaInfo', '--defaultSrsAuth', 'EPSG', '--defaultSrsCode', '2056',
+                '--modeldir', testdata_path('ilimodels/CIAF_LADM'), '--models', 'CIAF_LADM']
+        self.assertEqual(0, worker.run(args), ''.join(output))
+        self.assertTrue(os.path.isfile(gpkg))
+
+        # The same worker runs the next invocation
+        self.assertIs(worker, iliworker.get_ili2db_worker(java.path, ili2db_bin, 'utf-8'))
+        self.assertTrue(worker.running)
+        self.assertEqual(0, worker.run(args), ''.join(output))
+
 if __name__ == '__main__':
     nose2.main()
@@ -22,7 +22,8 @@ import os.path
 import inspect
 from qgis.PyQt.QtWidgets import (
     QFileDialog,
-    QApplication
+    QApplication,
+    QCompleter
 )
 from qgis.PyQt.QtCore import (
     QCoreApplication,
@@ -33,21 +34,32 @@ from qgis.PyQt.QtCore import (
     QUrl
 )
 from qgis.PyQt.QtGui import QValidator
-from qgis.PyQt.QtNetwork import QNetworkRequest
+from qgis.PyQt.QtNetwork import QNetworkRequest, QNetworkReply
 from qgis.core import QgsNetworkAccessManager
 from functools import partial
 import fnmatch
 
 
-def selectFileName(line_edit_widget, title, file_filter, parent):
+def selectFileName(line_edit_widget, title, file_filter, parent, multiple=False):
+    if multiple:
+        filenames, matched_filter = QFileDialog.getOpenFileNames(
+            parent, title, line_edit_widget.text().split(';')[0], file_filter)
+        if filenames:
+            line_edit_widget.setText(';'.join(filenames))
+        return
     filename, matched_filter = QFileDialog.getOpenFileName(
         parent, title, line_edit_widget.text(), file_filter)
     line_edit_widget.setText(filename)
 
 
 def make_file_selector(widget, title=QCoreApplication.translate('projectgenerator', 'Open File'),
-                       file_filter=QCoreApplication.translate('projectgenerator', 'Any file(*)'), parent=None):
-    return partial(selectFileName, line_edit_widget=widget, title=title, file_filter=file_filter, parent=parent)
+                       file_filter=QCoreApplication.translate('projectgenerator', 'Any file(*)'), parent=None,
+                       multiple=False):
+    """
+    With ``multiple`` several files can be selected, they are separated by ``;``.
+    """
+    return partial(selectFileName, line_edit_widget=widget, title=title, file_filter=file_filter, parent=parent,
+                   multiple=multiple)
 
 
 def selectFileNameToSave(line_edit_widget, title, file_filter, parent, extension, extensions):
@@ -88,7 +100,12 @@ class NetworkError(RuntimeError):
         self.error_code = error_code
 
 
-def download_file(url, filename, on_progress=None, on_finished=None, on_error=None, on_success=None):
+# Asynchronous downloads are kept referenced until they are finished, the
+# reply and its callbacks would otherwise be garbage collected while running
+_pending_downloads = set()
+
+
+def download_file(url, filename, on_progress=None, on_finished=None, on_error=None, on_success=None, headers=None, on_reply=None):
     """
     Will download the file from url to a local filename.
     The method will only return once it's finished.
@@ -96,6 +113,13 @@ def download_file(url, filename, on_progress=None, on_finished=None, on_error=No
     While downloading it will repeatedly report progress by calling on_progress
     with two parameters bytes_received and bytes_total.
 
+    Additional request headers can be passed in the ``headers`` dict. If the
+    server replies with ``304 Not Modified`` to a conditional request, the local
+    file is left untouched and the download counts as successful.
+
+    If on_reply is set, it will be called with the finished QNetworkReply before
+    on_error or on_success, e.g. to read response headers.
+
     If an error occurs, it raises a NetworkError exception.
 
     It will return the filename if everything was ok.
@@ -103,16 +127,23 @@ def download_file(url, filename, on_progress=None, on_finished=None, on_error=No
     network_access_manager = QgsNetworkAccessManager.instance()
 
     req = QNetworkRequest(QUrl(url))
+    if headers:
+        for header, value in headers.items():
+            req.setRawHeader(header.encode(), value.encode())
     reply = network_access_manager.get(req)
 
     def on_download_progress(bytes_received, bytes_total):
         on_progress(bytes_received, bytes_total)
 
     def finished():
-        file = QFile(filename)
-        file.open(QIODevice.WriteOnly)
-        file.write(reply.readAll())
-        file.close()
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if not reply.error() and status != 304:
+            file = QFile(filename)
+            file.open(QIODevice.WriteOnly)
+            file.write(reply.readAll())
+            file.close()
+        if on_reply:
+            on_reply(reply)
         if reply.error() and on_error:
             on_error(reply.error(), reply.errorString())
         elif not reply.error() and on_success:
@@ -120,12 +151,15 @@ def download_file(url, filename, on_progress=None, on_finished=None, on_error=No
 
         if on_finished:
             on_finished()
+        _pending_downloads.discard(download)
         reply.deleteLater()
 
     if on_progress:
         reply.downloadProgress.connect(on_download_progress)
 
     reply.finished.connect(finished)
+    download = (reply, finished, on_download_progress)
+    _pending_downloads.add(download)
 
     if not on_finished and not on_success:
         loop = QEventLoop()
@@ -138,6 +172,88 @@ def download_file(url, filename, on_progress=None, on_finished=None, on_error=No
             return filename
 
 
+def download_file_resumable(url, filename, on_progress=None):
+    """
+    Downloads the file from url to a local filename, streaming the reply to
+    disk instead of keeping it in memory. The method will only return once
+    it's finished.
+
+    The data is written to ``filename + '.part'`` first. If this file exists
+    from an interrupted download, only the missing bytes are requested with an
+    HTTP range request. The completed file is moved to ``filename``.
+
+    While downloading it will repeatedly report progress by calling on_progress
+    with two parameters bytes_received and bytes_total.
+
+    If an error occurs, it raises a NetworkError exception. The partial file is
+    kept to resume the download later, unless the server answered with an
+    error status. Only the bodies of 200 and 206 replies are written.
+
+    It will return the filename if everything was ok.
+    """
+    part_filename = filename + '.part'
+    offset = os.path.getsize(part_filename) if os.path.isfile(part_filename) else 0
+
+    req = QNetworkRequest(QUrl(url))
+    if offset:
+        req.setRawHeader(b'Range', 'bytes={}-'.format(offset).encode())
+    reply = QgsNetworkAccessManager.instance().get(req)
+    part_file = list()
+
+    def on_ready_read():
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if status not in (200, 206):
+            # Error pages and redirects are no part of the file
+            reply.readAll()
+            return
+        if not part_file:
+            if status == 206:
+                part_file.append(open(part_filename, 'ab'))
+            else:
+                # The server ignored the range, start from scratch
+                part_file.append(open(part_filename, 'wb'))
+        part_file[0].write(reply.readAll().data())
+
+    def on_download_progress(bytes_received, bytes_total):
+        if bytes_total >= 0 and reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) == 206:
+            bytes_received += offset
+            bytes_total += offset
+        on_progress(bytes_received, bytes_total)
+
+    reply.readyRead.connect(on_ready_read)
+    if on_progress:
+        reply.downloadProgress.connect(on_download_progress)
+
+    loop = QEventLoop()
+    reply.finished.connect(loop.quit)
+    if not reply.isFinished():
+        loop.exec_()
+
+    if not reply.error():
+        on_ready_read()
+    if part_file:
+        part_file[0].close()
+    status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+    error, error_string = reply.error(), reply.errorString()
+    reply.deleteLater()
+
+    if status == 416 and offset:
+        # The partial file is not a prefix of the current file on the server
+        os.remove(part_filename)
+        return download_file_resumable(url, filename, on_progress)
+    if status is not None and status not in (200, 206):
+        # Nothing to resume from
+        if os.path.isfile(part_filename):
+            os.remove(part_filename)
+        if not error:
+            raise NetworkError(QNetworkReply.ProtocolFailure, 'HTTP status {}'.format(status))
+    if error:
+        raise NetworkError(error, error_string)
+
+    os.replace(part_filename, filename)
+    return filename
+
+
 class Validators(QObject):
 
     def validate_line_edits(self, *args, **kwargs):
@@ -162,7 +278,8 @@ class Validators(QObject):
 
 class FileValidator(QValidator):
 
-    def __init__(self, pattern='*', is_executable=False, parent=None, allow_empty=False, allow_non_existing=False):
+    def __init__(self, pattern='*', is_executable=False, parent=None, allow_empty=False, allow_non_existing=False,
+                 allow_multiple=False):
         """
         Validates if a string is a valid filename, based on the provided parameters.
 
@@ -172,12 +289,14 @@ class FileValidator(QValidator):
         :param parent: The parent QObject
         :param allow_empty: Empty strings are valid
         :param allow_non_existing: Non existing files are valid
+        :param allow_multiple: Several filenames separated by ``;`` are valid if each of them is
         """
         QValidator.__init__(self, parent)
         self.pattern = pattern
         self.is_executable = is_executable
         self.allow_empty = allow_empty
         self.allow_non_existing = allow_non_existing
+        self.allow_multiple = allow_multiple
 
     """
     Validator for file line edits
@@ -187,6 +306,17 @@ class FileValidator(QValidator):
         if self.allow_empty and not text.strip():
             return QValidator.Acceptable, text, pos
 
+        if self.allow_multiple and ';' in text:
+            filenames = text.split(';')
+            if all(self._validate_file(filename.strip()) for filename in filenames):
+                return QValidator.Acceptable, text, pos
+            return QValidator.Intermediate, text, pos
+
+        if self._validate_file(text):
+            return QValidator.Acceptable, text, pos
+        return QValidator.Intermediate, text, pos
+
+    def _validate_file(self, text):
         pattern_matches = False
         if type(self.pattern) is str:
             pattern_matches = fnmatch.fnmatch(text, self.pattern)
@@ -199,9 +329,9 @@ class FileValidator(QValidator):
                 or (not self.allow_non_existing and not os.path.isfile(text)) \
                 or not pattern_matches \
                 or (self.is_executable and not os.access(text, os.X_OK)):
-            return QValidator.Intermediate, text, pos
+            return False
         else:
-            return QValidator.Acceptable, text, pos
+            return True
 
 
 class NonEmptyStringValidator(QValidator):
@@ -216,6 +346,19 @@ class NonEmptyStringValidator(QValidator):
         return QValidator.Acceptable, text, pos
 
 
+class SearchCompleter(QCompleter):
+    """
+    Completer which leaves the search to its model.
+
+    The model needs a ``set_search_text(text)`` method and returns the
+    matches already ranked, the completer shows them without filtering.
+    """
+
+    def splitPath(self, path):
+        self.model().set_search_text(path)
+        return ['']
+
+
 class OverrideCursor():
 
     def __init__(self, cursor):